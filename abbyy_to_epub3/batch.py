@@ -0,0 +1,471 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Converts many books in one run, on a pool of worker processes, so the
+imports & tool probes are paid once rather than once per book.
+"""
+
+from collections import Counter
+from multiprocessing import Pool, SimpleQueue, active_children
+
+import contextlib
+import csv
+import json
+import logging
+import os
+import queue
+import signal
+import time
+import traceback
+
+MANIFEST_FIELDS = ['item_dir', 'item_identifier', 'item_bookpath']
+# the files which make a book of an item, after its bookpath
+BOOK_SUFFIXES = ['_abbyy.gz', '_scandata.xml']
+
+logger = logging.getLogger(__name__)
+
+_scratch_limit = None  # the batch's ScratchLimit, in a worker process
+_started = None  # where a worker process records the tasks it takes
+_task_id = None  # the task a worker process is running
+
+
+def read_manifest(path):
+    """
+    The books listed in a manifest: a CSV file with a header row, or a
+    JSON Lines file (`.jsonl`) of objects. Each book needs `item_dir` &
+    `item_identifier`; `item_bookpath` defaults to the identifier, and an
+    optional `out` is the EPUB's path. Raises ValueError for a book missing
+    a field, naming its line. A `workdir` keeps the book's intermediate
+    files & checkpoints, for `Ebook.craft_epub`.
+    """
+    jobs = []
+    with open(path, newline='') as f:
+        if path.endswith('.jsonl'):
+            rows = (
+                (line_no, json.loads(line))
+                for (line_no, line) in enumerate(f, start=1)
+                if line.strip()
+            )
+        else:
+            rows = enumerate(csv.DictReader(f), start=2)
+        for (line_no, row) in rows:
+            job = {
+                key: value for (key, value) in row.items()
+                if value not in (None, '')
+            }
+            job.setdefault('item_bookpath', job.get('item_identifier'))
+            missing = [key for key in MANIFEST_FIELDS if not job.get(key)]
+            if missing:
+                raise ValueError("{}, line {}: missing {}".format(
+                    path, line_no, ', '.join(missing)))
+            jobs.append(job)
+    return jobs
+
+
+def scan_items(root):
+    """
+    The books in every item directory under root: a directory holding
+    exactly one `<identifier>_meta.xml` is an item, & its books are found
+    by `item_books`.
+    """
+    jobs = []
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        metas = [name for name in filenames if name.endswith('_meta.xml')]
+        if len(metas) != 1:
+            if metas:
+                logger.warning(
+                    "Skipping {}: more than one _meta.xml".format(dirpath))
+            continue
+        jobs.extend(item_books(dirpath, filenames=filenames))
+    return jobs
+
+
+def item_books(item_dir, item_identifier=None, filenames=None):
+    """
+    The books of one item: each `<bookpath>_abbyy.gz` or
+    `<bookpath>_scandata.xml` in item_dir is a book, even with the other
+    missing, so that its conversion reports what is. Without an
+    identifier, it's taken from the item's only `<identifier>_meta.xml`;
+    raises ValueError if there isn't exactly one.
+    """
+    if filenames is None:
+        filenames = os.listdir(item_dir)
+    if item_identifier is None:
+        metas = [name for name in filenames if name.endswith('_meta.xml')]
+        if len(metas) != 1:
+            raise ValueError("{}: {} _meta.xml files, not one".format(
+                item_dir, len(metas)))
+        item_identifier = metas[0][:-len('_meta.xml')]
+    bookpaths = set()
+    for name in filenames:
+        for suffix in BOOK_SUFFIXES:
+            if name.endswith(suffix):
+                bookpaths.add(name[:-len(suffix)])
+    return [
+        {
+            'item_dir': item_dir,
+            'item_identifier': item_identifier,
+            'item_bookpath': bookpath,
+        }
+        for bookpath in sorted(bookpaths)
+    ]
+
+
+def epub_path(job, out_dir):
+    """ Where a book's EPUB goes: its `out`, else named for its bookpath """
+    return job.get('out') or os.path.join(
+        out_dir, '{}.epub'.format(os.path.basename(job['item_bookpath']))
+    )
+
+
+def book_workdir(job, workdir):
+    """
+    The book's work directory: its own `workdir` if it has one, else one
+    for it under workdir, if given.
+    """
+    if job.get('workdir') or not workdir:
+        return job.get('workdir')
+    return os.path.join(
+        workdir, job['item_identifier'],
+        os.path.basename(job['item_bookpath']),
+    )
+
+
+def init_worker(scratch_limit=None, started=None):
+    """
+    Share the batch's ScratchLimit, if it has one, & its TaskWatch's queue,
+    with a worker
+    """
+    global _scratch_limit, _started
+    _scratch_limit = scratch_limit
+    _started = started
+
+
+@contextlib.contextmanager
+def no_scratch():
+    """ Holds no scratch space, for a batch without a scratch limit """
+    yield None
+
+
+def watched(convert, task_id, task):
+    """
+    Run convert on a task in a worker process, having recorded which
+    process took it, for the TaskWatch
+    """
+    global _task_id
+    _task_id = task_id
+    report_task('started', os.getpid())
+    return convert(task)
+
+
+def report_task(event, value):
+    """
+    Tell the TaskWatch, if there is one, of the task this worker is
+    running: `started` by a process, `waiting` for scratch bytes, or
+    `holding` them.
+    """
+    if _started is not None and _task_id is not None:
+        _started.put((event, _task_id, value))
+
+
+class TaskWatch(object):
+    """
+    Notices tasks lost to a pool: a pool replaces a worker process which
+    dies, killed by the OOM killer say, but never answers for the task it
+    had. Workers run each task through `watched`, which records the
+    process taking it on `queue`; a task whose process has gone without
+    its result coming back is lost.
+
+    So is one which has run for longer than `deadline` seconds, if that's
+    set: its worker is killed, for the pool to replace, so a stuck book
+    can't keep a worker from the books queued behind it. A book waiting
+    for scratch space isn't timed out, & its deadline counts from when it
+    has it. The scratch bytes a lost book held are given to `release`.
+    """
+    GRACE = 2  # seconds a dead worker's result may still be on its way
+
+    def __init__(self, deadline=0, release=None):
+        self.queue = SimpleQueue()
+        self.deadline = deadline
+        self.release = release
+        self.started = {}   # task id: (pid, when its deadline counts from)
+        self.waiting = set()  # tasks waiting for scratch space
+        self.held = {}      # task id: scratch bytes it holds
+        self.dead = {}      # task id: when its process was first seen gone
+
+    def lost(self, outstanding):
+        """
+        Of the outstanding task ids, those lost since last asked, as
+        (task id, why) pairs.
+        """
+        while not self.queue.empty():
+            (event, task_id, value) = self.queue.get()
+            if event == 'started':
+                self.started[task_id] = (value, time.time())
+            elif event == 'waiting':
+                self.waiting.add(task_id)
+            elif event == 'holding' and task_id in self.started:
+                self.waiting.discard(task_id)
+                self.held[task_id] = value
+                self.started[task_id] = (
+                    self.started[task_id][0], time.time())
+        alive = {process.pid for process in active_children()}
+        now = time.time()
+        lost = []
+        for task_id in outstanding:
+            if task_id not in self.started:
+                continue    # still queued
+            (pid, began) = self.started[task_id]
+            if pid not in alive:
+                if now - self.dead.setdefault(task_id, now) >= self.GRACE:
+                    lost.append((task_id, 'worker died'))
+            elif (
+                self.deadline and task_id not in self.waiting and
+                now - began >= self.deadline
+            ):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                lost.append((task_id, 'timed out'))
+        for (task_id, why) in lost:
+            if self.held.get(task_id) and self.release:
+                self.release(self.held[task_id])
+            self.forget(task_id)
+        return lost
+
+    def forget(self, task_id):
+        """ Stop watching a task, once it's answered for """
+        self.started.pop(task_id, None)
+        self.waiting.discard(task_id)
+        self.held.pop(task_id, None)
+        self.dead.pop(task_id, None)
+
+
+def book_result(job, out_dir):
+    """ The result line of a book, before it's converted """
+    result = dict(job)
+    result.update({
+        'out': epub_path(job, out_dir),
+        'status': 'ok',
+        'exit_code': 0,
+        'error': None,
+        'pid': os.getpid(),
+    })
+    return result
+
+
+def lost_result(job, out_dir, error):
+    """ The result line of a book whose conversion was lost or failed """
+    result = book_result(job, out_dir)
+    result.update({
+        'status': 'failed',
+        'exit_code': 1,
+        'error': error,
+        'pid': None,
+        'seconds': 0,
+    })
+    return result
+
+
+def convert_item(task):
+    """
+    Convert one book in a worker process, and describe how it went. Any
+    failure, including a missing scandata exit, is reported rather than
+    raised, so one bad book doesn't stop the batch. Under a scratch limit,
+    the book waits until its estimated scratch space fits.
+    """
+    from abbyy_to_epub3.create_epub import (
+        ERR_MEMORY_BUDGET, ERR_MISSING_SCANDATA, Ebook,
+    )
+    (job, out_dir, tmpdir, options) = task
+    result = book_result(job, out_dir)
+    book = None
+    start = time.perf_counter()
+    try:
+        book = Ebook(
+            job['item_dir'], job['item_identifier'], job['item_bookpath'],
+            **options
+        )
+        if _scratch_limit:
+            estimate = book.scratch_estimate()
+            report_task('waiting', estimate)
+            scratch = _scratch_limit.hold(estimate)
+        else:
+            estimate = 0
+            scratch = no_scratch()
+        waited = time.perf_counter()
+        with scratch:
+            result['scratch_wait'] = time.perf_counter() - waited
+            if estimate:
+                report_task('holding', estimate)
+            book.craft_epub(
+                epub_outfile=result['out'], tmpdir=tmpdir,
+                workdir=job.get('workdir'),
+            )
+        if book.memory and book.memory.over_budget():
+            result.update({
+                'status': 'failed',
+                'exit_code': ERR_MEMORY_BUDGET,
+                'error': 'over the memory budget',
+            })
+    except SystemExit as e:
+        result.update({
+            'status': 'failed',
+            # sys.exit() exits 0, & sys.exit('message') 1
+            'exit_code': (
+                e.code if isinstance(e.code, int) else
+                0 if e.code is None else 1
+            ),
+            'error': (
+                'missing scandata' if e.code == ERR_MISSING_SCANDATA
+                else 'exited'
+            ),
+        })
+    except Exception as e:
+        result.update({
+            'status': 'failed',
+            'exit_code': 1,
+            'error': '{}: {}'.format(type(e).__name__, e),
+        })
+        logger.debug("{} failed:\n{}".format(
+            job['item_bookpath'], traceback.format_exc()))
+    result['seconds'] = time.perf_counter() - start
+
+    # The book is None if it failed before it was set up
+    if book is not None:
+        report = book.instrumentation.report()
+        result['stages'] = {
+            name: totals['wall']
+            for (name, totals) in report['spans'].get('stage', {}).items()
+        }
+        result['counters'] = report['counters']
+        result['sha256'] = book.content_hash
+        if book.memory:
+            result['peak_rss'] = book.memory.peak
+    return result
+
+
+def finisher(done, task_id, job=None, out_dir=None):
+    """
+    A pool callback putting a task's result on the done queue, or, given
+    its job, an error callback putting a failed result there: convert
+    reports failures itself, so an error is the pool failing.
+    """
+    def finish(result):
+        if job is not None:
+            result = lost_result(
+                job, out_dir, '{}: {}'.format(type(result).__name__, result))
+        done.put((task_id, result))
+    return finish
+
+
+def run_batch(
+    jobs, results_file, out_dir='.', tmpdir=None, workers=None,
+    books_per_worker=None, options=None, workdir=None, scratch_limit=0,
+    book_timeout=0, convert=convert_item,
+):
+    """
+    Convert jobs, as from `read_manifest` or `scan_items`, on `workers`
+    processes (default one per CPU), each replaced after converting
+    `books_per_worker` books to contain leaks. `options` are passed to each
+    Ebook. Given a workdir, each book keeps its intermediate files &
+    checkpoints in a directory under it, so rerunning a batch after a
+    crash resumes the books it cut short. A JSON line describing each book
+    is written to results_file as it finishes. Returns a Counter of the
+    books' statuses.
+
+    A `scratch_limit`, in bytes, caps the scratch space of the books being
+    converted at once: each holds its estimate while it runs, & a book
+    that doesn't fit waits, rather than filling the scratch disk.
+
+    Each item's `_meta.xml` is read once, here, & given to the workers
+    converting its books.
+
+    A worker killed outright, by the OOM killer say, loses its book: the
+    pool replaces the worker, & the book gets a failed result line, with
+    the error `worker died`, while the others carry on. So does a book
+    still converting after `book_timeout` seconds, if that's set, with the
+    error `timed out`; its worker is killed, & replaced, so the books
+    queued behind it still run. `convert` is run in the workers on
+    (job, out_dir, tmpdir, options).
+    """
+    # Loaded & probed before the workers start, so that forked workers
+    # inherit them rather than each paying for them again
+    from abbyy_to_epub3.create_epub import (
+        choose_image_backend, read_item_metadata,
+    )
+    from abbyy_to_epub3.workspace import ScratchLimit
+    options = dict(options or {})
+    choose_image_backend(options.get('image_backend'))
+
+    os.makedirs(out_dir, exist_ok=True)
+    statuses = Counter()
+    item_metadata = {}  # _meta.xml path: its metadata, None if unreadable
+
+    def book_options(job):
+        meta_xml = os.path.join(
+            job['item_dir'], '{}_meta.xml'.format(job['item_identifier']))
+        if meta_xml not in item_metadata:
+            try:
+                item_metadata[meta_xml] = read_item_metadata(meta_xml)
+            except Exception:
+                # The book's conversion will report it
+                item_metadata[meta_xml] = None
+        return dict(options, item_metadata=item_metadata[meta_xml])
+
+    limit = ScratchLimit(scratch_limit) if scratch_limit else None
+    watch = TaskWatch(book_timeout, release=limit.release if limit else None)
+    done = queue.Queue()  # (task id, result) as each book finishes
+    outstanding = {}      # task id: job, for each book not yet finished
+    with Pool(
+        processes=workers or None, maxtasksperchild=books_per_worker or None,
+        initializer=init_worker, initargs=(limit, watch.queue),
+    ) as pool:
+        for (task_id, job) in enumerate(jobs):
+            job = dict(job, workdir=book_workdir(job, workdir))
+            outstanding[task_id] = job
+            pool.apply_async(
+                watched,
+                (convert, task_id, (job, out_dir, tmpdir, book_options(job))),
+                callback=finisher(done, task_id),
+                error_callback=finisher(done, task_id, job, out_dir),
+            )
+        while outstanding:
+            # Results already in are taken first, not given up on
+            lost = watch.lost(outstanding) if done.empty() else []
+            for (task_id, why) in lost:
+                done.put(
+                    (task_id, lost_result(outstanding[task_id], out_dir, why))
+                )
+            try:
+                (task_id, result) = done.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if outstanding.pop(task_id, None) is None:
+                continue    # finished after it was given up on
+            watch.forget(task_id)
+            results_file.write(json.dumps(result, sort_keys=True) + '\n')
+            results_file.flush()
+            statuses[result['status']] += 1
+            logger.debug("{}: {} in {:.1f}s".format(
+                result['item_bookpath'], result['status'], result['seconds']))
+    return statuses
@@ -0,0 +1,222 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+# Image libraries we can use, in order of preference
+IMAGE_BACKENDS = ['kakadu', 'pillow']
+
+# Seconds a version probe may take before the tool counts as unusable
+PROBE_TIMEOUT = 30
+
+
+def version_tuple(version):
+    """ Turn a version string such as 'v7.10.2' into (7, 10, 2). """
+    match = re.search(r'(\d+(?:\.\d+)*)', version or '')
+    if not match:
+        return ()
+    return tuple(int(part) for part in match.group(1).split('.'))
+
+
+def _run(cmd):
+    """ Run a probe command, returning its combined output or None. """
+    try:
+        result = subprocess.run(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            timeout=PROBE_TIMEOUT,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return result.stdout.decode('utf-8', 'replace')
+
+
+def probe_kakadu():
+    """ kdu_expand: version, & whether it takes threads & regions. """
+    version = _run(['kdu_expand', '-v'])
+    if version is None:
+        return None
+    usage = _run(['kdu_expand', '-usage']) or ''
+    return {
+        'version': '.'.join(str(v) for v in version_tuple(version)),
+        'features': {
+            'num_threads': '-num_threads' in usage,
+            'region_decode': '-region' in usage,
+            'reduce': '-reduce' in usage,
+        },
+    }
+
+
+def probe_pillow():
+    """ Pillow is a requirement; check it can decode JPEG 2000. """
+    import PIL
+    from PIL import features
+    if not features.check('jpg_2000'):
+        return None
+    return {
+        'version': PIL.__version__,
+        'features': {
+            'num_threads': False,
+            'region_decode': False,
+            'reduce': True,
+        },
+    }
+
+
+def probe_node():
+    """ NodeJS, needed to run DAISY Ace """
+    version = _run(['node', '--version'])
+    if version is None:
+        return None
+    return {
+        'version': '.'.join(str(v) for v in version_tuple(version)),
+        'features': {},
+    }
+
+
+PROBES = {
+    'kakadu': ('kdu_expand', probe_kakadu),
+    'pillow': (None, probe_pillow),
+    'node': ('node', probe_node),
+}
+
+
+class ToolRegistry(object):
+    """
+    Records which external tools & libraries are available, their versions,
+    and the features we care about. Each tool is probed once per process.
+
+    Probe results can also be persisted to a JSON file shared between
+    processes, so a batch of conversions only spawns the probes once per
+    `ttl` seconds. A remembered probe is discarded early if the tool's
+    executable has moved.
+    """
+
+    def __init__(self, cache_file=None, ttl=86400):
+        self.logger = logging.getLogger(__name__)
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def persist_to(self, cache_file, ttl=86400):
+        """ Remember probes in cache_file for `ttl` seconds. """
+        self.cache_file = cache_file
+        self.ttl = ttl
+
+    def _load(self):
+        if not self.cache_file:
+            return {}
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, name, record):
+        if not self.cache_file:
+            return
+        saved = self._load()
+        saved[name] = record
+        directory = os.path.dirname(os.path.abspath(self.cache_file))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmppath = tempfile.mkstemp(dir=directory, prefix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(saved, f)
+            os.replace(tmppath, self.cache_file)
+        except OSError as e:
+            self.logger.debug("Can't save tool probes: {}".format(e))
+
+    def probe(self, name, refresh=False):
+        """
+        Return what we know about a tool, probing it if necessary:
+        {'available': bool, 'version': str, 'features': dict, 'path': str}
+        """
+        executable, prober = PROBES[name]
+        path = shutil.which(executable) if executable else None
+        with self._lock:
+            if not refresh and name in self._results:
+                return self._results[name]
+
+            record = None
+            if not refresh:
+                saved = self._load().get(name)
+                if (
+                    saved and
+                    saved.get('path') == path and
+                    time.time() - saved.get('probed_at', 0) < self.ttl
+                ):
+                    record = saved
+            if record is None:
+                result = prober() if (path or not executable) else None
+                record = {
+                    'available': result is not None,
+                    'version': result['version'] if result else None,
+                    'features': result['features'] if result else {},
+                    'path': path,
+                    'probed_at': time.time(),
+                }
+                self._save(name, record)
+                self.logger.debug("Probed {}: {}".format(name, record))
+            self._results[name] = record
+            return record
+
+    def available(self, name):
+        return self.probe(name)['available']
+
+    def supports(self, name, feature):
+        """ True if the tool is available & has the given feature """
+        return bool(self.probe(name)['features'].get(feature))
+
+    def image_backend(self, forced=None):
+        """
+        Choose the image library: `forced` if given, otherwise the first
+        available of IMAGE_BACKENDS. Pillow is always the fallback. Raises
+        ValueError for a forced backend that's unknown or not available,
+        rather than failing on the first image.
+        """
+        if forced and forced != 'auto':
+            if forced not in IMAGE_BACKENDS:
+                raise ValueError(
+                    "Unknown image backend `{}`. Options: {}".format(
+                        forced, ', '.join(IMAGE_BACKENDS))
+                )
+            if not self.available(forced):
+                raise ValueError(
+                    "Image backend `{}` isn't available. Install it, or "
+                    "use `auto`".format(forced)
+                )
+            return forced
+        for backend in IMAGE_BACKENDS:
+            if self.available(backend):
+                return backend
+        return 'pillow'
+
+
+# The registry shared by everything in this process
+registry = ToolRegistry()
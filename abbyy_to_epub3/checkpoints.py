@@ -0,0 +1,171 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+
+class Checkpoints(object):
+    """
+    Saved conversion stages, in a persistent work directory, so that a
+    conversion which dies part way can resume from its last finished stage.
+
+    Each checkpoint records the SHA-256 of the input files its stage read,
+    and a fingerprint of everything else its output depends on (the code
+    version, config.ini & the conversion options). It is only used while
+    those all still match. An input whose size & modification time are as
+    they were when it was last hashed isn't hashed again, so checking a
+    checkpoint of a book with gigabytes of page images takes milliseconds.
+    A stage's state, if it has any, is pickled to
+    `<stage>.pickle`; stages whose output is files in the work directory
+    are checkpointed without state. Files are written atomically, & the
+    record of a checkpoint only after its state, so a crash while saving
+    leaves the previous checkpoint or none.
+    """
+
+    MANIFEST = 'checkpoints.json'
+    FILES = '_files'  # manifest entry remembering the inputs' checksums
+
+    def __init__(self, directory, fingerprint='', debug=False):
+        self.logger = logging.getLogger(__name__)
+        if debug:
+            self.logger.addHandler(logging.StreamHandler())
+            self.logger.setLevel(logging.DEBUG)
+
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # path: {'size', 'mtime_ns', 'sha256'} of each input last hashed
+        self.files = self._manifest().get(self.FILES, {})
+
+    @staticmethod
+    def make_fingerprint(*parts):
+        """ A fingerprint of the given strings. """
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(str(part).encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def checksum(self, path):
+        """ The SHA-256 of a file, hashed only if it may have changed """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self.files.get(path)
+        if (
+            known and known['size'] == stat.st_size and
+            known['mtime_ns'] == stat.st_mtime_ns
+        ):
+            return known['sha256']
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2 ** 20), b''):
+                digest.update(chunk)
+        self.files[path] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': digest.hexdigest(),
+        }
+        return digest.hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _manifest(self):
+        try:
+            with open(self._path(self.MANIFEST)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, name, data):
+        """ Replace a file in the checkpoint directory atomically. """
+        (fd, tmp) = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._path(name))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _record(self, inputs):
+        return {
+            'inputs': {
+                os.path.abspath(path): self.checksum(path) for path in inputs
+            },
+            'fingerprint': self.fingerprint,
+        }
+
+    def valid(self, stage, inputs):
+        """ True if stage has a checkpoint made from the inputs as they are """
+        entry = self._manifest().get(stage)
+        if entry is None:
+            return False
+        record = self._record(inputs)
+        return all(entry.get(key) == value for (key, value) in record.items())
+
+    def load(self, stage):
+        """ The state saved with a stage, or None if it saved none. """
+        if not self._manifest()[stage]['state']:
+            return None
+        with open(self._path('{}.pickle'.format(stage)), 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, stage, inputs, state=None):
+        """
+        Record that stage finished, having read the files in inputs. The
+        state, if not None, is saved to be handed back by `load`.
+        """
+        record = self._record(inputs)
+        if state is not None:
+            self._write(
+                '{}.pickle'.format(stage),
+                pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL),
+            )
+        record['state'] = state is not None
+        record['saved'] = time.time()
+        self._update(stage, record)
+        self.logger.debug("Checkpointed {}".format(stage))
+
+    def discard(self, stage):
+        """ Forget a stage's checkpoint. """
+        self._update(stage, None)
+
+    def _update(self, stage, record):
+        """ Set or, given None, remove a stage's manifest entry. """
+        # Stages finish on different threads
+        with self.lock:
+            manifest = self._manifest()
+            if record is None:
+                manifest.pop(stage, None)
+            else:
+                manifest[stage] = record
+            manifest[self.FILES] = dict(self.files)
+            self._write(
+                self.MANIFEST,
+                json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'),
+            )
@@ -18,12 +18,127 @@
 
 import argparse
 import logging
+import os
+import sys
 
-from abbyy_to_epub3.create_epub import Ebook
+from abbyy_to_epub3.configuration import load_config, profile_names
+from abbyy_to_epub3.constants import DEFAULT_ACE_LEVEL, DEFAULT_EPUBCHECK_LEVEL
 
 logger = logging.getLogger(__name__)
 
 
+def add_conversion_arguments(parser):
+    """ Arguments for how books are converted, shared by both commands. """
+    parser.add_argument(
+        '-d',
+        '--debug',
+        action='store_true',
+        help='Show debugging information',
+    )
+    parser.add_argument(
+        '--tmpdir',
+        default=None,
+        help='Specify custom path for tmp abbyy and jp2 files'
+    )
+    parser.add_argument(
+        '--workdir',
+        default=None,
+        metavar='DIR',
+        help='Keep intermediate files & checkpoints in DIR, so that a '
+        'conversion which dies part way resumes when rerun',
+    )
+    parser.add_argument(
+        '--epubcheck',
+        nargs='?',
+        const=DEFAULT_EPUBCHECK_LEVEL,
+        help='Run EpubCheck on the newly created EPUB. '
+        'Options: `warning` & worse (default), `error` & worse, `fatal` only',
+    )
+    parser.add_argument(
+        '--ace',
+        nargs='?',
+        const=DEFAULT_ACE_LEVEL,
+        help='Run DAISY Ace on the newly created EPUB. '
+        'Options: `critical` & worse, `serious` & worse, '
+        '`moderate` & worse, `minor` (default)',
+    )
+    parser.add_argument(
+        '--image-profile',
+        choices=profile_names(load_config()),
+        default=None,
+        help='How to encode images: sizes, formats & byte budgets, '
+        'as defined in config.ini. Options: %(choices)s',
+    )
+    parser.add_argument(
+        '--image-cache',
+        default=None,
+        help='Directory of the image cache shared between runs. '
+        'Overrides CACHE_DIR in config.ini',
+    )
+    parser.add_argument(
+        '--image-backend',
+        choices=['auto', 'kakadu', 'pillow'],
+        default=None,
+        help='Image library to use. Default `auto` uses Kakadu if it is '
+        'installed, otherwise Pillow',
+    )
+    parser.add_argument(
+        '--workspace',
+        choices=['auto', 'disk', 'tmpfs', 'memory'],
+        default=None,
+        help='Where to unpack the inputs: on disk under --tmpdir, on tmpfs, '
+        'or nowhere, reading them as needed. `auto` is tmpfs if that fits '
+        'the memory budget, else disk. Overrides BACKING in config.ini',
+    )
+    parser.add_argument(
+        '--scratch-quota',
+        type=int,
+        default=None,
+        metavar='MB',
+        help='Fail a conversion which unpacks more than this many MB. '
+        'Overrides QUOTA in config.ini',
+    )
+    parser.add_argument(
+        '--reproducible',
+        action='store_true',
+        default=None,
+        help='Write the same EPUB bytes for the same inputs, with their '
+        'SHA-256 beside the EPUB, as EPUB.sha256. Overrides REPRODUCIBLE '
+        'in config.ini',
+    )
+    parser.add_argument(
+        '--memory',
+        action='store_true',
+        help='Track the peak memory of each stage, and print it',
+    )
+    parser.add_argument(
+        '--memory-budget',
+        type=int,
+        default=None,
+        metavar='MB',
+        help='Exit with an error if peak memory goes over this many MB. '
+        'The conversion is planned to stay within it, from the sizes of '
+        'the inputs. Overrides MEMORY_BUDGET in config.ini',
+    )
+
+
+def ebook_options(args):
+    """ Ebook keyword arguments from the shared conversion arguments. """
+    return {
+        'debug': args.debug,
+        'epubcheck': args.epubcheck,
+        'ace': args.ace,
+        'image_profile': args.image_profile,
+        'image_cache': args.image_cache,
+        'image_backend': args.image_backend,
+        'memory': args.memory,
+        'memory_budget': args.memory_budget,
+        'workspace': args.workspace,
+        'scratch_quota': args.scratch_quota,
+        'reproducible': args.reproducible,
+    }
+
+
 def main():
     parser = argparse.ArgumentParser(
         description=(
@@ -32,12 +147,6 @@ def main():
             "for details."
         )
     )
-    parser.add_argument(
-        '-d',
-        '--debug',
-        action='store_true',
-        help='Show debugging information',
-    )
     parser.add_argument(
         'item_dir', help="The file path where this item\'s files are kept.",
     )
@@ -45,7 +154,7 @@ def main():
         'item_identifier', help="The unique ID of this item.",
     )
     parser.add_argument(
-        'item_bookpath', help=(
+        'item_bookpath', nargs='?', help=(
             "The prefix to a specific book within an item."
             "In a simple book, usually the same as the item_identifier."
         ),
@@ -54,31 +163,71 @@ def main():
         '-o',
         '--out',
         default=None,
-        help='Output path for epub',
+        help='Output path for epub; with --all-books, the directory for '
+        'the EPUBs',
     )
     parser.add_argument(
-        '--tmpdir',
+        '--all-books',
+        action='store_true',
+        help='Convert every book in item_dir at once, each to an EPUB '
+        'named for its bookpath, printing a JSON line per book',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
         default=None,
-        help='Specify custom path for tmp abbyy and jp2 files'
+        help='With --all-books, books converted at once. '
+        'Overrides BATCH_WORKERS in config.ini',
     )
+    add_conversion_arguments(parser)
     parser.add_argument(
-        '--epubcheck',
-        nargs='?',
-        const=Ebook.DEFAULT_EPUBCHECK_LEVEL,
-        help='Run EpubCheck on the newly created EPUB. '
-        'Options: `warning` & worse (default), `error` & worse, `fatal` only',
+        '--thumbnail',
+        default=None,
+        help='Also save a cover thumbnail to this path',
     )
     parser.add_argument(
-        '--ace',
-        nargs='?',
-        const=Ebook.DEFAULT_ACE_LEVEL,
-        help='Run DAISY Ace on the newly created EPUB. '
-        'Options: `critical` & worse, `serious` & worse, '
-        '`moderate` & worse, `minor` (default)',
+        '--report',
+        default=None,
+        help='Save per-stage timings & counters to this path, as JSON',
+    )
+    parser.add_argument(
+        '--trace',
+        default=None,
+        help='Save per-stage timings to this path as a Chrome trace-event '
+        'file, for chrome://tracing or Perfetto',
+    )
+    parser.add_argument(
+        '--profile',
+        default=None,
+        metavar='DIR',
+        help='Save cProfile stats for each stage to DIR, as <stage>.prof',
+    )
+    parser.add_argument(
+        '--tracemalloc',
+        type=int,
+        default=0,
+        metavar='N',
+        help='Also list the N largest allocations at the end of each stage, '
+        'in the --report. Slow',
     )
     args = parser.parse_args()
+    if args.all_books:
+        if args.item_bookpath:
+            parser.error("--all-books converts every bookpath; give none")
+        for option in ('thumbnail', 'report', 'trace', 'profile'):
+            if getattr(args, option):
+                parser.error(
+                    "--{} can't be used with --all-books".format(option))
+        all_books(args)
+        return
+    if not args.item_bookpath:
+        parser.error("item_bookpath is required, unless --all-books")
 
     if args is not None:
+        # Imported here, so that --help & argument errors don't wait for
+        # the conversion's dependencies to load
+        from abbyy_to_epub3.create_epub import ERR_MEMORY_BUDGET, Ebook
+
         debug = args.debug
         if debug:
             logger.addHandler(logging.StreamHandler())
@@ -87,13 +236,248 @@ def main():
             args.item_dir,
             args.item_identifier,
             args.item_bookpath,
-            debug=debug,
-            epubcheck=args.epubcheck,
-            ace=args.ace,
+            profile_dir=args.profile,
+            tracemalloc_top=args.tracemalloc,
+            **ebook_options(args)
         )
         book.craft_epub(
-            epub_outfile=args.out or 'out.epub', tmpdir=args.tmpdir
+            epub_outfile=args.out or 'out.epub', tmpdir=args.tmpdir,
+            workdir=args.workdir, thumbnail_outfile=args.thumbnail,
+            report_outfile=args.report, trace_outfile=args.trace,
+        )
+        if book.memory:
+            if args.memory:
+                print(book.memory.summary(), file=sys.stderr)
+            if book.memory.over_budget():
+                sys.exit(ERR_MEMORY_BUDGET)
+
+
+def all_books(args):
+    """
+    Convert all of an item's books on a pool of workers, as
+    abbyy2epub-batch would, & exit with status 1 if any failed.
+    """
+    from abbyy_to_epub3.batch import item_books, run_batch
+
+    if args.debug:
+        logging.getLogger('abbyy_to_epub3.batch').addHandler(
+            logging.StreamHandler())
+        logging.getLogger('abbyy_to_epub3.batch').setLevel(logging.DEBUG)
+    jobs = item_books(args.item_dir, args.item_identifier)
+    config = load_config()
+    workers = args.workers
+    if workers is None:
+        workers = config.getint('Main', 'BATCH_WORKERS')
+    statuses = run_batch(
+        jobs, sys.stdout, out_dir=args.out or '.', tmpdir=args.tmpdir,
+        workers=workers,
+        books_per_worker=config.getint('Main', 'BATCH_BOOKS_PER_WORKER'),
+        options=ebook_options(args), workdir=args.workdir,
+        book_timeout=config.getint('Main', 'BATCH_BOOK_TIMEOUT'),
+    )
+    print("{} books: {}".format(len(jobs), ', '.join(
+        '{} {}'.format(count, status)
+        for (status, count) in sorted(statuses.items())
+    )), file=sys.stderr)
+    if statuses['failed']:
+        sys.exit(1)
+
+
+def batch_main():
+    parser = argparse.ArgumentParser(
+        description=(
+            'Process many ABBYY files into EPUBs, on a pool of workers.\n'
+            "See README at https://github.com/deborahgu/abbyy-to-epub3 "
+            "for details."
+        )
+    )
+    parser.add_argument(
+        'sources', nargs='+', metavar='manifest_or_dir',
+        help='A manifest of books, as CSV or JSON Lines (.jsonl) with the '
+        'fields item_dir, item_identifier, item_bookpath & optionally out; '
+        'or a directory to search for items',
+    )
+    parser.add_argument(
+        '-o',
+        '--out-dir',
+        default='.',
+        help='Directory for EPUBs without an `out` in the manifest',
+    )
+    parser.add_argument(
+        '--results',
+        default=None,
+        help='Append a JSON line per book, with its status & timings, to '
+        'this path instead of printing it',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='Books converted at once. Overrides BATCH_WORKERS in config.ini',
+    )
+    parser.add_argument(
+        '--books-per-worker',
+        type=int,
+        default=None,
+        metavar='N',
+        help='Replace each worker process after N books. '
+        'Overrides BATCH_BOOKS_PER_WORKER in config.ini',
+    )
+    parser.add_argument(
+        '--scratch-limit',
+        type=int,
+        default=None,
+        metavar='MB',
+        help='Most scratch space the books converted at once may unpack '
+        'together; a book waits until it fits. '
+        'Overrides BATCH_SCRATCH_LIMIT in config.ini',
+    )
+    add_conversion_arguments(parser)
+    args = parser.parse_args()
+
+    if args is not None:
+        from abbyy_to_epub3.batch import read_manifest, run_batch, scan_items
+
+        if args.debug:
+            logging.getLogger('abbyy_to_epub3.batch').addHandler(
+                logging.StreamHandler())
+            logging.getLogger('abbyy_to_epub3.batch').setLevel(logging.DEBUG)
+        jobs = []
+        for source in args.sources:
+            if os.path.isdir(source):
+                jobs.extend(scan_items(source))
+            else:
+                jobs.extend(read_manifest(source))
+
+        config = load_config()
+        workers = args.workers
+        if workers is None:
+            workers = config.getint('Main', 'BATCH_WORKERS')
+        books_per_worker = args.books_per_worker
+        if books_per_worker is None:
+            books_per_worker = config.getint('Main', 'BATCH_BOOKS_PER_WORKER')
+        scratch_limit = args.scratch_limit
+        if scratch_limit is None:
+            scratch_limit = config.getint('Main', 'BATCH_SCRATCH_LIMIT')
+
+        results_file = open(args.results, 'a') if args.results else sys.stdout
+        try:
+            statuses = run_batch(
+                jobs, results_file, out_dir=args.out_dir, tmpdir=args.tmpdir,
+                workers=workers, books_per_worker=books_per_worker,
+                options=ebook_options(args), workdir=args.workdir,
+                scratch_limit=scratch_limit * 2 ** 20,
+                book_timeout=config.getint('Main', 'BATCH_BOOK_TIMEOUT'),
+            )
+        finally:
+            if args.results:
+                results_file.close()
+        print("{} books: {}".format(len(jobs), ', '.join(
+            '{} {}'.format(count, status)
+            for (status, count) in sorted(statuses.items())
+        )), file=sys.stderr)
+        if statuses['failed']:
+            sys.exit(1)
+
+
+def service_main():
+    parser = argparse.ArgumentParser(
+        description=(
+            'Serve EPUB conversions over HTTP, from warm worker processes.\n'
+            "See README at https://github.com/deborahgu/abbyy-to-epub3 "
+            "for details."
+        )
+    )
+    parser.add_argument(
+        '--host',
+        default=None,
+        help='Address to listen on. Overrides HOST in config.ini',
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=None,
+        help='Port to listen on. Overrides PORT in config.ini',
+    )
+    parser.add_argument(
+        '--socket',
+        default=None,
+        metavar='PATH',
+        help='Listen on this Unix socket instead of a port',
+    )
+    parser.add_argument(
+        '-o',
+        '--out-dir',
+        default='.',
+        help='Directory for the EPUBs, named for their bookpath',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='Books converted at once. Overrides WORKERS in config.ini',
+    )
+    parser.add_argument(
+        '--books-per-worker',
+        type=int,
+        default=None,
+        metavar='N',
+        help='Replace each worker process after N books. '
+        'Overrides BOOKS_PER_WORKER in config.ini',
+    )
+    parser.add_argument(
+        '--queue-size',
+        type=int,
+        default=None,
+        help='Most books waiting or being converted. '
+        'Overrides QUEUE_SIZE in config.ini',
+    )
+    add_conversion_arguments(parser)
+    args = parser.parse_args()
+
+    if args is not None:
+        from abbyy_to_epub3.service import ConversionService, make_server
+
+        config = load_config()
+
+        def setting(value, name, get=config.getint):
+            return get('Service', name) if value is None else value
+
+        if args.debug:
+            logging.getLogger('abbyy_to_epub3.service').addHandler(
+                logging.StreamHandler())
+            logging.getLogger('abbyy_to_epub3.service').setLevel(
+                logging.DEBUG)
+        service = ConversionService(
+            out_dir=args.out_dir,
+            tmpdir=args.tmpdir,
+            workers=setting(args.workers, 'WORKERS'),
+            books_per_worker=setting(
+                args.books_per_worker, 'BOOKS_PER_WORKER'),
+            queue_size=setting(args.queue_size, 'QUEUE_SIZE'),
+            options=ebook_options(args),
+            debug=args.debug,
+            workdir=args.workdir,
+            book_timeout=config.getint('Service', 'BOOK_TIMEOUT'),
+        )
+        service.start()
+        server = make_server(
+            service,
+            host=setting(args.host, 'HOST', get=config.get),
+            port=setting(args.port, 'PORT'),
+            socket_path=args.socket,
+            timeout=config.getfloat('Service', 'REQUEST_TIMEOUT'),
         )
+        print("Serving on {}".format(
+            args.socket or 'http://{}:{}'.format(*server.server_address)
+        ), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            service.close()
 
 
 if __name__ == "__main__":
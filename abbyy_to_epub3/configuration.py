@@ -0,0 +1,50 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import configparser
+import os
+
+CONFIG_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'config.ini'
+)
+PROFILE_PREFIX = 'Profile:'
+
+_config = None
+
+
+def load_config():
+    """
+    The settings in config.ini, read on first use & shared from then on.
+    The file is found next to this module, which is much quicker than
+    asking pkg_resources.
+    """
+    global _config
+    if _config is None:
+        config = configparser.ConfigParser()
+        config.read(CONFIG_FILE)
+        _config = config
+    return _config
+
+
+def profile_names(config):
+    """ The names of the output profiles defined in the configuration. """
+    return [
+        section[len(PROFILE_PREFIX):] for section in config.sections()
+        if section.startswith(PROFILE_PREFIX)
+    ]
@@ -26,6 +26,10 @@ OLD_NSM = {
     'a': OLD_NS,
 }
 
+# Lowest severity reported by the validators when they're run without one
+DEFAULT_EPUBCHECK_LEVEL = 'warning'
+DEFAULT_ACE_LEVEL = 'minor'
+
 # Some page types should always be skipped
 # Instead of complicating the data structure and adding extra logic
 # on each block, just use a custom pagetype for anything where
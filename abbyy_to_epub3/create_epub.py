@@ -16,39 +16,102 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import OrderedDict
+from collections import Counter, OrderedDict
 from ebooklib import epub
 from ebooklib import utils as ebooklib_utils
 from fuzzywuzzy import fuzz
+from lxml import etree
 from numeral import roman2int
-from pkg_resources import resource_filename
+from PIL import Image
 
 from zipfile import BadZipFile, ZipFile
 
-import configparser
+import contextlib
+import copy
 import gzip
 import logging
 import os
 import sys
 import re
-import subprocess
-import tempfile
 
 from abbyy_to_epub3 import __version__
-from abbyy_to_epub3.constants import skippable_pages
+from abbyy_to_epub3.capabilities import registry as tools
+from abbyy_to_epub3.checkpoints import Checkpoints
+from abbyy_to_epub3.configuration import load_config, profile_names
+from abbyy_to_epub3.constants import (
+    DEFAULT_ACE_LEVEL, DEFAULT_EPUBCHECK_LEVEL,
+)
+from abbyy_to_epub3.geometry import BoxIndex, NoiseFilter, block_box
 from abbyy_to_epub3.parse_abbyy import AbbyyParser
+from abbyy_to_epub3.image_cache import ImageCache
+from abbyy_to_epub3.image_output import (
+    DuplicateIndex, OutputProfile, encode_image,
+)
 from abbyy_to_epub3.image_processing import factory as ImageFactory
-from abbyy_to_epub3.parse_scandata import ScandataParser
+from abbyy_to_epub3.image_processing import jp2_size
+from abbyy_to_epub3.instrumentation import Instrumentation
+from abbyy_to_epub3.memory import MemoryPlan, MemoryProbe
+from abbyy_to_epub3.parse_scandata import PageTable, ScandataParser
+from abbyy_to_epub3.reproducible import (
+    ReproducibleEpubWriter, content_hash, source_date, write_hash_file,
+)
+from abbyy_to_epub3.stages import StageScheduler
 from abbyy_to_epub3.utils import dirtify_xml, is_increasing
 from abbyy_to_epub3.verify_epub import EpubVerify
+from abbyy_to_epub3.workspace import (
+    Workspace, gzip_size, scratch_estimate,
+)
 
 
 # Set up configuration
-config = configparser.ConfigParser()
-configfile = resource_filename("abbyy_to_epub3", "config.ini")
-config.read(configfile)
+config = load_config()
 
 ERR_MISSING_SCANDATA = 3
+ERR_MEMORY_BUDGET = 4
+
+
+def read_item_metadata(meta_xml, debug=False):
+    """
+    The metadata in an item's `_meta.xml`, which all of its books share,
+    so it can be read once for them all & given to each Ebook.
+    """
+    meta = {}
+    parser = AbbyyParser('', meta_xml, meta, {}, [], debug=debug)
+    parser.parse_metadata()
+    meta.pop('PAGES_SUPPORT')  # the ABBYY's business
+    return meta
+
+
+class SpilledImage(epub.EpubImage):
+    """
+    An EpubImage whose content waits in a file until the EPUB is written,
+    rather than in memory.
+    """
+
+    def __init__(self, path):
+        super(SpilledImage, self).__init__()
+        self.path = path
+
+    def get_content(self, default=b''):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+
+def choose_image_backend(image_backend=None):
+    """
+    The image processing library to use: `image_backend` if given, else
+    BACKEND from config.ini. Tools are probed once per process, or once per
+    PROBE_TTL if PROBE_CACHE is set.
+    """
+    if config.get('Tools', 'PROBE_CACHE'):
+        tools.persist_to(
+            config.get('Tools', 'PROBE_CACHE'),
+            ttl=config.getint('Tools', 'PROBE_TTL'),
+        )
+    return tools.image_backend(
+        image_backend or config.get('Images', 'BACKEND')
+    )
+
 
 class ArchiveBookItem(object):
     """Archive.org is a website which contains an archive of items
@@ -120,12 +183,22 @@ class Ebook(ArchiveBookItem):
     Ebook is a utility for generating epub3 files based on Archive.org items.
     Holds extracted information about a book & the ebooklib EPUB object.
     """
-    DEFAULT_EPUBCHECK_LEVEL = 'warning'
-    DEFAULT_ACE_LEVEL = 'minor'
+    DEFAULT_EPUBCHECK_LEVEL = DEFAULT_EPUBCHECK_LEVEL
+    DEFAULT_ACE_LEVEL = DEFAULT_ACE_LEVEL
+    # what craft_html makes, saved in its checkpoint
+    HTML_STATE = [
+        'book', 'chapters', 'chapter_no', 'picnum', 'image_bytes',
+        'images_made', 'headers_present', 'pagenums_found',
+        'rpagenums_found', 'title_page', 'thumbnail',
+    ]
 
     def __init__(
             self, item_dir, item_identifier, item_bookpath,
-            debug=False, epubcheck=None, ace=None,
+            debug=False, epubcheck=None, ace=None, image_profile=None,
+            image_cache=None, image_backend=None, profile_dir=None,
+            memory=False, tracemalloc_top=0, memory_budget=None,
+            workspace=None, scratch_quota=None, item_metadata=None,
+            reproducible=None,
     ):
 
         self.logger = logging.getLogger(__name__)
@@ -144,17 +217,85 @@ class Ebook(ArchiveBookItem):
             # --ace minor
             self.DEFAULT_ACE_LEVEL if self.debug else None)
         self.metadata = {}     # the book's metadata
+        # the item's metadata, if read already for another of its books
+        self.item_metadata = item_metadata
         self.blocks = []       # all <blocks> with contents, attributes
         self.paragraphs = {}   # paragraph style info
 
-        self.tmpdir = ''       # stores converted images & extracted zip files
+        self.tmpdir = ''       # the workspace's directory
+        # where the inputs are unpacked, & how much of them may be (in MB)
+        self.workspace_backing = workspace or config.get(
+            'Workspace', 'BACKING')
+        if scratch_quota is None:
+            scratch_quota = config.getint('Workspace', 'QUOTA')
+        self.scratch_quota = scratch_quota * 2 ** 20
+        self.workspace = None  # the Workspace, while converting
+        # encoded images wait in the workspace, to save memory
+        self.spill_images = False
+        self.thumbnail = None  # small cover image, made with the cover
+        # the same inputs make the same EPUB bytes, with their hash beside it
+        if reproducible is None:
+            reproducible = config.getboolean('Main', 'REPRODUCIBLE')
+        self.reproducible = reproducible
+        self.content_hash = None  # SHA-256 of the EPUB, once it's written
         self.abbyy_file = ''   # the ABBYY XML file
         self.chapters = []     # holds each of the chapter (EpubHtml) objects
         self.progression = ''  # page direction
         self.firsts = {}       # all first lines per-page
         self.lasts = {}        # all last lines per-page
-        self.pages = OrderedDict()    # page-by-page information from scandata
+        self.pages = PageTable()    # page-by-page information from scandata
         self.chapter_no = 0    # current number of identified chapters
+        self.image_profile = OutputProfile.from_config(
+            config, image_profile or config.get('Images', 'DEFAULT_PROFILE')
+        )                      # how images are encoded
+        self.image_bytes = 0   # bytes of all encoded images so far
+        self.images_made = 0   # number of images encoded so far
+        self.images_expected = 0  # images still to come, for book budgets
+        # images already in the book, to point repeats at the stored item
+        self.stored_images = DuplicateIndex(
+            config.getint('Images', 'DEDUP_TOLERANCE')
+        )
+        self.stats = Counter()  # counts of what happened in the conversion
+        self.stage_timings = {}  # craft_epub stage name: (start, end) seconds
+        # per-stage memory peaks, if asked for or there's a budget (in MB)
+        if memory_budget is None:
+            memory_budget = config.getint('Main', 'MEMORY_BUDGET')
+        if memory or tracemalloc_top or memory_budget:
+            self.memory = MemoryProbe(
+                interval=config.getfloat('Main', 'MEMORY_SAMPLE_INTERVAL'),
+                tracemalloc_top=tracemalloc_top,
+                budget=memory_budget * 2 ** 20,
+                debug=debug,
+            )
+        else:
+            self.memory = None
+        # per-stage timings & counters; cProfile stats too, with profile_dir
+        self.instrumentation = Instrumentation(
+            counters=self.stats, profile_dir=profile_dir, memory=self.memory,
+        )
+        self.images_extracted = False  # all page images are in tmpdir
+        self.checkpoints = None  # finished stages, if given a workdir
+        # pictures closer than this are fragments of one figure
+        self.merge_gap = config.getint('Images', 'MERGE_GAP')
+        # rejects specks & stray marks which ABBYY calls pictures
+        self.noise_filter = NoiseFilter(
+            min_area=config.getfloat('Images', 'NOISE_MIN_AREA'),
+            max_aspect=config.getfloat('Images', 'NOISE_MAX_ASPECT'),
+            margin=config.getfloat('Images', 'NOISE_MARGIN'),
+            max_text_overlap=config.getfloat(
+                'Images', 'NOISE_MAX_TEXT_OVERLAP'
+            ),
+        )
+        # persistent cache of encoded images, shared across runs
+        image_cache = image_cache or config.get('Images', 'CACHE_DIR')
+        if image_cache:
+            self.image_cache = ImageCache(
+                image_cache,
+                max_bytes=config.getint('Images', 'CACHE_MAX_BYTES'),
+                debug=debug,
+            )
+        else:
+            self.image_cache = None
 
         # are there headers, footers, or page numbers?
         self.headers_present = False
@@ -170,29 +311,77 @@ class Ebook(ArchiveBookItem):
         self.book.reset()
         self.verifier = EpubVerify(self.debug)
 
-        # Choose the image processing library
-        try:
-            subprocess.run(
-                ["kdu_compress", "-v"], stdout=subprocess.DEVNULL, check=True
-            )
-            self.image_processor = "kakadu"
-        except (FileNotFoundError, subprocess.CalledProcessError) as e:
-            self.image_processor = "pillow"
+        self.image_processor = choose_image_backend(image_backend)
         self.logger.debug("Image processing with {}.".format(self.image_processor))
 
         super(Ebook, self).__init__(item_dir, item_identifier, item_bookpath)
 
+    @classmethod
+    def image_profiles(cls):
+        """ Names of the image output profiles in config.ini """
+        return profile_names(config)
+
+    def body_inputs(self):
+        """ The item's files the book's HTML is made from, besides meta.xml """
+        return [self.abbyy_gz, self.scandata_xml, self.jp2_zip]
+
+    @staticmethod
+    def require(condition):
+        """ Refuse a checkpoint whose files aren't all there. """
+        if not condition:
+            raise RuntimeError("Checkpointed files are missing")
+
+    def resume(self, stage, inputs, restore=None):
+        """
+        Resume a stage from its checkpoint, if there's a workdir holding one
+        made from the inputs as they are now. `restore` is given the state
+        saved with it. Returns True if the stage was resumed, False if it
+        needs running. A checkpoint which can't be restored is discarded.
+        """
+        if not self.checkpoints or not self.checkpoints.valid(stage, inputs):
+            return False
+        try:
+            state = self.checkpoints.load(stage)
+            if restore:
+                restore(state)
+        except Exception as e:
+            self.logger.warning(
+                "Can't resume {} from its checkpoint: {}".format(stage, e)
+            )
+            self.checkpoints.discard(stage)
+            return False
+        self.logger.debug("Resumed {} from its checkpoint".format(stage))
+        self.instrumentation.count('stages_resumed')
+        return True
+
+    def checkpoint(self, stage, inputs, state=None):
+        """ Save a finished stage's checkpoint, if there's a workdir. """
+        if self.checkpoints:
+            with self.instrumentation.span(stage, 'checkpoint'):
+                self.checkpoints.save(stage, inputs, state)
+
     def load_scandata_pages(self):
         """
         Parse the page-by-page scandata file. This stores page size,
         right or left leaf, and page type (eg copyright, color card, etc).
         """
-        parser = ScandataParser(
-            self.scandata_xml,
-            self.pages,
-            debug=self.debug,
-        )
-        parser.parse_scandata()
+        if self.resume('scandata', [self.scandata_xml], self.restore_pages):
+            return
+        # the memory estimate may have read it already
+        if not self.pages:
+            self.read_scandata()
+        self.checkpoint('scandata', [self.scandata_xml], self.pages)
+
+    def read_scandata(self):
+        """ Read the scandata file into the page table """
+        parser = ScandataParser(self.scandata_xml, debug=self.debug)
+        self.pages = parser.parse_scandata()
+
+    def restore_pages(self, pages):
+        """ Restore the page table saved with a scandata checkpoint """
+        if not isinstance(pages, PageTable):
+            raise TypeError("The checkpoint holds no page table")
+        self.pages = pages
 
     def create_accessibility_metadata(self):
         """ Set up accessibility metadata """
@@ -305,13 +494,21 @@ class Ebook(ArchiveBookItem):
         Extracts all of the images for the text.
 
         For efficiency's sake, do these all at once. Memory & CPU will be at a
-        higher premium than disk space, so unzip the entire scan file into temp
-        directory, instead of extracting only the needed images.
+        higher premium than disk space, so unzip the entire scan file into the
+        workspace, instead of extracting only the needed images. A `memory`
+        workspace skips this stage, & reads each page as it's needed.
         """
-        # extract jp2 images into tmpdir
+        if self.resume(
+            'images', [self.jp2_zip],
+            lambda state: self.require(self.images_are_extracted()),
+        ):
+            self.images_extracted = True
+            return
+        # extract jp2 images into the workspace
         try:
-            with ZipFile(self.jp2_zip) as f:
-                f.extractall(self.tmpdir)
+            self.workspace.extract_all(self.jp2_zip)
+            self.images_extracted = True
+            self.checkpoint('images', [self.jp2_zip])
         except BadZipFile as e:
             self.logger.error(
                 "extraction problem with {}".format(self.jp2_zip)
@@ -325,61 +522,168 @@ class Ebook(ArchiveBookItem):
         self.logger.debug(extracted_dir)
         return os.path.exists(extracted_dir)
 
+    def image_factory(self):
+        """
+        Create an image processor for the chosen library, with the decode
+        limits from config.ini.
+        """
+        num_threads = config.getint('Images', 'DECODE_THREADS') or None
+        if not tools.supports(self.image_processor, 'num_threads'):
+            num_threads = None
+        return ImageFactory(
+            self.image_processor,
+            num_threads=num_threads,
+            timeout=config.getint('Images', 'DECODE_TIMEOUT'),
+            max_decodes=(
+                config.getint('Images', 'MAX_CONCURRENT_DECODES') or None
+            ),
+        )
+
+    def image_budget(self):
+        """
+        The byte budget for the next image: the profile's per-image budget,
+        or an even share of what is left of the book budget, if smaller.
+        None means no limit.
+        """
+        budget = self.image_profile.image_budget
+        if self.image_profile.book_budget:
+            remaining = self.image_profile.book_budget - self.image_bytes
+            still_to_make = max(self.images_expected - self.images_made, 1)
+            share = max(remaining // still_to_make, 1)
+            budget = min(budget, share) if budget else share
+        return budget
+
+    def render_image(self, jp2, **decode_args):
+        """
+        Decode an image from a JP2 & encode it under the book's output
+        profile, or fetch the result from the image cache. Takes the
+        image processor's `decode` arguments. Raises RuntimeError if the
+        image can't be decoded.
+        """
+        budget = self.image_budget()
+        encoded = None
+        if self.image_cache:
+            key = self.image_cache.key(
+                jp2, self.image_processor, self.image_profile, budget,
+                **decode_args
+            )
+            encoded = self.image_cache.get(key)
+        if encoded is None:
+            with self.instrumentation.span('crop', 'image'):
+                im = self.image_factory().decode(jp2, **decode_args)
+                encoded = encode_image(im, self.image_profile, budget)
+            self.instrumentation.count('images_decoded')
+            if self.image_cache:
+                self.image_cache.put(key, encoded)
+        self.image_bytes += len(encoded.data)
+        self.images_made += 1
+        return encoded
+
     def get_cover_leaf(self):
         """
         Try to find a cover image. If nothing is tagged as 'Cover', use
         the first page tagged 'Title'. If nothing is tagged as
         'Title', either, use the first page tagged
-        'Normal'. Self.pages is an OrderedDict so break as soon as you
-        find something useful, and don't search the whole set of
-        pages.
-        """
-        pages_iter = iter(self.pages)
-        for p in pages_iter:
-            if self.pages[p] == 'cover':
-                cover_leaf = p
-                break
-            elif self.pages[p] == 'title':
-                cover_leaf = p
-                break
-            elif self.pages[p] == 'normal':
-                cover_leaf = p
-                break
-        try:
-            return cover_leaf
-        except NameError:
+        'Normal'. The page table finds it without looking at the pages one
+        by one.
+        """
+        cover_leaf = self.pages.cover_leaf()
+        if cover_leaf is None:
             e = "No pages in scandata marked as Cover, Title, or Normal"
             self.logger.error(e)
             raise RuntimeError(e)
+        return cover_leaf
 
-    def extract_cover(self):
+    def leaf_member(self, leaf):
+        """ The name of a leaf's JP2 in the zip of page images """
+        # pad out the filename to four digits
+        return "{item_bookpath}_jp2/{item_bookpath}_{num:0>4}.jp2".format(
+            item_bookpath=self.item_bookpath, num=leaf)
+
+    def cover_leaf_file(self):
         """
-        http://web.archive.org/web/20180416230000/https://www.safaribooksonline.com/blog/2009/11/20/best-practices-in-epub-cover-images/
+        The path to the cover leaf's JP2. If the page images haven't been
+        extracted, only the cover leaf is read from the zip, into its own
+        directory so it can't collide with a concurrent `extract_images`.
         """
-        if not self.images_are_extracted():
+        member = self.leaf_member(self.get_cover_leaf())
+        if self.images_extracted:
+            return os.path.join(self.tmpdir, member)
+        try:
+            return self.workspace.extract(self.jp2_zip, member, 'cover')
+        except (BadZipFile, KeyError) as e:
             raise RuntimeError(
-                'extract_covers cannot be run before extract_images'
+                "Can't read cover leaf {} from {}: {}".format(
+                    member, self.jp2_zip, e)
             )
 
-        # pad out the filename to four digits
-        cover_jp2 = "{tmp}/{item_bookpath}_jp2/{item_bookpath}_{num:0>4}.jp2".format(
-            tmp=self.tmpdir, item_bookpath=self.item_bookpath, num=self.get_cover_leaf())
-        cover_png = '{}/cover.png'.format(self.tmpdir)
-        self.logger.debug("jp2: %s & png: %s" % (
-            cover_jp2, cover_png))
+    def render_cover(self, cover_jp2):
+        """
+        Make the cover, & the thumbnail if one is configured, from a single
+        reduced-resolution decode of the cover leaf. Both keep the leaf's
+        aspect ratio. Returns (cover, thumbnail) EncodedImages; thumbnail is
+        None unless THUMBNAIL_WIDTH is set.
+        """
+        cover_box = (
+            config.getint('Images', 'COVER_WIDTH'),
+            config.getint('Images', 'COVER_HEIGHT'),
+        )
+        thumb_box = (
+            config.getint('Images', 'THUMBNAIL_WIDTH'),
+            config.getint('Images', 'THUMBNAIL_HEIGHT'),
+        )
+        wanted = OrderedDict([('cover', cover_box)])
+        if all(thumb_box):
+            wanted['thumbnail'] = thumb_box
+        budget = self.image_budget()
+
+        rendered = {}
+        keys = {}
+        if self.image_cache:
+            for name, box in wanted.items():
+                keys[name] = self.image_cache.key(
+                    cover_jp2, self.image_processor, self.image_profile,
+                    budget, fit=box,
+                )
+                rendered[name] = self.image_cache.get(keys[name])
+        if not all(rendered.get(name) for name in wanted):
+            decoded = self.image_factory().decode_to_fit(cover_jp2, cover_box)
+            for name, box in wanted.items():
+                # each is made from the decoded leaf, never from another
+                im = decoded
+                if box != cover_box:
+                    im = decoded.copy()
+                    im.thumbnail(box, Image.LANCZOS)
+                rendered[name] = encode_image(im, self.image_profile, budget)
+                if self.image_cache:
+                    self.image_cache.put(keys[name], rendered[name])
+
+        # Only the cover goes in the EPUB
+        self.image_bytes += len(rendered['cover'].data)
+        self.images_made += 1
+        return rendered['cover'], rendered.get('thumbnail')
+
+    def extract_cover(self):
+        """
+        http://web.archive.org/web/20180416230000/https://www.safaribooksonline.com/blog/2009/11/20/best-practices-in-epub-cover-images/
+
+        Needs only the scandata & the cover leaf, so it doesn't have to wait
+        for `extract_images`, & can run while the ABBYY is parsed.
+        """
+        cover_jp2 = self.cover_leaf_file()
+        self.logger.debug("cover jp2: %s" % cover_jp2)
 
         # convert the JP2K file into a usable format for the cover
-        imageobj = ImageFactory(self.image_processor)
         try:
-            imageobj.crop_image(
-                cover_jp2, cover_png, resize=(800, 1200)
-            )
+            cover, self.thumbnail = self.render_cover(cover_jp2)
         except RuntimeError as e:
             # for failed image creation, keep processing the epub
             self.logger.error(e)
+            return
 
         self.book.set_cover(
-            'images/cover.png', open(cover_png, 'rb').read())
+            'images/cover.{}'.format(cover.extension), cover.data)
+        self.book.get_item_with_id('cover-img').media_type = cover.media_type
         cover = self.book.items[-1]
         self.logger.debug(cover)
         cover.add_link(
@@ -391,12 +695,76 @@ class Ebook(ArchiveBookItem):
         a tuple of its dimensions:
         (left, top, right, bottom)
         """
-        left = int(block['style']['l'])
-        top = int(block['style']['t'])
-        right = int(block['style']['r'])
-        bottom = int(block['style']['b'])
+        return block_box(block)
+
+    def is_enclosed_image(self, block):
+        """
+        True if this image is entirely encapsulated in another image on the
+        same page. Only that page's pictures are compared.
+        """
+        pics_by_page = self.metadata.get('pics_by_page')
+        if not isinstance(pics_by_page, BoxIndex) or 'pic_id' not in block:
+            return False
+        return pics_by_page.is_redundant(block['page_no'], block['pic_id'])
+
+    def is_merged_image(self, block):
+        """
+        True if this image is a fragment of a figure whose first fragment,
+        on the same page, makes the image for the whole figure.
+        """
+        pics_by_page = self.metadata.get('pics_by_page')
+        if (
+            self.merge_gap < 0 or
+            not isinstance(pics_by_page, BoxIndex) or
+            'pic_id' not in block
+        ):
+            return False
+        return not pics_by_page.is_group_leader(
+            block['page_no'], block['pic_id'], self.merge_gap
+        )
 
-        return (left, top, right, bottom)
+    def image_box(self, block):
+        """
+        The rectangle to crop for an image block: the bounding box of all
+        the fragments of its figure, or its own rectangle if it stands alone
+        or merging is disabled.
+        """
+        pics_by_page = self.metadata.get('pics_by_page')
+        if (
+            self.merge_gap < 0 or
+            not isinstance(pics_by_page, BoxIndex) or
+            'pic_id' not in block
+        ):
+            return self.image_dim(block)
+        return pics_by_page.group_box(
+            block['page_no'], block['pic_id'], self.merge_gap
+        )
+
+    def image_skip_reason(self, block):
+        """
+        Why an image block shouldn't be made into an image, judging only by
+        the block geometry: 'enclosed' in another image, 'merged' into the
+        image of another fragment of its figure, or a NoiseFilter reason.
+        None if the image should be made.
+        """
+        if self.is_merged_image(block):
+            return 'enclosed' if self.is_enclosed_image(block) else 'merged'
+        # an enclosed first fragment still makes its merged figure's image
+        if self.merge_gap < 0 and self.is_enclosed_image(block):
+            return 'enclosed'
+        try:
+            box = self.image_box(block)
+            pagedim = (
+                float(block['style']['pagewidth']),
+                float(block['style']['pageheight']),
+            )
+        except (KeyError, ValueError):
+            return None
+        text_by_page = self.metadata.get('text_by_page')
+        text_area = 0
+        if isinstance(text_by_page, BoxIndex):
+            text_area = text_by_page.intersection_area(block['page_no'], box)
+        return self.noise_filter.reason(box, pagedim, text_area)
 
     def make_image(self, block):
         """
@@ -408,21 +776,43 @@ class Ebook(ArchiveBookItem):
             # The first page's image is made into the cover automatically
             return
 
-        # pad out the filename to four digits
-        origfile = '{dir}/{item_bookpath}_jp2/{item_bookpath}_{page:0>4}.jp2'.format(
-            dir=self.tmpdir,
-            item_bookpath=self.item_bookpath,
-            page=page_no
-        )
-        if not os.path.isfile(origfile):
+        # ignore images entirely encapsulated in another image, & stray
+        # marks, before any decoding
+        reason = self.image_skip_reason(block)
+        if reason:
+            self.instrumentation.count('images_skipped_{}'.format(reason))
             return
-        basefile = 'img_{:0>4}.png'.format(self.picnum)
-        outfile = '{}/{}'.format(self.tmpdir, basefile)
-        in_epub_imagefile = 'images/{}'.format(basefile)
 
-        # get image dimensions from ABBYY block attributes
-        # (left, top, right, bottom)
-        box = self.image_dim(block)
+        with self.page_image(page_no) as origfile:
+            if origfile is None:
+                return
+            return self.store_image(block, origfile)
+
+    @contextlib.contextmanager
+    def page_image(self, page_no):
+        """
+        The path to a page's JP2, or None if there's no such page. In a
+        workspace which doesn't unpack the page images, the page is read
+        from the zip, & kept until another page is needed: a page with
+        several pictures is unpacked, & hashed for the image cache, once.
+        """
+        member = self.leaf_member(page_no)
+        if self.workspace and not self.workspace.unpacks:
+            yield self.workspace.extract_current(
+                self.jp2_zip, member, 'pages'
+            )
+        else:
+            origfile = os.path.join(self.tmpdir, member)
+            yield origfile if os.path.isfile(origfile) else None
+
+    def store_image(self, block, origfile):
+        """
+        Crop an image block from its page's JP2, add it to the book unless
+        it's there already, & return the HTML showing it.
+        """
+        # get image dimensions from ABBYY block attributes, taking in any
+        # other fragments of the same figure: (left, top, right, bottom)
+        box = self.image_box(block)
         width = box[2] - box[0]
         height = box[3] - box[1]
 
@@ -431,28 +821,36 @@ class Ebook(ArchiveBookItem):
         pageheight = float(block['style']['pageheight'])
         pagedim = (pagewidth, pageheight)
 
-        # ignore if this image is entirely encapsulated in another image
-        for each_pic in self.metadata['pics_by_page']:
-            # Ignore if this is just the block itself
-            if each_pic == block:
-                continue
-            new_box = self.image_dim(each_pic)
-            if all(i >= j for i, j in zip(box, new_box)):
-                return
-
         # make the image:
-        imageobj = ImageFactory(self.image_processor)
         try:
-            imageobj.crop_image(origfile, outfile, dim=box, pagedim=pagedim)
+            encoded = self.render_image(origfile, dim=box, pagedim=pagedim)
         except RuntimeError as e:
             # for failed image creation, keep processing the epub
             self.logger.error(e)
             return ''
-        epubimage = epub.EpubImage()
-        epubimage.file_name = in_epub_imagefile
-        with open(outfile, 'rb') as f:
-            epubimage.content = f.read()
-        epubimage = self.book.add_item(epubimage)
+
+        # If this image is already in the book, point at the stored copy
+        in_epub_imagefile = self.stored_images.find(encoded)
+        if in_epub_imagefile:
+            self.instrumentation.count('images_duplicate')
+            # the duplicate takes no space in the EPUB
+            self.image_bytes -= len(encoded.data)
+        else:
+            in_epub_imagefile = 'images/img_{:0>4}.{}'.format(
+                self.picnum, encoded.extension
+            )
+            if self.spill_images:
+                epubimage = SpilledImage(self.spill(
+                    encoded.data, in_epub_imagefile
+                ))
+            else:
+                epubimage = epub.EpubImage()
+                epubimage.content = encoded.data
+            epubimage.file_name = in_epub_imagefile
+            epubimage.media_type = encoded.media_type
+            epubimage = self.book.add_item(epubimage)
+            self.stored_images.add(encoded, in_epub_imagefile)
+            self.instrumentation.count('images_stored')
 
         # to approximate original layout, set the image container width to
         # percentage of the page width
@@ -473,6 +871,15 @@ class Ebook(ArchiveBookItem):
 
         return content
 
+    def spill(self, data, file_name):
+        """ Keep an encoded image in the workspace, & return its path """
+        path = os.path.join(self.tmpdir, 'spilled', file_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.workspace.reserve(len(data), file_name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
     def make_chapter(self, heading):
         """
         Create a chapter section in an ebooklib.epub.
@@ -593,6 +1000,7 @@ class Ebook(ArchiveBookItem):
                     mylines[k + 1]['text']
                 )
                 mylines[k]['ratio_consecutive'] = ratio_consecutive
+                self.instrumentation.count('fuzzy_comparisons')
                 fuzz_consecutive += ratio_consecutive
             # Check to see if there's still two pages forward
             if k + 2 in mylines:
@@ -601,6 +1009,7 @@ class Ebook(ArchiveBookItem):
                     mylines[k + 2]['text']
                 )
                 mylines[k]['ratio_alternating'] = ratio_alternating
+                self.instrumentation.count('fuzzy_comparisons')
                 fuzz_alternating += ratio_alternating
 
         # occasional similar first/last lines might happen in all texts,
@@ -740,63 +1149,33 @@ class Ebook(ArchiveBookItem):
             for date in self.metadata['date']:
                 self.book.add_metadata('DC', 'date', date)
 
-    def craft_html(self):
-        """
-        Assembles the XHTML content.
-
-        Create some minimal navigation:
-        * Break sections at text elements marked role: heading
-        * Break files at any headings with roleLevel: 1
-        Imperfect, but better than having no navigation or monster files.
-
-        Images will get alternative text of "Picture #" followed by an index
-        number for this image. Barring real alternative text for
-        true accessibility, this at least adds some identifying information.
-        """
-
-        # Default section to hold cover image plus all until the 1st heading
+    def opening_heading(self):
+        """ The heading of the section before the first chapter. """
         if 'title' in self.metadata:
-            heading = self.metadata['title'][0]
-        else:
-            heading = "Opening Section"
-        self.picnum = 1
-        blocks_index = -1
-        self.last_row = False
-        pagetype = ''
-        prev_pagetype = ''
+            return self.metadata['title'][0]
+        return "Opening Section"
 
-        # Look for headers and page numbers
-        # FR10 has markup but isn't reliable so look there as well
-        self.identify_headers_footers_pagenos('first')
-        self.identify_headers_footers_pagenos('last')
-        self.last_row = False
-        self.last_cell = False
-
-        # Make the initial chapter stub
-        chapter = self.make_chapter(heading)
-        endnotes = '<ul>'
-        noteref = 1
-
-        # Make a title page
-        chapter.content += u'<h1 dir="ltr" class="center">{}</h1>'.format(
+    def title_page_html(self, heading):
+        """ The title page, from the metadata, starting the first section """
+        title_page = u'<h1 dir="ltr" class="center">{}</h1>'.format(
             heading
         )
         if 'title-alt-script' in self.metadata:
             for i in self.metadata['title-alt-script']:
-                chapter.content += (
+                title_page += (
                     u'<p dir="auto" class="center bold big">{}</p>'
                 ).format(i)
         if 'creator' in self.metadata:
             for i in self.metadata['creator']:
-                chapter.content += (
+                title_page += (
                     u'<p dir="ltr" class="center bold">{}</p>'
                 ).format(i)
         if 'creator-alt-script' in self.metadata:
             for i in self.metadata['creator-alt-script']:
-                chapter.content += (
+                title_page += (
                     u'<p dir="auto" class="center bold">{}</p>'
                 ).format(i)
-        chapter.content += (
+        title_page += (
             '<div class="offset">'
             '<p dir="ltr">This book was produced in EPUB format by the '
             'Internet Archive.</p> '
@@ -828,6 +1207,73 @@ class Ebook(ArchiveBookItem):
             'other persons with disabilities.</p>'
             '<p>Created with abbyy2epub (v.%s)</p></div>'
         ) % __version__
+        return title_page
+
+    def refresh_front_matter(self):
+        """
+        Bring the parts of resumed HTML which come from the metadata file up
+        to date: the title page & opening section's title, and every
+        chapter's language & text direction.
+        """
+        self.set_direction()
+        heading = self.opening_heading()
+        title_page = self.title_page_html(heading)
+        opening = self.chapters[0]
+        if title_page != self.title_page:
+            opening.content = (
+                title_page + opening.content[len(self.title_page):]
+            )
+            opening.title = dirtify_xml(heading).replace("\n", " ")
+            self.title_page = title_page
+        for chapter in self.chapters:
+            chapter.lang = '{}'.format(self.metadata['language'][0])
+            chapter.direction = self.progression
+
+    def craft_html(self):
+        """
+        Assembles the XHTML content.
+
+        Create some minimal navigation:
+        * Break sections at text elements marked role: heading
+        * Break files at any headings with roleLevel: 1
+        Imperfect, but better than having no navigation or monster files.
+
+        Images will get alternative text of "Picture #" followed by an index
+        number for this image. Barring real alternative text for
+        true accessibility, this at least adds some identifying information.
+        """
+        if self.resume('html', self.body_inputs(), self.restore_html):
+            return
+
+        # Default section to hold cover image plus all until the 1st heading
+        heading = self.opening_heading()
+        self.picnum = 1
+        blocks_index = -1
+        self.images_expected = self.images_made + sum(
+            1 for block in self.blocks
+            if block.get('type') == 'Picture' and
+            not self.image_skip_reason(block)
+        )
+        self.last_row = False
+        pagetype = ''
+        prev_pagetype = ''
+
+        # Look for headers and page numbers
+        # FR10 has markup but isn't reliable so look there as well
+        with self.instrumentation.span('headers', 'html'):
+            self.identify_headers_footers_pagenos('first')
+            self.identify_headers_footers_pagenos('last')
+        self.last_row = False
+        self.last_cell = False
+
+        # Make the initial chapter stub
+        chapter = self.make_chapter(heading)
+        endnotes = '<ul>'
+        noteref = 1
+
+        # Make a title page
+        self.title_page = self.title_page_html(heading)
+        chapter.content += self.title_page
 
         for block in self.blocks:
             blocks_index += 1
@@ -845,7 +1291,7 @@ class Ebook(ArchiveBookItem):
             else:
                 # Treat it as Normal if it's not set
                 pagetype = 'Normal'
-            if pagetype in skippable_pages:
+            if self.pages.is_skipped(block.get('page_no')):
                 continue
 
             # set the block style, if there is one
@@ -1034,141 +1480,421 @@ class Ebook(ArchiveBookItem):
                         block['type'], block['style']
                     )
                 )
+        if self.workspace:
+            self.workspace.drop_current()
+        self.checkpoint('html', self.body_inputs(), {
+            name: getattr(self, name) for name in self.HTML_STATE
+        })
 
-    def craft_epub(self, epub_outfile="out.epub", tmpdir=None):
-        """ Assemble the extracted metadata & text into an EPUB  """
-
-        # Even if we clean up properly afterwards, using TemporaryDirectory
-        # outside of a context manager seems to cause a resource leak
-        if tmpdir:
-            tmpdir = os.path.abspath(tmpdir)
-            os.makedirs(tmpdir, exist_ok=True)
-        with tempfile.TemporaryDirectory(dir=tmpdir) as self.tmpdir:
-            self.abbyy_file = "{tmp}/{base}_abbyy".format(
-                tmp=self.tmpdir, base=self.item_identifier
-            )
-            self.logger.debug("Temp directory: {}\nidentifier: {}".format(
-                self.tmpdir, self.item_identifier))
-            # Unzip ABBYY file to disk. (Might be too huge to hold in memory.)
-            with gzip.open(self.abbyy_gz, 'rb') as infile:
-                with open(self.abbyy_file, 'wb') as outfile:
-                    self.logger.debug(
-                        "Abbyy tmp dir: {}".format(self.abbyy_file)
-                    )
-                    for line in infile:
-                        outfile.write(line)
-
-            # read in the page-by-page scandata file
-            self.load_scandata_pages()
-
-            # Extract the page images and create the cover file
-            self.extract_images()
-            self.extract_cover()
-
-            # parse the ABBYY
-            parser = AbbyyParser(
-                self.abbyy_file,
-                self.meta_xml,
-                self.metadata,
-                self.paragraphs,
-                self.blocks,
-                debug=self.debug,
-            )
-            parser.parse_abbyy()
-            self.logger.debug("Done with parse_abbyy")
+    def unzip_abbyy(self):
+        """
+        Unzip the ABBYY file to disk. (Might be too huge to hold in memory.)
+        """
+        if self.resume(
+            'gunzip', [self.abbyy_gz],
+            lambda state: self.require(os.path.isfile(self.abbyy_file)),
+        ):
+            return
+        with gzip.open(self.abbyy_gz, 'rb') as infile:
+            self.logger.debug("Abbyy tmp dir: {}".format(self.abbyy_file))
+            self.workspace.copy(infile, self.abbyy_file)
+        self.checkpoint('gunzip', [self.abbyy_gz])
 
-            # Text direction: convert IA abbreviation to epub abbreviation
-            direction = {
-                'lr': 'ltr',
-                'rl': 'rtl',
+    def parse_abbyy(self):
+        """
+        Parse the unzipped ABBYY file into blocks, paragraphs & what it says
+        about itself, such as the FineReader version. The metadata file is
+        read separately, by `read_metadata`.
+        """
+        found = {}  # metadata from the ABBYY, kept apart for the checkpoint
+        if self.resume('parse', [self.abbyy_gz], self.restore_parse):
+            return
+        parser = AbbyyParser(
+            self.abbyy_file,
+            self.meta_xml,
+            found,
+            self.paragraphs,
+            self.blocks,
+            debug=self.debug,
+            instrumentation=self.instrumentation,
+        )
+        parser.parse_abbyy(with_metadata=False)
+        self.logger.debug("Done with parse_abbyy")
+        self.metadata.update(found)
+        self.set_version()
+        self.checkpoint(
+            'parse', [self.abbyy_gz], (found, self.paragraphs, self.blocks)
+        )
+
+    def read_metadata(self):
+        """
+        Read the metadata file, which is quick, so it isn't checkpointed:
+        the metadata can change without anything else being redone. If the
+        Ebook was given the item's metadata, a copy of that is used.
+        """
+        if self.item_metadata is not None:
+            meta = copy.deepcopy(self.item_metadata)
+        else:
+            meta = read_item_metadata(self.meta_xml, debug=self.debug)
+        self.metadata.update(meta)
+        self.set_direction()
+
+    def set_version(self):
+        """ Get the FineReader version from the parsed ABBYY """
+        if 'fr-version' in self.metadata:
+            self.version = self.metadata['fr-version']
+
+    def set_direction(self):
+        """ Set the text direction from the metadata """
+        # Text direction: convert IA abbreviation to epub abbreviation
+        direction = {
+            'lr': 'ltr',
+            'rl': 'rtl',
+        }
+
+        if 'page-progression' in self.metadata:
+            self.progression = direction[
+                self.metadata['page-progression'][0]
+            ]
+            self.book.set_direction(self.progression)
+        else:
+            # The epub, used in the spine, uses 'default' for unspecified
+            # direction. HTML, used in the content pages, uses 'auto'.
+            self.progression = 'auto'
+            self.book.set_direction('default')
+
+    def restore_html(self, state):
+        """
+        Take up the book as it was once its HTML was made, with the parts
+        made from the metadata file brought up to date.
+        """
+        for (name, value) in state.items():
+            setattr(self, name, value)
+        self.refresh_front_matter()
+
+    def restore_parse(self, state):
+        """ Fill in the parsed ABBYY from a checkpoint. """
+        (found, paragraphs, blocks) = state
+        self.metadata.update(found)
+        self.paragraphs.update(paragraphs)
+        self.blocks.extend(blocks)
+        self.set_version()
+
+    def assemble_book(self):
+        """
+        Add the book's metadata, navigation & stylesheet around the chapters.
+        """
+        # Set the book's metadata
+        self.set_metadata()
+
+        # set the accessibility metadata
+        self.create_accessibility_metadata()
+
+        # Navigation for EPUB 3 & EPUB 2 fallback
+        self.book.toc = self.chapters
+        self.book.add_item(epub.EpubNcx())
+        self.book.add_item(epub.EpubNav())
+        # cover_ncx hack to work around Adobe Digital Editions problem
+        self.book.spine = ['cover', 'nav', ] + self.chapters
+
+        # define CSS style
+        style = """
+            .center {text-align: center}
+            .sr-only {
+                width: 1px;
+                height: 1px;
+                padding: 0;
+                margin: -1px;
+                overflow: hidden;
+                clip: rect(0,0,0,0);
+                border: 0;
+            }
+            .strong {font-weight: bold;}
+            .italic {font-style: italic;}
+            .serif {font-family: serif;}
+            .sans {font-family: sans-serif;}
+            .big {font-size: 1.5em;}
+            .small {font-size: .75em;}
+            .offset {
+                margin: 1em;
+                padding: 1.5em;
+                border: black 1px solid;
             }
+            img {
+                padding: 0;
+                margin: 0;
+                max-width: 100%;
+                max-height: 100%;
+                column-count: 1;
+                break-inside: avoid;
+                oeb-column-number: 1;
+            }
+            """
 
-            if 'page-progression' in self.metadata:
-                self.progression = direction[
-                    self.metadata['page-progression'][0]
-                ]
-                self.book.set_direction(self.progression)
-            else:
-                # The epub, used in the spine, uses 'default' for unspecified
-                # direction. HTML, used in the content pages, uses 'auto'.
-                self.progression = 'auto'
-                self.book.set_direction('default')
-
-            # get the finereader version
-            if 'fr-version' in self.metadata:
-                self.version = self.metadata['fr-version']
-
-            # make the HTML chapters
-            self.logger.debug("craft_html")
-            self.craft_html()
-            self.logger.debug("Done assembling the HTML")
-
-            # Set the book's metadata
-            self.set_metadata()
-
-            # set the accessibility metadata
-            self.create_accessibility_metadata()
-
-            # Navigation for EPUB 3 & EPUB 2 fallback
-            self.book.toc = self.chapters
-            self.book.add_item(epub.EpubNcx())
-            self.book.add_item(epub.EpubNav())
-            # cover_ncx hack to work around Adobe Digital Editions problem
-            self.book.spine = ['cover', 'nav', ] + self.chapters
-
-            # define CSS style
-            style = """
-                .center {text-align: center}
-                .sr-only {
-                    width: 1px;
-                    height: 1px;
-                    padding: 0;
-                    margin: -1px;
-                    overflow: hidden;
-                    clip: rect(0,0,0,0);
-                    border: 0;
-                }
-                .strong {font-weight: bold;}
-                .italic {font-style: italic;}
-                .serif {font-family: serif;}
-                .sans {font-family: sans-serif;}
-                .big {font-size: 1.5em;}
-                .small {font-size: .75em;}
-                .offset {
-                    margin: 1em;
-                    padding: 1.5em;
-                    border: black 1px solid;
-                }
-                img {
-                    padding: 0;
-                    margin: 0;
-                    max-width: 100%;
-                    max-height: 100%;
-                    column-count: 1;
-                    break-inside: avoid;
-                    oeb-column-number: 1;
-                }
-                """
+        css_file = epub.EpubItem(
+            uid="style_nav",
+            file_name="style/style.css",
+            media_type="text/css",
+            content=style
+        )
+        self.book.add_item(css_file)
 
-            css_file = epub.EpubItem(
-                uid="style_nav",
-                file_name="style/style.css",
-                media_type="text/css",
-                content=style
+    def write_epub(self, epub_outfile, thumbnail_outfile=None):
+        """
+        Write the EPUB, and the cover thumbnail if given a thumbnail_outfile.
+        A reproducible EPUB has its hash written beside it, as .sha256.
+        """
+        if self.reproducible:
+            writer = ReproducibleEpubWriter(
+                epub_outfile, self.book,
+                date=source_date(config.get('Main', 'REPRODUCIBLE_DATE')),
             )
-            self.book.add_item(css_file)
-
+            writer.process()
+            writer.write()
+        else:
+            epub.write_epub(epub_outfile, self.book, {})
+        self.instrumentation.count(
+            'bytes_written', os.path.getsize(epub_outfile))
+        self.content_hash = content_hash(epub_outfile)
+        self.logger.debug("EPUB SHA-256: {}".format(self.content_hash))
+        if self.reproducible:
+            hash_file = write_hash_file(epub_outfile, self.content_hash)
+            self.instrumentation.count(
+                'bytes_written', os.path.getsize(hash_file))
+        if thumbnail_outfile and self.thumbnail:
+            with open(thumbnail_outfile, 'wb') as f:
+                f.write(self.thumbnail.data)
+            self.instrumentation.count(
+                'bytes_written', len(self.thumbnail.data))
+
+    def craft_epub(
+        self, epub_outfile="out.epub", tmpdir=None, thumbnail_outfile=None,
+        report_outfile=None, trace_outfile=None, workdir=None,
+    ):
+        """
+        Assemble the extracted metadata & text into an EPUB. If given a
+        thumbnail_outfile, also save the cover thumbnail there. Timings &
+        counters for each stage are written as JSON to report_outfile, and
+        as a Chrome trace to trace_outfile, if given, even if a stage fails.
+
+        Given a workdir, the intermediate files are kept there instead of
+        in a temporary directory, with checkpoints of the finished stages &
+        the encoded images, so a conversion of the same item which dies
+        part way resumes where it left off.
+
+        The inputs are unpacked into a `Workspace`, with the backing & quota
+        given to the Ebook; a `disk` workspace is under tmpdir.
+        """
+        if workdir:
+            workdir = os.path.abspath(workdir)
+            self.use_workdir(workdir)
+        self.plan_memory()
+        self.workspace = Workspace(
+            self.workspace_backing,
+            root=tmpdir,
+            tmpfs_dir=config.get('Workspace', 'TMPFS_DIR'),
+            quota=self.scratch_quota,
+            directory=workdir,
+            debug=self.debug,
+        )
+        with self.workspace:
+            self.tmpdir = self.workspace.path
+            if self.workspace.unpacks:
+                self.abbyy_file = "{tmp}/{base}_abbyy".format(
+                    tmp=self.tmpdir, base=self.item_identifier
+                )
+            else:
+                self.abbyy_file = self.abbyy_gz  # parsed from the gzip
+            self.logger.debug("Temp directory: {}\nidentifier: {}".format(
+                self.tmpdir, self.item_identifier))
             if epub_outfile.endswith('.epub'):
                 epub_outfile = epub_outfile
             else:
                 epub_outfile = '%s.epub' % epub_outfile
-            epub.write_epub(epub_outfile, self.book, {})
 
-            # run validation on epub
+            # Each stage starts as soon as the stages it needs are done. The
+            # page images (disk), the cover (one decode) & the ABBYY parse
+            # (CPU) overlap. Stages adding items to the book are kept in
+            # sequence: EpubBook isn't thread-safe, and the item order should
+            # not depend on timing. Profiled, they run one at a time, since
+            # only one stage can be profiled at once.
+            if self.instrumentation.profile_dir:
+                max_workers = 1
+            else:
+                max_workers = config.getint('Main', 'STAGE_THREADS') or None
+            stages = StageScheduler(
+                max_workers=max_workers,
+                debug=self.debug,
+                instrumentation=self.instrumentation,
+            )
+            stages.add('metadata', self.read_metadata)
+            if self.checkpoints and self.checkpoints.valid(
+                'html', self.body_inputs()
+            ):
+                # Only the metadata file can have changed since the HTML
+                # was made: rebuild around it, leaving the ABBYY & page
+                # images alone
+                self.logger.debug("Rebuilding around the saved HTML")
+                stages.add('html', self.craft_html, after=['metadata'])
+            elif self.workspace.unpacks:
+                stages.add('gunzip', self.unzip_abbyy)
+                stages.add('scandata', self.load_scandata_pages)
+                stages.add('images', self.extract_images)
+                stages.add('cover', self.extract_cover, after=['scandata'])
+                stages.add('parse', self.parse_abbyy, after=['gunzip'])
+                stages.add('html', self.craft_html, after=[
+                    'parse', 'scandata', 'images', 'cover', 'metadata',
+                ])
+            else:
+                # Nothing to unpack: the pages are read as they're needed
+                stages.add('scandata', self.load_scandata_pages)
+                stages.add('cover', self.extract_cover, after=['scandata'])
+                stages.add('parse', self.parse_abbyy)
+                stages.add('html', self.craft_html, after=[
+                    'parse', 'scandata', 'cover', 'metadata',
+                ])
+            stages.add('assemble', self.assemble_book, after=['html'])
+            stages.add(
+                'write',
+                lambda: self.write_epub(epub_outfile, thumbnail_outfile),
+                after=['assemble'],
+            )
             if self.debug or self.epubcheck:
-                self.validate_epub(epub_outfile, level=self.epubcheck)
+                stages.add(
+                    'epubcheck',
+                    lambda: self.validate_epub(
+                        epub_outfile, level=self.epubcheck),
+                    after=['write'],
+                )
             if self.debug or self.ace:
-                self.validate_a11y(epub_outfile, level=self.ace)
+                stages.add(
+                    'ace',
+                    lambda: self.validate_a11y(epub_outfile, level=self.ace),
+                    after=['write'],
+                )
+            if self.memory:
+                self.memory.start()
+            try:
+                stages.run()
+            finally:
+                if self.memory:
+                    self.memory.stop()
+                    self.logger.debug(self.memory.summary())
+                    if self.memory.over_budget():
+                        self.logger.warning(
+                            "Peak memory {:.0f} MB is over the budget of "
+                            "{:.0f} MB".format(
+                                self.memory.peak / 2 ** 20,
+                                self.memory.budget / 2 ** 20))
+                self.stage_timings = stages.timings
+                self.stats['pages'] = len(self.pages)
+                self.stats['blocks'] = len(self.blocks)
+                scratch = self.workspace.usage()
+                self.logger.debug("Workspace: {}".format(scratch))
+                self.stats['scratch_peak_bytes'] = scratch['peak']
+                self.stats['scratch_bytes'] = scratch['on_disk']
+                if report_outfile:
+                    self.instrumentation.write_report(report_outfile)
+                if trace_outfile:
+                    self.instrumentation.write_trace(trace_outfile)
+
+            self.logger.debug("Conversion stats: {}".format(dict(self.stats)))
+            if self.image_cache:
+                self.logger.debug(
+                    "Image cache: {}".format(self.image_cache.stats)
+                )
+
+    def plan_memory(self):
+        """
+        Given a memory budget, choose the workspace, if it's `auto`, & if
+        encoded images are spilled, from an estimate made from the inputs'
+        sizes, & log why. Without a budget, an `auto` workspace is on disk.
+        """
+        budget = self.memory.budget if self.memory else 0
+        if not budget:
+            if self.workspace_backing == 'auto':
+                self.workspace_backing = 'disk'
+            return
+        plan = MemoryPlan(
+            self.estimate_memory(), budget, self.workspace_backing
+        )
+        for reason in plan.reasons:
+            self.logger.info("Memory plan: {}".format(reason))
+        if not plan.fits():
+            self.logger.warning(
+                "No plan keeps the estimated peak memory within the budget")
+        self.workspace_backing = plan.workspace
+        self.spill_images = plan.spill_images
+        self.memory.plan = plan
+
+    def estimate_memory(self):
+        """
+        What converting the book should take, in bytes, by part, as
+        `MemoryPlan` expects, from the size of the ABBYY, the number of
+        leaves in scandata (or of page images) & the largest page image.
+        The costs per input are rough, & set in config.ini.
+        """
+        with ZipFile(self.jp2_zip) as f:
+            infos = f.infolist()
+            largest = max(infos, key=lambda info: info.file_size)
+            with f.open(largest) as jp2:
+                (width, height) = jp2_size(jp2.read(256)) or (0, 0)
+        # the page table is kept, so the scandata stage needn't read it again
+        try:
+            if not self.pages:
+                self.read_scandata()
+            leaves = len(self.pages)
+        except (OSError, ValueError, etree.XMLSyntaxError):
+            leaves = len(infos)
+        image_size = self.image_profile.image_budget or (
+            sum(info.file_size for info in infos) / max(len(infos), 1))
+        images = leaves * config.getfloat(
+            'Main', 'MEMORY_ESTIMATE_PICTURES_PER_LEAF') * image_size
+        if self.image_profile.book_budget:
+            images = min(images, self.image_profile.book_budget)
+        return {
+            'base': config.getfloat('Main', 'MEMORY_ESTIMATE_BASE') * 2 ** 20,
+            'blocks': gzip_size(self.abbyy_gz) * config.getfloat(
+                'Main', 'MEMORY_ESTIMATE_PER_ABBYY_MB'),
+            'decode': width * height / 10 ** 6 * config.getfloat(
+                'Main', 'MEMORY_ESTIMATE_PER_MEGAPIXEL') * 2 ** 20,
+            'images': images,
+            'scratch': scratch_estimate(self.abbyy_gz, self.jp2_zip),
+        }
+
+    def scratch_estimate(self):
+        """ The bytes a conversion unpacks into a workspace like ours """
+        return scratch_estimate(
+            self.abbyy_gz, self.jp2_zip,
+            unpacks=self.workspace_backing != 'memory',
+        )
+
+    def use_workdir(self, workdir):
+        """
+        Checkpoint stages in workdir. Encoded images are checkpointed as
+        they're made, in an image cache there, unless there's one already.
+        """
+        os.makedirs(workdir, exist_ok=True)
+        self.checkpoints = Checkpoints(
+            os.path.join(workdir, 'checkpoints'),
+            # Anything besides the inputs which changes the stages' output
+            fingerprint=Checkpoints.make_fingerprint(
+                __version__,
+                sorted(
+                    (section, sorted(config.items(section)))
+                    for section in config.sections()
+                ),
+                sorted(vars(self.image_profile).items()),
+                self.image_processor,
+            ),
+            debug=self.debug,
+        )
+        if not self.image_cache:
+            self.image_cache = ImageCache(
+                os.path.join(workdir, 'images'),
+                max_bytes=config.getint('Images', 'CACHE_MAX_BYTES'),
+                debug=self.debug,
+            )
 
     def validate_epub(self, epub_file, level=None):
         self.logger.debug("Running EpubCheck on {}".format(epub_file))
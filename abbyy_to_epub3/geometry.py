@@ -0,0 +1,240 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import defaultdict
+
+import numpy as np
+
+
+def block_box(block):
+    """
+    Given a dict object containing the block info, return a tuple of its
+    dimensions from the ABBYY attributes: (left, top, right, bottom)
+    """
+    style = block['style']
+    return (
+        int(style['l']), int(style['t']), int(style['r']), int(style['b'])
+    )
+
+
+class BoxIndex(object):
+    """
+    A per-page index of block rectangles, for geometry tests which only look
+    at the other blocks on the same page.
+
+    Rectangles are (left, top, right, bottom) in page pixels, as ABBYY
+    records them. Each page's rectangles are kept as a NumPy array, so a
+    test against every rectangle on a page is a single vectorised operation.
+    """
+
+    def __init__(self):
+        self._pending = defaultdict(list)  # page_no: boxes not yet in arrays
+        self._boxes = {}                   # page_no: (n, 4) array of boxes
+        self._redundant = {}               # page_no: cached enclosure flags
+        self._groups = defaultdict(dict)   # page_no: {gap: group labels}
+
+    def add(self, page_no, box):
+        """
+        Add a rectangle on the given page. Returns the rectangle's id, its
+        position among that page's rectangles.
+        """
+        box_id = len(self._pending[page_no])
+        if page_no in self._boxes:
+            box_id += len(self._boxes[page_no])
+        self._pending[page_no].append(box)
+        self._redundant.pop(page_no, None)
+        self._groups.pop(page_no, None)
+        return box_id
+
+    def boxes(self, page_no):
+        """ All rectangles on a page, as an (n, 4) integer array. """
+        pending = self._pending.pop(page_no, None)
+        if pending:
+            new = np.array(pending, dtype=np.int64).reshape(-1, 4)
+            if page_no in self._boxes:
+                new = np.concatenate((self._boxes[page_no], new))
+            self._boxes[page_no] = new
+        return self._boxes.get(page_no, np.empty((0, 4), dtype=np.int64))
+
+    def pages(self):
+        """ Page numbers which have at least one rectangle. """
+        return sorted(set(self._boxes) | set(self._pending))
+
+    def __len__(self):
+        return sum(len(self.boxes(page_no)) for page_no in self.pages())
+
+    def containing(self, page_no, box):
+        """ Mask of the rectangles on a page which fully enclose `box`. """
+        boxes = self.boxes(page_no)
+        (left, top, right, bottom) = box
+        return (
+            (boxes[:, 0] <= left) & (boxes[:, 1] <= top) &
+            (boxes[:, 2] >= right) & (boxes[:, 3] >= bottom)
+        )
+
+    def overlapping(self, page_no, box):
+        """ Mask of the rectangles on a page which share area with `box`. """
+        boxes = self.boxes(page_no)
+        (left, top, right, bottom) = box
+        return (
+            (boxes[:, 0] < right) & (boxes[:, 2] > left) &
+            (boxes[:, 1] < bottom) & (boxes[:, 3] > top)
+        )
+
+    def intersection_area(self, page_no, box):
+        """
+        The area `box` shares with the rectangles on a page, summed. Where
+        those rectangles overlap each other, the result can exceed the
+        area of `box`.
+        """
+        boxes = self.boxes(page_no)
+        (left, top, right, bottom) = box
+        widths = np.clip(
+            np.minimum(boxes[:, 2], right) - np.maximum(boxes[:, 0], left),
+            0, None
+        )
+        heights = np.clip(
+            np.minimum(boxes[:, 3], bottom) - np.maximum(boxes[:, 1], top),
+            0, None
+        )
+        return int((widths * heights).sum())
+
+    def redundant(self, page_no):
+        """
+        Mask of the rectangles on a page which are entirely enclosed in
+        another rectangle on that page. Of identical rectangles, only the
+        first is kept. Computed once per page, pairwise.
+        """
+        if page_no not in self._redundant:
+            boxes = self.boxes(page_no)
+            lt, rb = boxes[:, :2], boxes[:, 2:]
+            # inside[i, j]: rectangle i lies within rectangle j
+            inside = (
+                (lt[:, None, :] >= lt[None, :, :]).all(axis=2) &
+                (rb[:, None, :] <= rb[None, :, :]).all(axis=2)
+            )
+            identical = (boxes[:, None, :] == boxes[None, :, :]).all(axis=2)
+            ids = np.arange(len(boxes))
+            earlier = ids[None, :] < ids[:, None]
+            enclosing = (inside & ~identical) | (identical & earlier)
+            self._redundant[page_no] = enclosing.any(axis=1)
+        return self._redundant[page_no]
+
+    def is_redundant(self, page_no, box_id):
+        """ True if the given rectangle is enclosed in another on its page """
+        return bool(self.redundant(page_no)[box_id])
+
+    def groups(self, page_no, gap=0):
+        """
+        Label each rectangle on a page with the group it belongs to: the
+        rectangles connected through chains of neighbours no more than `gap`
+        pixels apart, overlapping or touching included. A group's label is
+        the id of its first rectangle. Computed once per page and gap.
+        """
+        if gap not in self._groups[page_no]:
+            boxes = self.boxes(page_no)
+            lt, rb = boxes[:, :2], boxes[:, 2:]
+            # near[i, j]: the rectangles are within `gap` on both axes
+            near = (
+                (lt[:, None, :] <= rb[None, :, :] + gap) &
+                (lt[None, :, :] <= rb[:, None, :] + gap)
+            ).all(axis=2)
+            labels = np.arange(len(boxes))
+            # spread the lowest id through each group until nothing changes
+            while True:
+                spread = np.where(near, labels[None, :], len(boxes)).min(
+                    axis=1
+                )
+                if (spread == labels).all():
+                    break
+                labels = spread
+            self._groups[page_no][gap] = labels
+        return self._groups[page_no][gap]
+
+    def group_box(self, page_no, box_id, gap=0):
+        """
+        The bounding box of the group the given rectangle belongs to, as
+        (left, top, right, bottom).
+        """
+        labels = self.groups(page_no, gap)
+        members = self.boxes(page_no)[labels == labels[box_id]]
+        return (
+            int(members[:, 0].min()), int(members[:, 1].min()),
+            int(members[:, 2].max()), int(members[:, 3].max()),
+        )
+
+    def is_group_leader(self, page_no, box_id, gap=0):
+        """ True if the given rectangle is the first of its group. """
+        return bool(self.groups(page_no, gap)[box_id] == box_id)
+
+
+class NoiseFilter(object):
+    """
+    Rejects Picture blocks which are probably specks, stray marks or gutter
+    shadows, using only the block geometry ABBYY gives us, so they are
+    dropped before any image is decoded.
+
+    A picture is noise if it is:
+
+    - small: less than `min_area` of the page area
+    - aspect: more than `max_aspect` times longer than it is wide, or the
+      reverse (0 disables this test)
+    - margin: entirely within `margin` of the page size from an edge
+    - text: covered by text blocks over more than `max_text_overlap` of its
+      own area
+    """
+
+    def __init__(
+        self, min_area=0.0, max_aspect=0, margin=0.0, max_text_overlap=1.0,
+    ):
+        self.min_area = min_area
+        self.max_aspect = max_aspect
+        self.margin = margin
+        self.max_text_overlap = max_text_overlap
+
+    def reason(self, box, pagedim, text_area=0):
+        """
+        Why the picture in `box` is noise: 'small', 'aspect', 'margin' or
+        'text'; None if it looks like a real image. Pagedim is passed as
+        (width, height), text_area is the area of `box` covered by text.
+        """
+        (left, top, right, bottom) = box
+        (pagewidth, pageheight) = pagedim
+        width = right - left
+        height = bottom - top
+        area = width * height
+
+        if width <= 0 or height <= 0:
+            return 'small'
+        if area < self.min_area * pagewidth * pageheight:
+            return 'small'
+        if (
+            self.max_aspect and
+            max(width / height, height / width) > self.max_aspect
+        ):
+            return 'aspect'
+        if self.margin and (
+            right <= self.margin * pagewidth or
+            left >= (1 - self.margin) * pagewidth or
+            bottom <= self.margin * pageheight or
+            top >= (1 - self.margin) * pageheight
+        ):
+            return 'margin'
+        if text_area > self.max_text_overlap * area:
+            return 'text'
+        return None
@@ -0,0 +1,255 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from contextlib import contextmanager
+
+from abbyy_to_epub3.image_output import EncodedImage
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+MEDIA_TYPES = {
+    'jpg': 'image/jpeg',
+    'png': 'image/png',
+}
+
+
+class ImageCache(object):
+    """
+    A persistent, content-addressed cache of encoded images, shared between
+    runs and between concurrent conversions.
+
+    Entries are keyed on a hash of everything that determines the output:
+    the bytes of the source JP2, the crop box, page dimensions, image
+    library and output profile. Each entry is a file named
+    `<key>.<kind>.<extension>`, written atomically, so readers never see a
+    partial image. Once the cache grows beyond `max_bytes`, the least
+    recently used entries are evicted down to LOW_WATER of it, so that the
+    walk evicting needs isn't repeated by the next few stores; a hit
+    refreshes an entry's mtime. Temporary files left by a writer that died
+    are deleted by the walk once they're TMP_GRACE seconds old.
+
+    The cache's total size is kept in a file beside the entries, updated by
+    each store under the cache's lock, so the directory is only walked to
+    evict, or if that file is missing.
+    """
+
+    LOCKFILE = '.lock'
+    SIZEFILE = '.size'
+    # Evicting stops once the cache fits in this fraction of max_bytes
+    LOW_WATER = 0.9
+    # Seconds before an unrenamed temporary file counts as abandoned
+    TMP_GRACE = 3600
+
+    def __init__(self, directory, max_bytes=2 ** 30, debug=False):
+        self.logger = logging.getLogger(__name__)
+        if debug:
+            self.logger.addHandler(logging.StreamHandler())
+            self.logger.setLevel(logging.DEBUG)
+
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        self._digests = {}     # (path, size, mtime): hash of the file
+        self._lock = threading.Lock()
+
+    def file_digest(self, path):
+        """
+        SHA-256 of a file's contents. Remembered per file, since a page's JP2
+        is often used for several crops.
+        """
+        stat = os.stat(path)
+        memo = (path, stat.st_size, stat.st_mtime_ns)
+        if memo not in self._digests:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            self._digests[memo] = digest.hexdigest()
+        return self._digests[memo]
+
+    def key(self, jp2, backend, profile, budget=None, **decode_args):
+        """
+        The cache key for an image made from the JP2 with the given library,
+        output profile & byte budget. Decode arguments such as `dim`,
+        `pagedim` and `resize` are part of the key.
+        """
+        parts = {
+            'jp2': self.file_digest(jp2),
+            'backend': backend,
+            'profile': sorted(vars(profile).items()),
+            'budget': budget,
+            'decode': sorted(
+                (k, list(v) if isinstance(v, tuple) else v)
+                for k, v in decode_args.items()
+            ),
+        }
+        encoded = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def _entry(self, key):
+        """ The path of the cached entry for this key, if there is one. """
+        subdir = os.path.join(self.directory, key[:2])
+        try:
+            names = os.listdir(subdir)
+        except FileNotFoundError:
+            return None
+        for name in names:
+            if name.startswith(key + '.'):
+                return os.path.join(subdir, name)
+        return None
+
+    def get(self, key):
+        """ Return the cached EncodedImage for this key, or None. """
+        path = self._entry(key)
+        data = None
+        if path:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.utime(path)
+            except FileNotFoundError:
+                # evicted by another process since we listed it
+                data = None
+        with self._lock:
+            if data is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+        (_, kind, extension) = os.path.basename(path).split('.')
+        return EncodedImage(data, MEDIA_TYPES[extension], extension, kind)
+
+    def put(self, key, encoded):
+        """ Store an EncodedImage, evicting old entries if necessary. """
+        subdir = os.path.join(self.directory, key[:2])
+        os.makedirs(subdir, exist_ok=True)
+        path = os.path.join(
+            subdir, '{}.{}.{}'.format(key, encoded.kind, encoded.extension)
+        )
+        # Write to a temporary name, then rename: concurrent writers of the
+        # same key produce identical files, & readers never see partial ones
+        fd, tmppath = tempfile.mkstemp(dir=subdir, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(encoded.data)
+            with self.locked():
+                try:
+                    replaced = os.stat(path).st_size
+                except FileNotFoundError:
+                    replaced = 0
+                os.replace(tmppath, path)
+                total = self.read_size()
+                if total is None:
+                    total = sum(size for (_, size, _) in self.scan())
+                else:
+                    total += len(encoded.data) - replaced
+                if total > self.max_bytes:
+                    total = self.evict_locked()
+                self.write_size(total)
+        except OSError as e:
+            self.logger.error("Can't write to image cache: {}".format(e))
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            return
+        with self._lock:
+            self.stats['stores'] += 1
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold the cache's exclusive lock, so concurrent processes don't
+        change the size file or evict at the same time.
+        """
+        with open(os.path.join(self.directory, self.LOCKFILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def read_size(self):
+        """ The cache's total size from its size file; None if unknown """
+        try:
+            with open(os.path.join(self.directory, self.SIZEFILE)) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write_size(self, total):
+        """ Record the cache's total size; call with the lock held """
+        with open(os.path.join(self.directory, self.SIZEFILE), 'w') as f:
+            f.write(str(total))
+
+    def scan(self):
+        """
+        (mtime, size, path) of each entry, walking the directory. Deletes
+        stale temporary files on the way; call with the lock held.
+        """
+        entries = []
+        stale = time.time() - self.TMP_GRACE
+        for subdir, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(subdir, name)
+                if name.startswith('.') and not name.startswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(path)
+                    if name.startswith('.tmp'):
+                        if stat.st_mtime < stale:
+                            os.remove(path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache fits in
+        LOW_WATER of max_bytes.
+        """
+        with self.locked():
+            self.write_size(self.evict_locked())
+
+    def evict_locked(self):
+        """
+        Evict, with the lock held, & return the cache's size after. The
+        size is counted afresh, correcting the size file for entries
+        deleted by hand.
+        """
+        entries = self.scan()
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total <= self.max_bytes * self.LOW_WATER:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self._lock:
+                self.stats['evictions'] += 1
+        return total
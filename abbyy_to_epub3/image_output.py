@@ -0,0 +1,245 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+from io import BytesIO
+from PIL import Image
+
+import hashlib
+
+from abbyy_to_epub3.configuration import PROFILE_PREFIX, profile_names
+
+# Don't shrink images below this width while trying to meet a byte budget
+MIN_WIDTH = 200
+# Each attempt at meeting a byte budget scales the image by this much
+SCALE_STEP = 0.8
+
+EncodedImage = namedtuple(
+    'EncodedImage', ['data', 'media_type', 'extension', 'kind']
+)
+
+
+class OutputProfile(object):
+    """
+    How images are encoded for one target: the widest image allowed, byte
+    budgets for each image & for the whole book, and the formats used.
+
+    Budgets and widths of 0 (or None) mean no limit. A lossless profile
+    writes every image as a full-colour PNG.
+    """
+
+    def __init__(
+        self, name, max_width=None, image_budget=None, book_budget=None,
+        jpeg_quality_max=85, jpeg_quality_min=40, lossless=False,
+        bitonal_ratio=0.97, lineart_ratio=0.85, palette_colors=64,
+    ):
+        self.name = name
+        self.max_width = max_width or None
+        self.image_budget = image_budget or None
+        self.book_budget = book_budget or None
+        self.jpeg_quality_max = jpeg_quality_max
+        self.jpeg_quality_min = jpeg_quality_min
+        self.lossless = lossless
+        # share of near-black & near-white pixels marking bitonal/line art
+        self.bitonal_ratio = bitonal_ratio
+        self.lineart_ratio = lineart_ratio
+        self.palette_colors = palette_colors
+
+    @classmethod
+    def from_config(cls, config, name):
+        """ Read the named profile, & the [Images] thresholds, from config """
+        section = PROFILE_PREFIX + name
+        if not config.has_section(section):
+            raise ValueError(
+                "Unknown image profile `{}`. Options: {}".format(
+                    name, ', '.join(profile_names(config))
+                )
+            )
+        return cls(
+            name,
+            max_width=config.getint(section, 'MAX_WIDTH'),
+            image_budget=config.getint(section, 'IMAGE_BUDGET'),
+            book_budget=config.getint(section, 'BOOK_BUDGET'),
+            jpeg_quality_max=config.getint(section, 'JPEG_QUALITY_MAX'),
+            jpeg_quality_min=config.getint(section, 'JPEG_QUALITY_MIN'),
+            lossless=config.getboolean(section, 'LOSSLESS'),
+            bitonal_ratio=config.getfloat('Images', 'BITONAL_RATIO'),
+            lineart_ratio=config.getfloat('Images', 'LINEART_RATIO'),
+            palette_colors=config.getint('Images', 'PALETTE_COLORS'),
+        )
+
+
+def classify(im, profile):
+    """
+    Guess what kind of image this is from a small greyscale copy:
+    'bitonal' (text & scans with no mid-tones), 'lineart' (mostly black &
+    white, with some shading), or 'photo'.
+    """
+    if im.mode == '1':
+        return 'bitonal'
+    # Sample pixels rather than averaging, which would invent mid-tones
+    small = im.convert('L')
+    small.thumbnail((256, 256), Image.NEAREST)
+    histogram = small.histogram()
+    extremes = sum(histogram[:32]) + sum(histogram[224:])
+    ratio = extremes / max(sum(histogram), 1)
+    if ratio >= profile.bitonal_ratio:
+        return 'bitonal'
+    if ratio >= profile.lineart_ratio:
+        return 'lineart'
+    return 'photo'
+
+
+def fit_width(im, max_width):
+    """ Scale the image down, keeping its aspect ratio, to max_width. """
+    if max_width and im.width > max_width:
+        height = max(round(im.height * max_width / im.width), 1)
+        im = im.resize((max_width, height), Image.LANCZOS)
+    return im
+
+
+def _save(im, fmt, **params):
+    buf = BytesIO()
+    im.save(buf, fmt, **params)
+    return buf.getvalue()
+
+
+def _encode_png(im, kind, profile):
+    if kind == 'bitonal':
+        im = im.convert('L').convert('1', dither=Image.NONE)
+    elif kind == 'lineart':
+        if im.mode not in ('L', 'RGB'):
+            im = im.convert('RGB')
+        im = im.quantize(colors=profile.palette_colors)
+    return _save(im, 'png', optimize=True)
+
+
+def _encode_jpeg(im, profile, budget):
+    """
+    Binary search for the best JPEG quality which fits the budget. Returns
+    the lowest allowed quality if nothing fits.
+    """
+    if im.mode not in ('L', 'RGB'):
+        im = im.convert('RGB')
+    if not budget:
+        return _save(
+            im, 'jpeg', quality=profile.jpeg_quality_max, optimize=True
+        )
+    low, high = profile.jpeg_quality_min, profile.jpeg_quality_max
+    best = None
+    while low <= high:
+        quality = (low + high) // 2
+        data = _save(im, 'jpeg', quality=quality, optimize=True)
+        if len(data) <= budget:
+            best = data
+            low = quality + 1
+        else:
+            high = quality - 1
+    if best is None:
+        best = _save(
+            im, 'jpeg', quality=profile.jpeg_quality_min, optimize=True
+        )
+    return best
+
+
+def encode_image(im, profile, budget=None):
+    """
+    Encode a decoded Pillow image for the EPUB under the given profile:
+    JPEG for photographs, 1-bit PNG for bitonal images, palettized PNG for
+    line art. If the result is larger than `budget` bytes, the image is
+    scaled down until it fits or reaches MIN_WIDTH.
+    """
+    im = fit_width(im, profile.max_width)
+    if profile.lossless:
+        kind = 'lossless'
+    else:
+        kind = classify(im, profile)
+
+    while True:
+        if kind == 'photo':
+            data = _encode_jpeg(im, profile, budget)
+        elif kind == 'lossless':
+            data = _save(im, 'png')
+        else:
+            data = _encode_png(im, kind, profile)
+        if not budget or len(data) <= budget or im.width <= MIN_WIDTH:
+            break
+        im = fit_width(im, max(int(im.width * SCALE_STEP), MIN_WIDTH))
+
+    if kind == 'photo':
+        return EncodedImage(data, 'image/jpeg', 'jpg', kind)
+    return EncodedImage(data, 'image/png', 'png', kind)
+
+
+def dhash(im, size=8):
+    """
+    Perceptual difference hash of an image, as a (size * size)-bit integer.
+    Similar looking images have hashes a small Hamming distance apart.
+    """
+    small = im.convert('L').resize((size + 1, size), Image.LANCZOS)
+    pixels = small.tobytes()
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+class DuplicateIndex(object):
+    """
+    Remembers the images already stored in a book, so repeated ornaments,
+    logos & blank regions can point at one stored item.
+
+    Identical encoded bytes always match. With a tolerance above 0, images
+    of the same pixel dimensions also match when their perceptual hashes
+    differ by at most `tolerance` bits.
+    """
+
+    def __init__(self, tolerance=0):
+        self.tolerance = tolerance
+        self._exact = {}        # sha256 of encoded bytes: file name
+        self._perceptual = []   # (pixel size, dhash, file name)
+
+    def _fingerprint(self, encoded):
+        im = Image.open(BytesIO(encoded.data))
+        return im.size, dhash(im)
+
+    def find(self, encoded):
+        """ The file name of a stored duplicate of this image, or None. """
+        digest = hashlib.sha256(encoded.data).hexdigest()
+        if digest in self._exact:
+            return self._exact[digest]
+        if self.tolerance:
+            size, phash = self._fingerprint(encoded)
+            for (other_size, other_hash, file_name) in self._perceptual:
+                if (
+                    size == other_size and
+                    bin(phash ^ other_hash).count('1') <= self.tolerance
+                ):
+                    return file_name
+        return None
+
+    def add(self, encoded, file_name):
+        """ Record a newly stored image. """
+        digest = hashlib.sha256(encoded.data).hexdigest()
+        self._exact[digest] = file_name
+        if self.tolerance:
+            size, phash = self._fingerprint(encoded)
+            self._perceptual.append((size, phash, file_name))
@@ -16,10 +16,60 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from io import BytesIO
 from PIL import Image
 
 import logging
+import math
+import os
+import struct
 import subprocess
+import tempfile
+import threading
+
+# Seconds an external decoder may run before we give up on the image
+DEFAULT_TIMEOUT = 300
+
+# Semaphores bounding concurrent decodes, shared by every processor in the
+# process so parallel callers can't oversubscribe the CPUs.
+_decode_slots = {}
+_decode_slots_lock = threading.Lock()
+
+
+def reduce_level(size, box):
+    """
+    The number of JP2 resolution levels which can be discarded from an image
+    of `size` (width, height) while still having enough pixels to fill
+    `box` (width, height) with the whole image, keeping its aspect ratio.
+    """
+    scale = min(box[0] / size[0], box[1] / size[1])
+    if scale >= 1:
+        return 0
+    return int(math.floor(math.log2(1 / scale)))
+
+
+def jp2_size(header):
+    """
+    The (width, height) of a JP2, from the start of the file, which holds
+    its image header box; None if that isn't there.
+    """
+    at = header.find(b'ihdr')
+    if at < 0 or len(header) < at + 12:
+        return None
+    (height, width) = struct.unpack('>II', header[at + 4:at + 12])
+    return (width, height)
+
+
+def decode_slots(limit=None):
+    """
+    Return the process-wide semaphore allowing at most `limit` image decodes
+    at once. Defaults to one decode per CPU.
+    """
+    limit = limit or os.cpu_count() or 1
+    with _decode_slots_lock:
+        if limit not in _decode_slots:
+            _decode_slots[limit] = threading.BoundedSemaphore(limit)
+        return _decode_slots[limit]
 
 
 class ImageProcessor(object):
@@ -28,22 +78,66 @@ class ImageProcessor(object):
 
     Can use various image processing libraries via factories.
     """
-    def __init__(self, debug=False):
+    def __init__(
+        self, debug=False, num_threads=None, timeout=DEFAULT_TIMEOUT,
+        max_decodes=None,
+    ):
         self.logger = logging.getLogger(__name__)
         if debug:
             self.logger.addHandler(logging.StreamHandler())
             self.logger.setLevel(logging.DEBUG)
 
+        self.num_threads = num_threads    # threads per decode, if supported
+        self.timeout = timeout            # seconds per external decode
+        self.max_decodes = max_decodes    # concurrent decodes per process
+
+    def dimensions(self, origfile):
+        """
+        The (width, height) of an image, read from its header without
+        decoding the pixels.
+        """
+        try:
+            with Image.open(origfile) as im:
+                return im.size
+        except (IOError, SyntaxError) as e:
+            raise RuntimeError(
+                "Can't read image header {}: {}".format(origfile, e)
+            )
+
+    def decode_to_fit(self, origfile, box):
+        """
+        Decode an entire image scaled to fit within `box` (width, height),
+        keeping its aspect ratio. Only the JP2 resolution levels needed for
+        that size are decoded.
+        """
+        level = reduce_level(self.dimensions(origfile), box)
+        im = self.decode(origfile, discard_level=level)
+        im.thumbnail(box, Image.LANCZOS)
+        return im
+
+    def crop_image(self, origfile, outfile, **kwargs):
+        """
+        Given an image object, save a crop or the entire image as a PNG.
+        Takes the same keyword arguments as the library's `decode`.
+        """
+        im = self.decode(origfile, **kwargs)
+        try:
+            im.save(outfile, 'png')
+        except (IOError, ValueError) as e:
+            raise RuntimeError(
+                "Can't save image {} to {}: {}".format(origfile, outfile, e)
+            )
 
-def factory(type):
+
+def factory(type, **kwargs):
 
     class KakaduProcessor(ImageProcessor):
-        def crop_image(
-            self, origfile, outfile,
+        def decode(
+            self, origfile,
             discard_level=2, dim=False, pagedim=False, resize=False,
         ):
             """
-            Given an image object, save a crop of the entire image.
+            Given an image object, decode a crop or the entire image.
             Convert (left, top, right, bottom) in pixels to the format
             wanted by kakadu: "{<top>,<left>},{<height>,<width>}"
             as percentages between 0.0 and 1.0.
@@ -51,7 +145,7 @@ def factory(type):
             """
 
             if dim and pagedim:
-                # if dimensions are passed, save a crop of the image
+                # if dimensions are passed, decode a crop of the image
                 (left, top, right, bottom) = dim
                 (pagewidth, pageheight) = pagedim
                 region_string = "{%s,%s},{%s,%s}" % (
@@ -63,71 +157,94 @@ def factory(type):
             else:
                 region_string = "{0.0,0.0},{1.0,1.0}"
 
-            # kdu_expand has to be run as a subprocess call
-            cmd_bmp = [
-                'kdu_expand',
-                '-region', region_string,
-                '-reduce', str(discard_level),
-                '-i', origfile,
-                '-o', outfile + '.bmp'
-            ]
-            cmd_pnm = [
-                'bmptopnm', outfile + '.bmp'
-            ]
-            cmd_png = 'pnmtopng'
-            try:
-                subprocess.run(
-                    cmd_bmp, stdout=subprocess.DEVNULL, check=True
-                )
-            except subprocess.CalledProcessError as e:
-                raise RuntimeError(
-                    "Can't save cropped image as BMP: {}".format(e)
-                )
-            # We don't always control the filenames of the JP2, so use
-            # subprocess.PIPE, not shell=True, to prevent injection
-            try:
-                p_pnm = subprocess.Popen(
-                    cmd_pnm,
-                    stderr=subprocess.DEVNULL,
-                    stdout=subprocess.PIPE,
-                )
-            except subprocess.CalledProcessError as e:
-                raise RuntimeError(
-                    "Can't generate PNM: {}".format(e)
-                )
+            im = self.expand(origfile, region_string, discard_level)
+            if resize:
+                im = im.resize(resize)
+            return im
+
+        def expand(self, origfile, region_string, discard_level):
+            """
+            Decode a region of a JP2 with kdu_expand, returning a Pillow image.
+
+            kdu_expand only writes to named files, and picks the output format
+            from the extension. Give it a PNM-named link to its own stdout, so
+            the pixels come straight back through the pipe into memory.
+            """
+            # Greyscale scans must be written as PGM; PPM needs 3 components
+            extension = 'pgm' if self.components(origfile) == 1 else 'ppm'
+            with tempfile.TemporaryDirectory() as linkdir:
+                stdout_link = os.path.join(linkdir, 'out.' + extension)
+                os.symlink('/dev/stdout', stdout_link)
+
+                # kdu_expand has to be run as a subprocess call
+                cmd = [
+                    'kdu_expand',
+                    '-quiet',
+                    '-region', region_string,
+                    '-reduce', str(discard_level),
+                    '-i', origfile,
+                    '-o', stdout_link,
+                ]
+                if self.num_threads is not None:
+                    cmd += ['-num_threads', str(self.num_threads)]
+
+                # We don't always control the filenames of the JP2, so pass
+                # a list, not shell=True, to prevent injection
+                with decode_slots(self.max_decodes):
+                    try:
+                        result = subprocess.run(
+                            cmd,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            timeout=self.timeout,
+                            check=True,
+                        )
+                    except subprocess.CalledProcessError as e:
+                        raise RuntimeError(
+                            "Can't expand {}: {}".format(origfile, e)
+                        )
+                    except subprocess.TimeoutExpired as e:
+                        raise RuntimeError(
+                            "Timed out expanding {}: {}".format(origfile, e)
+                        )
+                    except OSError as e:
+                        # kdu_expand is missing or can't be run
+                        raise RuntimeError(
+                            "Can't run kdu_expand on {}: {}".format(
+                                origfile, e)
+                        )
+
             try:
-                p_png = subprocess.Popen(
-                    cmd_png,
-                    stderr=subprocess.DEVNULL,
-                    stdin=p_pnm.stdout,
-                    stdout=subprocess.PIPE,
-                )
-            except subprocess.CalledProcessError as e:
+                im = Image.open(BytesIO(result.stdout))
+                im.load()
+            except (IOError, SyntaxError) as e:
                 raise RuntimeError(
-                    "Can't generate PNG: {}".format(e)
+                    "Can't read expanded image {}: {}".format(origfile, e)
                 )
+            return im
 
-            # Write the PNG from the pipeline into a file
-            # `pnmtopng` only writes to stdout
-            pngout, pngerr = p_png.communicate()
-            with open(outfile, 'wb') as fh:
-                fh.write(pngout)
-
-            if resize:
-                im = Image.open(outfile)
-                im.resize(resize)
-                im.save(outfile, 'png')
+        def components(self, origfile):
+            """
+            Read the number of colour components from the JP2 header,
+            without decoding the image. Assume colour if we can't tell.
+            """
+            try:
+                with Image.open(origfile) as im:
+                    return len(im.getbands())
+            except (IOError, SyntaxError):
+                return 3
 
     class PillowProcessor(ImageProcessor):
 
-        def crop_image(
-            self, origfile, outfile,
+        def decode(
+            self, origfile,
             discard_level=False, dim=False, pagedim=False, resize=False
         ):
             """
-            Given an image object, save a crop or the entire image.
-            Pagedim, discard_level aren't used for Pillow processing but
-            the caller doesn't know which library we use.
+            Given an image object, decode a crop or the entire image.
+            Pagedim isn't used for Pillow processing but the caller doesn't
+            know which library we use. Discard_level only applies to JP2s,
+            & `dim` is still given in full resolution pixels.
             """
 
             try:
@@ -136,29 +253,28 @@ def factory(type):
                 raise RuntimeError(
                     "Can't open image {}: {}".format(origfile, e))
 
+            if discard_level and im.format == 'JPEG2000':
+                # decode only the lower resolution levels
+                im.reduce = discard_level
+                im.load()
+                if dim:
+                    dim = [int(d / 2 ** discard_level) for d in dim]
+
             # if no specified new dimensions, use current dimensions.
             if not resize:
                 resize = im.size
 
-            if dim:
-                # if dimensions are passed, save a crop of the image
-                try:
-                    im.resize(resize).crop(dim).save(outfile)
-                except IOError as e:
-                    raise RuntimeError(
-                        "Can't crop image {} & save to {}: {}".format(
-                            origfile, outfile, e
-                        )
-                    )
-            else:
-                # save the entire image
-                try:
-                    im.resize(resize).save(outfile)
-                except IOError as e:
-                    raise RuntimeError(
-                        "Cannot create cover file: {}".format(e)
-                    )
+            try:
+                im = im.resize(resize)
+                if dim:
+                    # if dimensions are passed, decode a crop of the image
+                    im = im.crop(dim)
+            except IOError as e:
+                raise RuntimeError(
+                    "Can't decode image {}: {}".format(origfile, e)
+                )
+            return im
 
     if type == "kakadu":
-        return KakaduProcessor()
-    return PillowProcessor()
+        return KakaduProcessor(**kwargs)
+    return PillowProcessor(**kwargs)
@@ -0,0 +1,194 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import ExitStack, contextmanager
+
+import cProfile
+import json
+import os
+import threading
+import time
+
+# the calling thread's CPU time; time.thread_time is Python 3.7+
+if hasattr(time, 'thread_time'):
+    thread_time = time.thread_time
+elif hasattr(time, 'CLOCK_THREAD_CPUTIME_ID'):
+    def thread_time():
+        return time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+else:
+    thread_time = time.process_time  # the whole process's, as a last resort
+
+# held while a span is profiled: Python 3.12 allows one profiler at a time
+_profiling = threading.Lock()
+
+Span = namedtuple(
+    'Span', ['name', 'category', 'start', 'wall', 'cpu', 'thread']
+)
+
+
+class Instrumentation(object):
+    """
+    Collects where the time goes in a conversion: a span for each stage or
+    step, with its wall & CPU time, plus counters of what was done.
+
+    Spans may be recorded from several threads at once. CPU time is the
+    recording thread's own, so concurrent stages don't count each other's
+    work. If given a `profile_dir`, spans recorded with `profile=True` also
+    dump cProfile stats there, as `<name>.prof`; only one span is profiled
+    at a time, so one which starts while another is being profiled isn't,
+    & is counted as `profiles_skipped`. Given a MemoryProbe, stages also
+    record their memory high-water marks.
+    """
+
+    def __init__(self, counters=None, profile_dir=None, memory=None):
+        self.counters = Counter() if counters is None else counters
+        self.profile_dir = profile_dir
+        self.memory = memory
+        self.spans = []
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    @contextmanager
+    def span(self, name, category='stage', profile=False):
+        """ Record the time spent inside the `with` block. """
+        profiler = None
+        if profile and self.profile_dir:
+            profiler = self.start_profile()
+            if profiler is None:
+                self.count('profiles_skipped')
+        start = time.perf_counter()
+        cpu = thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            cpu = thread_time() - cpu
+            if profiler:
+                profiler.disable()
+                _profiling.release()
+                profiler.dump_stats(
+                    os.path.join(self.profile_dir, '{}.prof'.format(name))
+                )
+            with self._lock:
+                self.spans.append(Span(
+                    name, category, start - self.started, wall, cpu,
+                    threading.get_ident(),
+                ))
+
+    @staticmethod
+    def start_profile():
+        """
+        A profiler, enabled, or None if another span, or another tool, is
+        profiling already.
+        """
+        if not _profiling.acquire(blocking=False):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiling tool is already active
+            _profiling.release()
+            return None
+        return profiler
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Record a conversion stage: a profiled span, and its memory use if
+        there's a MemoryProbe.
+        """
+        with ExitStack() as stack:
+            if self.memory is not None:
+                stack.enter_context(self.memory.stage(name))
+            stack.enter_context(self.span(name, 'stage', profile=True))
+            yield
+
+    def count(self, name, n=1):
+        """ Add `n` to a counter. """
+        with self._lock:
+            self.counters[name] += n
+
+    def report(self):
+        """
+        A summary of the conversion: per category, each span name's total
+        wall & CPU seconds & number of calls, the counters, and the memory
+        report if there's a MemoryProbe.
+        """
+        categories = OrderedDict()
+        for span in sorted(self.spans, key=lambda span: span.start):
+            totals = categories.setdefault(
+                span.category, OrderedDict()
+            ).setdefault(span.name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            totals['wall'] += span.wall
+            totals['cpu'] += span.cpu
+            totals['calls'] += 1
+        end = max(
+            (span.start + span.wall for span in self.spans), default=0.0
+        )
+        report = {
+            'wall': end,
+            'spans': categories,
+            'counters': dict(self.counters),
+        }
+        if self.memory is not None:
+            report['memory'] = self.memory.report()
+        return report
+
+    def trace_events(self):
+        """
+        The spans & counters as Chrome trace events, which chrome://tracing
+        and Perfetto can display as a timeline.
+        """
+        pid = os.getpid()
+        events = [
+            {
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': round(span.start * 1e6),
+                'dur': round(span.wall * 1e6),
+                'pid': pid,
+                'tid': span.thread,
+                'args': {'cpu_ms': round(span.cpu * 1e3, 3)},
+            }
+            for span in sorted(self.spans, key=lambda span: span.start)
+        ]
+        events.append({
+            'name': 'counters',
+            'ph': 'C',
+            'ts': max((event['ts'] + event['dur'] for event in events),
+                      default=0),
+            'pid': pid,
+            'args': dict(self.counters),
+        })
+        return events
+
+    def write_report(self, path):
+        """ Write the report as JSON. """
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def write_trace(self, path):
+        """ Write the Chrome trace-event file. """
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events()}, f)
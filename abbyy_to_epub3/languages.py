@@ -0,0 +1,129 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+ISO 639 language code normalisation without loading pycountry's database,
+which takes longer than parsing a small book's metadata.
+
+`normalize_language` gives what `pycountry.languages.lookup` would, reduced
+to the 2-letter code if there is one, else the 3-letter code. Codes are
+answered from the precomputed tables in `language_codes`; anything else,
+such as a language name, falls back to pycountry itself.
+
+Regenerate the tables after upgrading pycountry:
+
+    python -m abbyy_to_epub3.languages
+"""
+
+import os
+
+from abbyy_to_epub3 import language_codes
+
+TABLE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'language_codes.py'
+)
+
+
+def normal_code(language):
+    """ The code a pycountry language is normalised to. """
+    return (
+        getattr(language, 'alpha_2', None) or
+        getattr(language, 'alpha_3', None)
+    )
+
+
+def normalize_language(code):
+    """
+    The 2-letter ISO 639-1 code for a language given as an ISO 639-1, 639-2
+    (either form) or 639-3 code, falling back to its 3-letter code if it
+    has no 2-letter one. Raises LookupError for an unknown language.
+    """
+    key = code.strip().lower()
+    if key in language_codes.NORMAL:
+        return language_codes.NORMAL[key]
+    if key in language_codes.CANONICAL:
+        return key
+    # Imported here: pycountry is slow to load, & only needed for names
+    import pycountry
+    return normal_code(pycountry.languages.lookup(code))
+
+
+def table_source():
+    """ The source of the language_codes module, from installed pycountry """
+    import pkg_resources
+    import pycountry
+
+    normal = {}
+    canonical = set()
+    for language in pycountry.languages:
+        for attribute in ('alpha_2', 'alpha_3', 'bibliographic'):
+            code = getattr(language, attribute, None)
+            if not code:
+                continue
+            # Ask lookup rather than using `language`: a few codes are
+            # also the name of another language, which lookup prefers
+            target = normal_code(pycountry.languages.lookup(code))
+            code = code.lower()
+            if code == target:
+                canonical.add(code)
+            else:
+                normal[code] = target
+
+    canonical = sorted(canonical)
+    # The license header: this module's opening comment block
+    lines = []
+    with open(__file__) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            lines.append(line.rstrip())
+    lines += [
+        '',
+        '',
+        '"""',
+        'Language codes as pycountry {} has them. Generated by'.format(
+            pkg_resources.get_distribution('pycountry').version),
+        '`python -m abbyy_to_epub3.languages`; don\'t edit by hand.',
+        '"""',
+        '',
+        '# codes normalised to a different code: mostly the alpha_3 &',
+        '# bibliographic codes of languages which have an alpha_2 code',
+        'NORMAL = {',
+    ]
+    lines += [
+        "    '{}': '{}',".format(code, target)
+        for (code, target) in sorted(normal.items())
+    ]
+    lines += [
+        '}',
+        '',
+        '# codes which are already normal: alpha_2 codes, & the alpha_3 codes',
+        '# of languages without one',
+        'CANONICAL = frozenset("""',
+    ]
+    lines += [
+        ' '.join(canonical[i:i + 18]) for i in range(0, len(canonical), 18)
+    ]
+    lines += ['""".split())', '']
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    with open(TABLE_FILE, 'w') as f:
+        f.write(table_source())
@@ -0,0 +1,295 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from contextlib import contextmanager
+
+import logging
+import os
+import resource
+import sys
+import threading
+import tracemalloc
+
+
+def current_rss():
+    """
+    This process's resident set size now, in bytes; None where
+    /proc/self/statm isn't available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def peak_rss():
+    """
+    The highest resident set size of this process so far, in bytes. Linux
+    reports ru_maxrss in KiB, macOS in bytes.
+    """
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class MemoryProbe(object):
+    """
+    Records the memory high-water mark of each stage of a conversion.
+
+    While started, a background thread samples the resident set size every
+    `interval` seconds, and each sample raises the peak of every stage
+    running at the time. Since stages can overlap, a stage's peak is the
+    process's peak while it ran, not its own allocations. The process's
+    own high-water mark (ru_maxrss) is also read at each stage boundary,
+    so peaks between samples aren't missed overall.
+
+    With `tracemalloc_top`, tracemalloc runs too, and the largest live
+    allocations by source line are listed at the end of each stage. This
+    slows the conversion considerably.
+
+    A non-zero `budget`, in bytes, is the peak the conversion should stay
+    within; `over_budget` says if it didn't. The MemoryPlan chosen to stay
+    within it, if any, is kept as `plan`, to report with the peaks.
+    """
+
+    def __init__(self, interval=0.05, tracemalloc_top=0, budget=0,
+                 debug=False):
+        self.logger = logging.getLogger(__name__)
+        if debug:
+            self.logger.addHandler(logging.StreamHandler())
+            self.logger.setLevel(logging.DEBUG)
+
+        self.interval = interval
+        self.tracemalloc_top = tracemalloc_top
+        self.budget = budget
+        self.stages = {}     # stage name: its memory record
+        self.peak = 0        # highest RSS seen, in bytes
+        self._running = {}   # stage name: highest RSS sampled while running
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._tracing = False   # we started tracemalloc, so must stop it
+        self.plan = None
+
+    def start(self):
+        """ Start sampling, and tracemalloc if asked for. """
+        if self.tracemalloc_top and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        self._stop.clear()
+        self._sampler = threading.Thread(
+            target=self._sample_loop, name='memory-probe', daemon=True
+        )
+        self._sampler.start()
+
+    def stop(self):
+        """ Stop sampling, and take a last reading. """
+        if self._sampler:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        self.peak = max(self.peak, peak_rss())
+
+    def sample(self):
+        """ Take one RSS reading, raising the running stages' peaks. """
+        rss = current_rss() or 0
+        with self._lock:
+            self.peak = max(self.peak, rss)
+            for name, peak in self._running.items():
+                self._running[name] = max(peak, rss)
+        return rss
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def top_allocations(self):
+        """ The largest live allocations by source line, largest first. """
+        if not tracemalloc.is_tracing():
+            return []
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        return [
+            {
+                'where': '{}:{}'.format(
+                    stat.traceback[0].filename, stat.traceback[0].lineno),
+                'size': stat.size,
+                'count': stat.count,
+            }
+            for stat in snapshot.statistics('lineno')[:self.tracemalloc_top]
+        ]
+
+    @contextmanager
+    def stage(self, name):
+        """ Record the memory high-water mark inside the `with` block. """
+        start = self.sample()
+        with self._lock:
+            self._running[name] = start
+        try:
+            yield
+        finally:
+            end = self.sample()
+            with self._lock:
+                sampled = self._running.pop(name)
+            record = {
+                'rss_start': start,
+                'rss_end': end,
+                'rss_peak': sampled,
+                'maxrss': peak_rss(),
+            }
+            if self.tracemalloc_top:
+                record['top_allocations'] = self.top_allocations()
+            self.stages[name] = record
+            self.peak = max(self.peak, record['maxrss'])
+            self.logger.debug(
+                "Memory after {}: {:.1f} MB, peak {:.1f} MB".format(
+                    name, end / 2 ** 20, sampled / 2 ** 20))
+
+    def over_budget(self):
+        """ True if there's a budget and the peak RSS went over it. """
+        return bool(self.budget) and self.peak > self.budget
+
+    def report(self):
+        """ Peak RSS overall & per stage, in bytes, and the budget check. """
+        report = {
+            'peak_rss': self.peak,
+            'budget': self.budget,
+            'over_budget': self.over_budget(),
+            'stages': self.stages,
+        }
+        if self.plan:
+            report['plan'] = self.plan.report()
+        return report
+
+    def summary(self):
+        """ Human-readable per-stage peaks, in MB. """
+        lines = ["Peak memory (MB):"]
+        for name, record in self.stages.items():
+            lines.append("  {:<12} {:8.1f}".format(
+                name, record['rss_peak'] / 2 ** 20))
+        lines.append("  {:<12} {:8.1f}".format('overall', self.peak / 2 ** 20))
+        if self.plan:
+            lines.append("  {:<12} {:8.1f}".format(
+                'estimated', self.plan.peak() / 2 ** 20))
+        if self.budget:
+            lines.append("  {:<12} {:8.1f}{}".format(
+                'budget', self.budget / 2 ** 20,
+                '  EXCEEDED' if self.over_budget() else ''))
+        return '\n'.join(lines)
+
+
+class MemoryPlan(object):
+    """
+    How to run a conversion so it stays within a memory budget, chosen
+    before it starts from an estimate of what it needs.
+
+    The estimate, in bytes, is made from the sizes of the inputs by the
+    caller, in parts:
+
+    - base: the process before it reads anything
+    - blocks: the parsed ABBYY & the book's text, held to the end
+    - decode: one page image, decoded & cropped
+    - images: the encoded images, held until the EPUB is written
+    - scratch: the unpacked inputs, which take memory on tmpfs
+
+    The decodes of one conversion run one at a time, so only one counts.
+    Starting from the fastest way, each choice below is given up, in
+    turn, while the estimated peak is over the budget:
+
+    - the workspace, if `auto`: tmpfs, rather than disk
+    - encoded images are held in memory, rather than spilled to the
+      workspace until the EPUB is written
+
+    The blocks are always held, so a budget can be too small for any plan;
+    `fits` says so, & `reasons` explain each choice.
+    """
+
+    def __init__(self, estimate, budget, workspace='auto'):
+        self.estimate = estimate
+        self.budget = budget
+        self.workspace = 'tmpfs' if workspace == 'auto' else workspace
+        self.spill_images = False
+        self.reasons = []
+
+        if workspace != 'auto':
+            self.reasons.append(
+                "workspace on {}, as configured".format(workspace))
+        elif self.fits():
+            self.reasons.append(
+                "workspace on tmpfs: the estimated peak of {} with the "
+                "inputs unpacked in memory is within the budget of {}".format(
+                    megabytes(self.peak()), megabytes(budget)))
+        else:
+            over = self.peak()
+            self.workspace = 'disk'
+            self.reasons.append(
+                "workspace on disk: the estimated peak of {} with {} of "
+                "inputs unpacked in memory is over the budget of {}".format(
+                    megabytes(over), megabytes(estimate['scratch']),
+                    megabytes(budget)))
+        if not self.fits() and estimate['images']:
+            over = self.peak()
+            self.spill_images = True
+            self.reasons.append(
+                "spilling encoded images to the workspace: holding {} of "
+                "them takes the estimated peak to {}, over the budget of "
+                "{}".format(
+                    megabytes(estimate['images']), megabytes(over),
+                    megabytes(budget)))
+        if not self.fits():
+            self.reasons.append(
+                "the estimated peak of {} is still over the budget of {}: "
+                "the parsed ABBYY & a page decode are always held".format(
+                    megabytes(self.peak()), megabytes(budget)))
+
+    def peak(self):
+        """ The estimated peak, in bytes, of the chosen plan """
+        peak = (
+            self.estimate['base'] + self.estimate['blocks'] +
+            self.estimate['decode']
+        )
+        if self.workspace == 'tmpfs':
+            peak += self.estimate['scratch']
+        if not self.spill_images:
+            peak += self.estimate['images']
+        return peak
+
+    def fits(self):
+        """ True if the estimated peak is within the budget """
+        return self.peak() <= self.budget
+
+    def report(self):
+        """ The estimate, the choices & why they were made """
+        return {
+            'estimate': self.estimate,
+            'peak': self.peak(),
+            'workspace': self.workspace,
+            'spill_images': self.spill_images,
+            'reasons': self.reasons,
+        }
+
+
+def megabytes(nbytes):
+    return "{:.0f} MB".format(nbytes / 2 ** 20)
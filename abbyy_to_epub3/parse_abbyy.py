@@ -16,15 +16,19 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from contextlib import contextmanager
 from ebooklib import utils as ebooklibutils
 from lxml import etree
 
 import gc
+import gzip
 import logging
-import pycountry
 import re
 
 from abbyy_to_epub3 import constants
+from abbyy_to_epub3.geometry import BoxIndex, block_box
+from abbyy_to_epub3.instrumentation import Instrumentation
+from abbyy_to_epub3.languages import normalize_language
 from abbyy_to_epub3.utils import fast_iter, gettext, sanitize_xml
 
 
@@ -149,7 +153,7 @@ class AbbyyParser(object):
 
     def __init__(
         self, document, metadata_file, metadata,
-        paragraphs, blocks, debug=False
+        paragraphs, blocks, debug=False, instrumentation=None,
     ):
         self.logger = logging.getLogger(__name__)
         if debug:
@@ -162,6 +166,8 @@ class AbbyyParser(object):
         self.paragraphs = paragraphs
         self.blocks = blocks
         self.page_no = 0
+        # records the time each pass over the ABBYY takes
+        self.instrumentation = instrumentation or Instrumentation()
 
         # Save page numbers only if using a supporting version of ebooklib
         if 'create_pagebreak' in dir(ebooklibutils):
@@ -176,32 +182,47 @@ class AbbyyParser(object):
         else:
             return False
 
+    @contextmanager
+    def source(self):
+        """
+        The document, for one pass of iterparse. A gzipped ABBYY (`.gz`) is
+        decompressed as it's read, rather than unpacked first.
+        """
+        if self.document.endswith('.gz'):
+            with gzip.open(self.document, 'rb') as f:
+                yield f
+        else:
+            yield self.document
+
     def find_namespace(self):
         """
         find the namespace of an XML document. Assumes that the namespace of
         the first element in the context is the namespace we need. This is more
         memory-efficient then parsing the entire tree to get the root node.
         """
-        context = etree.iterparse(self.document, events=('start',),)
-        for event, elem in context:
-            # Namespace depends on finereader version.
-            # We can parse FR6 schema, a little
-            if not self.version:
-                abbyy_nsm = elem.nsmap
-                if constants.ABBYY_NS in abbyy_nsm.values():
-                    self.nsm = constants.ABBYY_NSM
-                    self.ns = constants.ABBYY_NS
-                    self.version = "FR10"
-                elif constants.OLD_NS in abbyy_nsm.values():
-                    self.nsm = constants.OLD_NSM
-                    self.ns = constants.OLD_NS
-                    self.version = "FR6"
+        with self.source() as document:
+            context = etree.iterparse(document, events=('start',),)
+            for event, elem in context:
+                # Namespace depends on finereader version.
+                # We can parse FR6 schema, a little
+                if not self.version:
+                    abbyy_nsm = elem.nsmap
+                    if constants.ABBYY_NS in abbyy_nsm.values():
+                        self.nsm = constants.ABBYY_NSM
+                        self.ns = constants.ABBYY_NS
+                        self.version = "FR10"
+                    elif constants.OLD_NS in abbyy_nsm.values():
+                        self.nsm = constants.OLD_NSM
+                        self.ns = constants.OLD_NS
+                        self.version = "FR6"
+                    else:
+                        raise RuntimeError(
+                            "Input XML not in a supported schema.")
+                    self.logger.debug(
+                        "FineReader Version {}".format(self.version))
+                    self.metadata['fr-version'] = self.version
                 else:
-                    raise RuntimeError("Input XML not in a supported schema.")
-                self.logger.debug("FineReader Version {}".format(self.version))
-                self.metadata['fr-version'] = self.version
-            else:
-                return
+                    return
 
     def parse_metadata(self):
         """
@@ -226,11 +247,7 @@ class AbbyyParser(object):
         else:
             lang_code = self.metadata['language'][0]
             try:
-                lang = pycountry.languages.lookup(lang_code)
-                self.metadata['language'][0] = (
-                    getattr(lang, 'alpha_2', None) or
-                    getattr(lang, 'alpha_3', None)
-                )
+                self.metadata['language'][0] = normalize_language(lang_code)
             except LookupError:
                 self.logger.debug(
                     "Invalid language code {}. Setting to English".format(
@@ -239,11 +256,12 @@ class AbbyyParser(object):
                 )
                 self.metadata['language'][0] = 'en'
 
-    def parse_abbyy(self):
+    def parse_abbyy(self, with_metadata=True):
         """
         Parse the ABBYY into a format useful for `create_epub`. Process the
         the elements we will need to construct the EPUB: `paragraphStyle`,
-        `fontStyle`, and `page`.  We traverse the entire tree twice with
+        `fontStyle`, and `page`. Unless with_metadata is False, the metadata
+        file is parsed too.  We traverse the entire tree twice with
         `iterparse`, because lxml builds the whole node tree in memory for even
         tag-selective `iterparse`, & if we don't traverse the whole tree, we
         can't delete the unowned nodes. `fast_iter` makes the process speedy,
@@ -253,7 +271,8 @@ class AbbyyParser(object):
         """
 
         # some basic initialization
-        self.metadata['pics_by_page'] = dict()
+        self.metadata['pics_by_page'] = BoxIndex()
+        self.metadata['text_by_page'] = BoxIndex()
         self.fontStyles = dict()
         self.pages = []
 
@@ -265,13 +284,15 @@ class AbbyyParser(object):
 
         self.logger.debug("Beginning iterparse")
         # paragraphStyle is a prerequisite for page
-        context = etree.iterparse(
-            self.document,
-            events=('end',),
-        )
-        self.logger.debug("fast_iter on process_styles")
-        fast_iter(context, self.process_styles)
-        del context
+        with self.source() as document:
+            context = etree.iterparse(
+                document,
+                events=('end',),
+            )
+            self.logger.debug("fast_iter on process_styles")
+            with self.instrumentation.span('styles', 'parse'):
+                fast_iter(context, self.process_styles)
+            del context
 
         # Because of the processing order of XML events, it's efficient
         # to collect para and font styles upfront & collate it after.
@@ -285,19 +306,23 @@ class AbbyyParser(object):
                     ]
 
         # parse the metadata document next
-        self.logger.debug("parse_metadata")
-        self.parse_metadata()
+        if with_metadata:
+            self.logger.debug("parse_metadata")
+            with self.instrumentation.span('metadata', 'parse'):
+                self.parse_metadata()
 
         # finally, extract the individual page elements from the XML
         self.logger.debug("Beginning iterparse on pages")
-        context = etree.iterparse(
-            self.document,
-            events=('end',),
-            tag="{{{}}}page".format(self.ns),
-        )
-        self.logger.debug("fast_iter on process_pages")
-        fast_iter(context, self.process_pages)
-        del context
+        with self.source() as document:
+            context = etree.iterparse(
+                document,
+                events=('end',),
+                tag="{{{}}}page".format(self.ns),
+            )
+            self.logger.debug("fast_iter on process_pages")
+            with self.instrumentation.span('pages', 'parse'):
+                fast_iter(context, self.process_pages)
+            del context
 
         # if we don't clear the list, the page elements will stick around
         # even after the list's scope has vanished, leaking memory
@@ -368,9 +393,21 @@ class AbbyyParser(object):
 
     def parse_block(self, block):
         """ Parse a single block on the page.  """
-        blockattr = block.attrib
+        # A plain copy: the element is cleared once parsed
+        blockattr = dict(block.attrib)
         blockattr['pagewidth'] = self.pagewidth
         blockattr['pageheight'] = self.pageheight
+        if (
+            self.is_block_type(blockattr, "Text") or
+            self.is_block_type(blockattr, "Table")
+        ):
+            # Remember where the text is, to spot pictures covering text
+            try:
+                self.metadata['text_by_page'].add(
+                    self.page_no, block_box({'style': blockattr})
+                )
+            except (KeyError, ValueError):
+                self.logger.debug("Text block without coordinates")
         if self.is_block_type(blockattr, "Text"):
             paras = block.iterdescendants(
                 tag="{{{}}}par".format(self.ns)
@@ -545,12 +582,11 @@ class AbbyyParser(object):
             }
             self.blocks.append(d)
 
-            # If this is an image, add it to a dict of all images
-            # by page number, so we can strip out overlapping images
+            # If this is an image, add its rectangle to the per-page index
+            # of all images, so we can strip out overlapping images
             if self.is_block_type(blockattr, "Picture"):
-                if self.page_no in self.metadata['pics_by_page']:
-                    self.metadata['pics_by_page'].append(d)
-                else:
-                    self.metadata['pics_by_page'] = [d, ]
+                d['pic_id'] = self.metadata['pics_by_page'].add(
+                    self.page_no, block_box(d)
+                )
 
             d = dict()
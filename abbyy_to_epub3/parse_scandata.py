@@ -16,10 +16,108 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from array import array
+from collections.abc import Mapping
 from lxml import etree
 
 import logging
 
+import numpy as np
+
+from abbyy_to_epub3.constants import skippable_pages
+
+# the page types a cover is taken from, in the order get_cover_leaf wants
+COVER_TYPES = ['cover', 'title', 'normal']
+
+
+class PageTable(Mapping):
+    """
+    A book's pages from its scandata, kept in arrays: for each leaf, its
+    page type, whether it's skipped, its original width & height, and its
+    crop box (x, y, w, h); -1 where scandata doesn't say. A leaf's row is
+    found by indexing an array with the leaf number, so every lookup
+    takes the same time however long the book.
+
+    As a mapping, it gives each leaf's page type, lowercased, in scandata
+    order, or `skippable` for a leaf not added to access formats, as the
+    dict of pages it replaces did. A leaf is skipped if it's skippable or
+    one of the `skippable_pages` types.
+    """
+
+    def __init__(
+        self, leaves=(), pagetypes=(), access=(), sizes=(), crops=(),
+    ):
+        self.types = sorted(set(pagetypes))  # the page type of each code
+        self.leaves = np.array(leaves, dtype=np.int32)
+        self.codes = np.array(
+            [self.types.index(pagetype) for pagetype in pagetypes],
+            dtype=np.int16,
+        )
+        self.access = np.array(access, dtype=bool)
+        self.skipped = ~self.access | np.isin(
+            self.codes,
+            [self.types.index(t) for t in skippable_pages if t in self.types],
+        )
+        self.sizes = np.array(sizes, dtype=np.int32).reshape(-1, 2)
+        self.crops = np.array(crops, dtype=np.int32).reshape(-1, 4)
+        # the row of each leaf number, -1 for a leaf that isn't there
+        self.rows = np.full(
+            self.leaves.max() + 1 if len(self.leaves) else 0, -1,
+            dtype=np.int32,
+        )
+        # a leaf listed twice keeps its last entry, as a dict would
+        self.rows[self.leaves] = np.arange(len(self.leaves), dtype=np.int32)
+
+    def row(self, leaf):
+        """ The row of a leaf in the arrays; KeyError if it isn't there """
+        if isinstance(leaf, (int, np.integer)) and 0 <= leaf < len(self.rows):
+            row = self.rows[leaf]
+            if row >= 0:
+                return row
+        raise KeyError(leaf)
+
+    def __getitem__(self, leaf):
+        row = self.row(leaf)
+        if not self.access[row]:
+            return 'skippable'
+        return self.types[self.codes[row]]
+
+    def __iter__(self):
+        for (row, leaf) in enumerate(self.leaves):
+            if self.rows[leaf] == row:
+                yield int(leaf)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.rows >= 0))
+
+    def is_skipped(self, leaf):
+        """ If the leaf's blocks are left out; leaves not listed aren't """
+        try:
+            return bool(self.skipped[self.row(leaf)])
+        except KeyError:
+            return False
+
+    def dimensions(self, leaf):
+        """ The leaf's original (width, height), or None if unknown """
+        size = self.sizes[self.row(leaf)]
+        return None if size.min() < 0 else tuple(int(n) for n in size)
+
+    def crop_box(self, leaf):
+        """ The leaf's crop box (x, y, w, h), or None if unknown """
+        crop = self.crops[self.row(leaf)]
+        return None if crop.min() < 0 else tuple(int(n) for n in crop)
+
+    def cover_leaf(self):
+        """
+        The first leaf, added to access formats, which is the cover, a
+        title page or a normal page; None if there's none.
+        """
+        codes = [self.types.index(t) for t in COVER_TYPES if t in self.types]
+        rows = np.flatnonzero(np.isin(self.codes, codes) & self.access)
+        # only rows still holding their leaf, for leaves listed twice
+        rows = [row for row in rows if self.rows[self.leaves[row]] == row]
+        return int(self.leaves[rows[0]]) if rows else None
+
 
 class ScandataParser(object):
     """
@@ -28,28 +126,65 @@ class ScandataParser(object):
 
     """
 
-    def __init__(self, scandata, pages, debug=False):
+    def __init__(self, scandata, debug=False):
         self.logger = logging.getLogger(__name__)
         if debug:
             self.logger.addHandler(logging.StreamHandler())
             self.logger.setLevel(logging.DEBUG)
 
-        self.pages = pages
         self.document = scandata
 
     def parse_scandata(self):
-        """ read the scandata file into an lxml etree """
-        self.tree = etree.parse(self.document)
-
-        pagelist = self.tree.findall("./pageData/page")
-        for page in pagelist:
-            num = page.get('leafNum')
-            # In case contributors use inconsistent case, lowercase pageType
-            pagetype = page.find('pageType').text.lower()
-            # Instead of complicating the data structure and adding extra logic
-            # on each block, just use a custom pagetype for anything where
-            # "addToAccessFormats" is set to false.
-            access_formats = page.find('addToAccessFormats').text.lower()
-            if access_formats == 'false':
-                pagetype = "skippable"
-            self.pages[int(num)] = pagetype
+        """
+        Read the scandata file into a PageTable, a page at a time, without
+        building the whole tree.
+        """
+        self.leaves = array('i')
+        self.pagetypes = []
+        self.access = array('b')
+        self.sizes = array('i')    # width & height of each page in turn
+        self.crops = array('i')    # x, y, w & h of each page in turn
+        self.types = {}    # so pages of a type share one string
+        context = etree.iterparse(
+            self.document, events=('end',), tag='page',
+        )
+        for event, page in context:
+            parent = page.getparent()
+            if parent is not None and parent.tag == 'pageData':
+                self.process_page(page)
+            # pages are flat in pageData, so drop each once it's read
+            page.clear()
+            while page.getprevious() is not None:
+                del parent[0]
+        del context
+        return PageTable(
+            self.leaves, self.pagetypes, self.access, self.sizes, self.crops,
+        )
+
+    def process_page(self, page):
+        """ Record a `page` element of `pageData` """
+        fields = {child.tag: child.text for child in page}
+        crop = page.find('cropBox')
+        if crop is not None:
+            fields.update((child.tag, child.text) for child in crop)
+        self.leaves.append(int(page.get('leafNum')))
+        # In case contributors use inconsistent case, lowercase pageType
+        pagetype = (fields.get('pageType') or '').lower()
+        self.pagetypes.append(self.types.setdefault(pagetype, pagetype))
+        self.access.append(
+            (fields.get('addToAccessFormats') or '').lower() != 'false'
+        )
+        self.sizes.extend(
+            number(fields.get(name)) for name in ('origWidth', 'origHeight')
+        )
+        self.crops.extend(
+            number(fields.get(name)) for name in ('x', 'y', 'w', 'h')
+        )
+
+
+def number(text):
+    """ A whole number from scandata, or -1 if there isn't one """
+    try:
+        return int(float(text))
+    except (TypeError, ValueError):
+        return -1
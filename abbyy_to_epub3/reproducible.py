@@ -0,0 +1,126 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Reproducible EPUBs: the same book, from the same inputs, written to the same
+bytes, so they can be deduplicated by a hash of their content.
+"""
+
+from datetime import datetime, timezone
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+from ebooklib import epub
+
+import hashlib
+import os
+
+CHUNK = 2 ** 20  # bytes hashed at a time
+ZIP_EPOCH = datetime(1980, 1, 1, tzinfo=timezone.utc)  # the earliest zip date
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def source_date(default):
+    """
+    The date reproducible EPUBs are given, in UTC: SOURCE_DATE_EPOCH, as
+    the reproducible-builds convention has it, if that's set, else default,
+    as YYYY-MM-DDTHH:MM:SS in UTC. Never before the earliest date a zip can
+    hold.
+    """
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if epoch:
+        date = datetime.fromtimestamp(int(epoch), timezone.utc)
+    else:
+        date = datetime.strptime(default, DATE_FORMAT).replace(
+            tzinfo=timezone.utc)
+    return max(date, ZIP_EPOCH)
+
+
+class FixedZipFile(ZipFile):
+    """
+    A zip whose entries are stamped with one date & the same permissions,
+    whenever & wherever they're written. They're deflated at zlib's default
+    level, which is fixed.
+    """
+
+    def __init__(self, file, date):
+        super(FixedZipFile, self).__init__(file, 'w', ZIP_DEFLATED)
+        self.date_time = date.timetuple()[:6]
+
+    def writestr(self, zinfo_or_arcname, data, compress_type=None):
+        if isinstance(zinfo_or_arcname, ZipInfo):
+            zinfo = zinfo_or_arcname
+        else:
+            zinfo = ZipInfo(zinfo_or_arcname, date_time=self.date_time)
+            zinfo.compress_type = self.compression
+        zinfo.create_system = 3  # unix, rather than whatever we run on
+        zinfo.external_attr = 0o100644 << 16  # a regular file, rw-r--r--
+        super(FixedZipFile, self).writestr(
+            zinfo, data, compress_type=compress_type,
+        )
+
+
+class ReproducibleEpubWriter(epub.EpubWriter):
+    """
+    Writes an EpubBook as ebooklib does, but reproducibly: every entry, &
+    the book's modified date, get the one date, the entries after the
+    mimetype & OPF are written in order of name rather than of how the book
+    was put together, & they're compressed at a fixed level.
+    """
+
+    def __init__(self, name, book, date, options=None):
+        options = dict(options or {}, mtime=date)
+        super(ReproducibleEpubWriter, self).__init__(name, book, options)
+        self.date = date
+
+    def _write_items(self):
+        items = self.book.items
+        self.book.items = sorted(items, key=lambda item: item.file_name)
+        try:
+            super(ReproducibleEpubWriter, self)._write_items()
+        finally:
+            self.book.items = items
+
+    def write(self):
+        self.out = FixedZipFile(self.file_name, self.date)
+        with self.out:
+            self.out.writestr('mimetype', 'application/epub+zip',
+                              compress_type=ZIP_STORED)
+            self._write_container()
+            self._write_opf()
+            self._write_items()
+
+
+def content_hash(path):
+    """ The SHA-256 of a file, as hex """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_hash_file(path, digest):
+    """
+    Write a file's hash beside it, as path.sha256, in the format of
+    sha256sum so `sha256sum -c` can check it. Returns the hash file's path.
+    """
+    hash_file = '{}.sha256'.format(path)
+    with open(hash_file, 'w') as f:
+        f.write('{}  {}\n'.format(digest, os.path.basename(path)))
+    return hash_file
@@ -0,0 +1,403 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+A long-running conversion service: a small HTTP API, on localhost or a Unix
+socket, in front of a pool of worker processes which have the conversion
+machinery imported & the image tools probed before the first request.
+
+    POST /convert  {"item_dir": ..., "item_identifier": ...,
+                    "item_bookpath": ...}
+    GET  /health
+    GET  /metrics
+
+A conversion request waits for its book & answers with the result line
+`batch.convert_item` gives: 200 if the book converted, 500 if not. Requests
+for a book already being converted wait for that conversion rather than
+starting another. Once QUEUE_SIZE books are waiting or being converted,
+further books are turned away with 503 & a Retry-After header. A book whose
+worker dies, or which overruns BOOK_TIMEOUT, fails, & /health reports the
+service as degraded from then on.
+"""
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import Pool
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+import itertools
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+from abbyy_to_epub3.batch import (
+    MANIFEST_FIELDS, TaskWatch, book_workdir, convert_item,
+    init_worker as init_batch_worker, watched,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceBusy(Exception):
+    """ The queue of conversions is full. """
+
+
+def warm_up():
+    """ Import the conversion machinery & probe the image tools. """
+    from abbyy_to_epub3.create_epub import choose_image_backend
+    choose_image_backend()
+
+
+def init_worker(started=None):
+    """
+    Warm up each worker before it's given a book, & have it record the books
+    it takes on the service's TaskWatch queue. Workers leave Ctrl-C to the
+    service, which lets the books underway finish.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_batch_worker(started=started)
+    warm_up()
+
+
+class Conversion(object):
+    """ One book's conversion, which any number of requests may wait on. """
+
+    def __init__(self, job):
+        self.job = job
+        self.done = threading.Event()
+        self.result = None
+        self.waiters = 1
+
+    def wait(self, timeout=None):
+        """ The result, or None if it isn't ready within timeout seconds """
+        self.done.wait(timeout)
+        return self.result
+
+
+class ConversionService(object):
+    """
+    Converts books on a pool of warm worker processes, each replaced after
+    `books_per_worker` books. At most `queue_size` books may be waiting or
+    being converted at once; `submit` raises ServiceBusy beyond that.
+    `convert` is run in the workers on (job, out_dir, tmpdir, options).
+    Given a workdir, each book is converted with checkpoints in its own
+    directory there, so a request for a book whose conversion died resumes
+    it.
+
+    A watchdog fails a book whose worker process dies, which the pool never
+    answers for, & one still converting after `book_timeout` seconds, if
+    that's set, freeing its place in the queue; a stuck book's worker is
+    killed, for the pool to replace, so the queue only ever holds as much
+    work as the workers are doing. Such books are counted as `lost`.
+    """
+    WATCH_INTERVAL = 0.5  # seconds between the watchdog's looks
+
+    def __init__(
+        self, out_dir='.', tmpdir=None, workers=None, books_per_worker=None,
+        queue_size=16, options=None, convert=convert_item, debug=False,
+        workdir=None, book_timeout=0,
+    ):
+        self.logger = logging.getLogger(__name__)
+        if debug:
+            self.logger.addHandler(logging.StreamHandler())
+            self.logger.setLevel(logging.DEBUG)
+
+        self.out_dir = out_dir
+        self.tmpdir = tmpdir
+        self.workers = workers or os.cpu_count() or 1
+        self.books_per_worker = books_per_worker or None
+        self.queue_size = queue_size
+        self.options = dict(options or {})
+        self.convert = convert
+        self.workdir = workdir
+        self.pool = None
+        self.lock = threading.Lock()
+        self.pending = {}         # book key: Conversion, queued or running
+        self.book_timeout = book_timeout
+        self.watch = None         # TaskWatch of the books given to the pool
+        self.tasks = {}           # task id: how to fail it, if it's lost
+        self.task_ids = itertools.count()
+        self.watchdog = None
+        self.stats = Counter()    # requests, outcomes & seconds converting
+        self.started = None
+
+    def start(self):
+        """ Start the workers; imports & probes run in each straight away """
+        os.makedirs(self.out_dir, exist_ok=True)
+        # Done before forking too, so forked workers start warm
+        warm_up()
+        self.watch = TaskWatch(self.book_timeout)
+        self.pool = Pool(
+            processes=self.workers, initializer=init_worker,
+            initargs=(self.watch.queue, ),
+            maxtasksperchild=self.books_per_worker,
+        )
+        self.started = time.time()
+        self.watchdog = threading.Thread(target=self.watch_tasks, daemon=True)
+        self.watchdog.start()
+
+    def close(self):
+        """ Stop taking books, & wait for those underway to finish. """
+        if self.pool is not None:
+            pool = self.pool
+            pool.close()
+            # the watchdog carries on, failing lost books, until all are done
+            while self.pending:
+                time.sleep(self.WATCH_INTERVAL)
+            self.pool = None
+            pool.terminate()    # leaving overrunning books
+            pool.join()
+            self.watchdog.join()
+
+    def watch_tasks(self):
+        """ Fail the books lost by the pool, while it's running """
+        while self.pool is not None:
+            with self.lock:
+                lost = self.watch.lost(list(self.tasks))
+                failing = [
+                    (self.tasks[task_id], why) for (task_id, why) in lost
+                ]
+            for (fail, why) in failing:
+                self.logger.warning("Lost a conversion: {}".format(why))
+                fail(why, lost=True)
+            time.sleep(self.WATCH_INTERVAL)
+
+    @staticmethod
+    def book_key(job):
+        return (
+            os.path.abspath(job['item_dir']),
+            job['item_identifier'],
+            job['item_bookpath'],
+        )
+
+    def epub_path(self, job):
+        """
+        Where a book's EPUB goes: in a directory for its item, so books of
+        different items with the same bookpath don't overwrite each other.
+        """
+        return os.path.join(
+            self.out_dir, job['item_identifier'],
+            '{}.epub'.format(os.path.basename(job['item_bookpath'])),
+        )
+
+    def submit(self, job):
+        """
+        The Conversion of a book: the one underway if the book is already
+        being converted, else a new one. Raises ServiceBusy if the queue is
+        full, & ValueError if the item's identifier isn't a plain name.
+        """
+        identifier = job['item_identifier']
+        if identifier in ('.', '..') or os.sep in identifier:
+            raise ValueError("invalid item_identifier")
+        key = self.book_key(job)
+        with self.lock:
+            self.stats['requests'] += 1
+            conversion = self.pending.get(key)
+            if conversion is not None:
+                self.stats['coalesced'] += 1
+                conversion.waiters += 1
+                return conversion
+            if len(self.pending) >= self.queue_size:
+                self.stats['rejected'] += 1
+                raise ServiceBusy(
+                    "{} books already queued".format(len(self.pending))
+                )
+            conversion = Conversion(job)
+            self.pending[key] = conversion
+            task_id = next(self.task_ids)
+        job = dict(
+            job, workdir=book_workdir(job, self.workdir),
+            out=self.epub_path(job),
+        )
+        os.makedirs(os.path.dirname(job['out']), exist_ok=True)
+
+        def finished(result, lost=False):
+            with self.lock:
+                if self.tasks.pop(task_id, None) is None:
+                    return    # failed already, as lost
+                self.watch.forget(task_id)
+                del self.pending[key]
+                if lost:
+                    self.stats['lost'] += 1
+                self.stats[result['status']] += 1
+                self.stats['converting_seconds'] += result.get('seconds', 0)
+            conversion.result = result
+            conversion.done.set()
+            self.logger.debug("{}: {} for {} request(s)".format(
+                job['item_bookpath'], result['status'], conversion.waiters))
+
+        def failed(error, lost=False):
+            # convert_item reports failures itself; this is the pool failing,
+            # or the watchdog giving up on the book
+            result = dict(job)
+            result.update({
+                'status': 'failed',
+                'exit_code': 1,
+                'error': error if lost else '{}: {}'.format(
+                    type(error).__name__, error),
+            })
+            finished(result, lost=lost)
+
+        with self.lock:
+            self.tasks[task_id] = failed
+        self.pool.apply_async(
+            watched,
+            (self.convert, task_id,
+             (job, self.out_dir, self.tmpdir, self.options)),
+            callback=finished, error_callback=failed,
+        )
+        return conversion
+
+    def health(self):
+        """
+        `ok`, `down` if the workers are stopped, or `degraded` if books have
+        been lost, to dead workers or the timeout, since it started.
+        """
+        with self.lock:
+            lost = self.stats['lost']
+        if self.pool is None:
+            return {'status': 'down'}
+        if lost:
+            return {'status': 'degraded', 'lost': lost}
+        return {'status': 'ok'}
+
+    def metrics(self):
+        """ Counts of requests & their outcomes, and the queue's state. """
+        with self.lock:
+            metrics = dict(self.stats)
+            metrics.update({
+                'pending': len(self.pending),
+                'queue_size': self.queue_size,
+                'workers': self.workers,
+                'uptime': time.time() - self.started if self.started else 0,
+            })
+        return metrics
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """ The HTTP API; the server's `service` does the work. """
+
+    # seconds before a Retry-After, when the queue is full
+    RETRY_AFTER = 30
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/health':
+            health = service.health()
+            self.send_json(
+                503 if health['status'] == 'down' else 200, health
+            )
+        elif self.path == '/metrics':
+            self.send_json(200, service.metrics())
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/convert':
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError("expected a JSON object")
+        except ValueError as e:
+            self.send_json(400, {'error': 'invalid JSON: {}'.format(e)})
+            return
+        # Where the EPUB goes is the service's business, not the client's
+        job = {
+            key: request[key] for key in MANIFEST_FIELDS if request.get(key)
+        }
+        job.setdefault('item_bookpath', job.get('item_identifier'))
+        missing = [key for key in MANIFEST_FIELDS if not job.get(key)]
+        if missing:
+            self.send_json(400, {'error': 'missing ' + ', '.join(missing)})
+            return
+
+        try:
+            conversion = self.server.service.submit(job)
+        except ServiceBusy as e:
+            self.send_json(
+                503, {'error': str(e)},
+                headers=[('Retry-After', str(self.RETRY_AFTER))],
+            )
+            return
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        result = conversion.wait(self.server.timeout_seconds)
+        if result is None:
+            self.send_json(504, {'error': 'still converting'})
+        else:
+            self.send_json(200 if result['status'] == 'ok' else 500, result)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s" % (self.address_string(), format % args))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # Replace a socket left behind by a previous run
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        UnixStreamServer.server_bind(self)
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def make_server(service, host='127.0.0.1', port=0, socket_path=None,
+                timeout=None):
+    """
+    An HTTP server for the service, on a Unix socket if socket_path is
+    given, else on host & port. Requests wait up to `timeout` seconds for
+    their book, then get a 504 while it carries on converting.
+    """
+    if socket_path:
+        server = ThreadingUnixHTTPServer(socket_path, ServiceHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.service = service
+    server.timeout_seconds = timeout or None
+    return server
@@ -0,0 +1,159 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import logging
+import time
+
+Stage = namedtuple('Stage', ['name', 'func', 'after'])
+StageTiming = namedtuple('StageTiming', ['start', 'end'])
+
+
+class StageScheduler(object):
+    """
+    Runs the stages of a conversion on a thread pool, each as soon as the
+    stages it depends on have finished, so independent work overlaps: the
+    page image extraction is mostly disk, the ABBYY parse mostly CPU.
+
+    Stages are added in an order where dependencies come first. If a stage
+    raises, no further stages are started; the stages already running are
+    allowed to finish, and the first exception is re-raised from `run`.
+
+    Given an Instrumentation, each stage is also recorded as one of its
+    stages, named after the stage.
+    """
+
+    def __init__(self, max_workers=None, debug=False, instrumentation=None):
+        self.logger = logging.getLogger(__name__)
+        if debug:
+            self.logger.addHandler(logging.StreamHandler())
+            self.logger.setLevel(logging.DEBUG)
+
+        self.max_workers = max_workers
+        self.instrumentation = instrumentation
+        self.stages = []
+        self.timings = {}   # stage name: StageTiming, seconds from run start
+
+    def add(self, name, func, after=()):
+        """
+        Add a stage calling `func` with no arguments, to run once all the
+        stages named in `after` are done.
+        """
+        known = {stage.name for stage in self.stages}
+        if name in known:
+            raise ValueError("Duplicate stage: {}".format(name))
+        missing = set(after) - known
+        if missing:
+            raise ValueError("Stage {} depends on unknown stages: {}".format(
+                name, ', '.join(sorted(missing))))
+        self.stages.append(Stage(name, func, tuple(after)))
+
+    def _timed(self, stage, started):
+        """ Run a stage, recording when it started & finished. """
+        start = time.perf_counter() - started
+        try:
+            if self.instrumentation is None:
+                return stage.func()
+            with self.instrumentation.stage(stage.name):
+                return stage.func()
+        finally:
+            self.timings[stage.name] = StageTiming(
+                start, time.perf_counter() - started
+            )
+
+    def run(self):
+        """ Run all the stages, returning once they're all done. """
+        self.timings = {}
+        started = time.perf_counter()
+        waiting = list(self.stages)
+        done = set()
+        running = {}   # future: stage
+        error = None
+        workers = self.max_workers or max(len(self.stages), 1)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while waiting or running:
+                if error is None:
+                    ready = [
+                        stage for stage in waiting
+                        if done.issuperset(stage.after)
+                    ]
+                    for stage in ready:
+                        waiting.remove(stage)
+                        self.logger.debug("Starting stage {}".format(
+                            stage.name))
+                        future = executor.submit(self._timed, stage, started)
+                        running[future] = stage
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    exception = future.exception()
+                    if exception is not None:
+                        self.logger.debug("Stage {} failed: {!r}".format(
+                            stage.name, exception))
+                        error = error or exception
+                    else:
+                        done.add(stage.name)
+        if error is not None:
+            raise error
+        self.logger.debug(self.report())
+
+    def critical_path(self):
+        """
+        The chain of stages which determined the total run time, as a list of
+        names, first stage first: starting from the stage which finished last,
+        each step goes back to the dependency which finished last.
+        """
+        if not self.timings:
+            return []
+        stages = {stage.name: stage for stage in self.stages}
+        name = max(self.timings, key=lambda name: self.timings[name].end)
+        path = [name]
+        while True:
+            after = [dep for dep in stages[name].after if dep in self.timings]
+            if not after:
+                break
+            name = max(after, key=lambda dep: self.timings[dep].end)
+            path.append(name)
+        return path[::-1]
+
+    def report(self):
+        """ Human-readable stage timings, marking the critical path. """
+        critical = set(self.critical_path())
+        lines = ["Stage timings (seconds from start):"]
+        for stage in self.stages:
+            if stage.name not in self.timings:
+                continue
+            timing = self.timings[stage.name]
+            lines.append("{mark} {name:<12} {start:8.3f} {end:8.3f} "
+                         "({length:.3f})".format(
+                             mark='*' if stage.name in critical else ' ',
+                             name=stage.name,
+                             start=timing.start,
+                             end=timing.end,
+                             length=timing.end - timing.start))
+        if self.timings:
+            lines.append("Critical path: {} ({:.3f}s)".format(
+                ' -> '.join(self.critical_path()),
+                max(timing.end for timing in self.timings.values())))
+        return '\n'.join(lines)
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import time
+
+import pytest
+
+from abbyy_to_epub3.batch import (
+    TaskWatch, convert_item, epub_path, item_books, read_manifest, run_batch,
+    scan_items,
+)
+from abbyy_to_epub3.create_epub import ERR_MISSING_SCANDATA, Ebook
+
+TEST_DIR = os.path.dirname(__file__)
+ITEM_DIR = os.path.join(TEST_DIR, 'item_dir')
+
+
+def dying_convert(task):
+    """ Stands in for convert_item; the worker dies on book `two` """
+    (job, out_dir, tmpdir, options) = task
+    if job['item_bookpath'] == 'two':
+        os._exit(1)
+    if job['item_bookpath'].startswith('slow'):
+        time.sleep(30)
+    result = dict(job)
+    result.update({'status': 'ok', 'error': None, 'seconds': 0})
+    return result
+
+
+class TestBatch(object):
+
+    def test_csv_manifest(self, tmpdir):
+        """ Reads a CSV manifest; the bookpath defaults to the identifier """
+        manifest = tmpdir.join('books.csv')
+        manifest.write(
+            'item_dir,item_identifier,item_bookpath,out\n'
+            'a,item_a,book_a,\n'
+            'b,item_b,,b.epub\n'
+        )
+        assert read_manifest(str(manifest)) == [
+            {'item_dir': 'a', 'item_identifier': 'item_a',
+             'item_bookpath': 'book_a'},
+            {'item_dir': 'b', 'item_identifier': 'item_b',
+             'item_bookpath': 'item_b', 'out': 'b.epub'},
+        ]
+
+    def test_jsonl_manifest(self, tmpdir):
+        """ Reads a JSON Lines manifest, skipping blank lines. """
+        manifest = tmpdir.join('books.jsonl')
+        manifest.write(
+            '{"item_dir": "a", "item_identifier": "item_a"}\n\n'
+        )
+        assert read_manifest(str(manifest)) == [
+            {'item_dir': 'a', 'item_identifier': 'item_a',
+             'item_bookpath': 'item_a'},
+        ]
+
+    def test_manifest_missing_field(self, tmpdir):
+        """ A book without an item_dir is an error naming its line. """
+        manifest = tmpdir.join('books.csv')
+        manifest.write('item_dir,item_identifier\na,item_a\n,item_b\n')
+        with pytest.raises(ValueError, match='line 3: missing item_dir'):
+            read_manifest(str(manifest))
+
+    def test_scan_items(self, tmpdir):
+        """ Finds a book for each ABBYY file in each item directory. """
+        item = tmpdir.mkdir('items').mkdir('item')
+        for name in ('item_meta.xml', 'vol1_abbyy.gz', 'vol2_abbyy.gz'):
+            item.join(name).write('')
+        tmpdir.join('items', 'stray_abbyy.gz').write('')
+
+        assert scan_items(str(tmpdir.join('items'))) == [
+            {'item_dir': str(item), 'item_identifier': 'item',
+             'item_bookpath': 'vol1'},
+            {'item_dir': str(item), 'item_identifier': 'item',
+             'item_bookpath': 'vol2'},
+        ]
+
+    def test_item_books(self, tmpdir):
+        """
+        Each ABBYY or scandata file is a book; the identifier comes from
+        the item's _meta.xml.
+        """
+        item = tmpdir.mkdir('item')
+        for name in (
+            'item_meta.xml', 'vol1_abbyy.gz', 'vol1_scandata.xml',
+            'vol1_jp2.zip', 'vol2_scandata.xml',
+        ):
+            item.join(name).write('')
+
+        assert [job['item_bookpath'] for job in item_books(str(item))] == [
+            'vol1', 'vol2']
+        assert {
+            job['item_identifier'] for job in item_books(str(item), 'other')
+        } == {'other'}
+        item.join('second_meta.xml').write('')
+        with pytest.raises(ValueError):
+            item_books(str(item))
+
+    def test_epub_path(self):
+        """ An EPUB goes to its `out`, else is named for its bookpath """
+        assert epub_path({'item_bookpath': 'sub/book'}, 'out') == (
+            os.path.join('out', 'book.epub'))
+        assert epub_path(
+            {'item_bookpath': 'book', 'out': 'mine.epub'}, 'out'
+        ) == 'mine.epub'
+
+    def test_missing_scandata(self, tmpdir):
+        """ A missing scandata exit fails the book without ending the run """
+        item_dir = str(tmpdir.join('item_dir'))
+        shutil.copytree(ITEM_DIR, item_dir)
+        os.remove(os.path.join(item_dir, 'item_bookpath_scandata.xml'))
+        job = {
+            'item_dir': item_dir,
+            'item_identifier': 'item_identifier',
+            'item_bookpath': 'item_bookpath',
+        }
+
+        result = convert_item((job, str(tmpdir), None, {}))
+
+        assert result['status'] == 'failed'
+        assert result['exit_code'] == ERR_MISSING_SCANDATA
+        assert result['error'] == 'missing scandata'
+
+    @pytest.mark.parametrize('code, exit_code', [
+        (None, 0), ('stopped', 1), (3, 3),
+    ])
+    def test_exit_code(self, code, exit_code, tmpdir, monkeypatch):
+        """ Any SystemExit gives a whole-number exit code """
+        def craft_epub(self, **kwargs):
+            raise SystemExit(code)
+        monkeypatch.setattr(Ebook, 'craft_epub', craft_epub)
+        job = {
+            'item_dir': ITEM_DIR,
+            'item_identifier': 'item_identifier',
+            'item_bookpath': 'item_bookpath',
+        }
+
+        result = convert_item((job, str(tmpdir), None, {}))
+
+        assert result['status'] == 'failed'
+        assert result['exit_code'] == exit_code
+
+    def test_run_batch(self, tmpdir):
+        """ Writes a result line for each book, whatever its fate. """
+        jobs = [
+            {'item_dir': str(tmpdir.join(name)), 'item_identifier': name,
+             'item_bookpath': name}
+            for name in ('one', 'two', 'three')
+        ]
+        results = io.StringIO()
+
+        statuses = run_batch(
+            jobs, results, out_dir=str(tmpdir), workers=2,
+            books_per_worker=1,
+        )
+
+        assert statuses == {'failed': 3}
+        lines = [json.loads(line) for line in results.getvalue().splitlines()]
+        assert sorted(line['item_identifier'] for line in lines) == [
+            'one', 'three', 'two']
+        assert all(line['error'].startswith('OSError') for line in lines)
+
+    def test_lost_books(self, tmpdir):
+        """ Books lost with their worker, or overrunning, fail; no hang """
+        jobs = [
+            {'item_dir': str(tmpdir), 'item_identifier': name,
+             'item_bookpath': name}
+            for name in ('one', 'two', 'slow', 'three')
+        ]
+        results = io.StringIO()
+
+        statuses = run_batch(
+            jobs, results, out_dir=str(tmpdir), workers=2, book_timeout=3,
+            convert=dying_convert,
+        )
+
+        assert statuses == {'ok': 2, 'failed': 2}
+        errors = {
+            line['item_bookpath']: line['error']
+            for line in map(json.loads, results.getvalue().splitlines())
+        }
+        assert errors == {
+            'one': None, 'two': 'worker died', 'slow': 'timed out',
+            'three': None,
+        }
+
+    def test_all_workers_stuck(self, tmpdir):
+        """ Stuck workers are killed, so the books queued behind run """
+        jobs = [
+            {'item_dir': str(tmpdir), 'item_identifier': name,
+             'item_bookpath': name}
+            for name in ('slow1', 'slow2', 'one', 'three')
+        ]
+        results = io.StringIO()
+        start = time.time()
+
+        statuses = run_batch(
+            jobs, results, out_dir=str(tmpdir), workers=2, book_timeout=1,
+            convert=dying_convert,
+        )
+
+        assert statuses == {'ok': 2, 'failed': 2}
+        # neither slow book ran its 30 seconds
+        assert time.time() - start < 20
+
+    def test_timed_out_task(self):
+        """ A timed-out task's process is killed, & its scratch released """
+        released = []
+        watch = TaskWatch(deadline=0.1, release=released.append)
+        worker = multiprocessing.Process(target=time.sleep, args=(30, ))
+        worker.start()
+        watch.queue.put(('started', 0, worker.pid))
+        watch.queue.put(('holding', 0, 100))
+        assert watch.lost([0]) == []
+        time.sleep(0.2)
+
+        assert watch.lost([0]) == [(0, 'timed out')]
+        worker.join(10)
+        assert worker.exitcode == -signal.SIGKILL
+        assert released == [100]
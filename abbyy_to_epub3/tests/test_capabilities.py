@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import mock
+import pytest
+import time
+
+from abbyy_to_epub3 import capabilities
+from abbyy_to_epub3.capabilities import ToolRegistry, version_tuple
+
+
+class TestToolRegistry(object):
+
+    @pytest.fixture
+    def kakadu(self, monkeypatch):
+        """ Pretend kdu_expand is installed, counting each probe. """
+        probe = mock.Mock(return_value={
+            'version': '7.10.2',
+            'features': {'num_threads': True, 'region_decode': True},
+        })
+        monkeypatch.setitem(
+            capabilities.PROBES, 'kakadu', ('kdu_expand', probe)
+        )
+        monkeypatch.setattr(
+            capabilities.shutil, 'which', lambda tool: '/usr/bin/' + tool
+        )
+        return probe
+
+    def test_version_tuple(self):
+        """ Versions are compared as tuples of integers. """
+        assert version_tuple('v6.4.0') == (6, 4, 0)
+        assert version_tuple('version v7.10') == (7, 10)
+        assert version_tuple('') == ()
+
+    def test_probe_once(self, kakadu):
+        """ A tool is probed once per registry, however often it's asked. """
+        tools = ToolRegistry()
+        for _ in range(3):
+            assert tools.available('kakadu')
+
+        assert kakadu.call_count == 1
+        assert tools.probe('kakadu')['version'] == '7.10.2'
+        assert tools.supports('kakadu', 'num_threads')
+
+    def test_missing_tool(self, monkeypatch):
+        """ A tool that isn't on the path is unavailable, & not run. """
+        monkeypatch.setattr(capabilities.shutil, 'which', lambda tool: None)
+        with mock.patch('subprocess.run') as run:
+            tools = ToolRegistry()
+
+            assert not tools.available('node')
+            assert not run.called
+
+    def test_persisted(self, kakadu, tmpdir):
+        """ Probes are shared through the cache file until they expire. """
+        cache_file = str(tmpdir.join('tools.json'))
+        ToolRegistry(cache_file).probe('kakadu')
+        ToolRegistry(cache_file).probe('kakadu')
+
+        assert kakadu.call_count == 1
+
+        expired = ToolRegistry(cache_file, ttl=0)
+        time.sleep(0.01)
+        expired.probe('kakadu')
+
+        assert kakadu.call_count == 2
+
+    def test_image_backend(self, kakadu):
+        """ Kakadu is preferred, but the caller can force a backend. """
+        tools = ToolRegistry()
+
+        assert tools.image_backend() == 'kakadu'
+        assert tools.image_backend('auto') == 'kakadu'
+        assert tools.image_backend('pillow') == 'pillow'
+        with pytest.raises(ValueError):
+            tools.image_backend('imagemagick')
+
+    def test_forced_backend_unavailable(self, monkeypatch):
+        """ Forcing a backend that isn't installed fails up front. """
+        monkeypatch.setattr(capabilities.shutil, 'which', lambda tool: None)
+        tools = ToolRegistry()
+
+        with pytest.raises(ValueError):
+            tools.image_backend('kakadu')
+        assert tools.image_backend('auto') == 'pillow'
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import os
+
+from abbyy_to_epub3.checkpoints import Checkpoints
+
+
+class TestCheckpoints(object):
+
+    def test_save_load(self, tmpdir):
+        """ A stage's state comes back while its inputs are unchanged. """
+        source = tmpdir.join('input.xml')
+        source.write('<a/>')
+        checkpoints = Checkpoints(str(tmpdir.join('checkpoints')))
+
+        assert not checkpoints.valid('parse', [str(source)])
+        checkpoints.save('parse', [str(source)], {'blocks': [1, 2]})
+
+        again = Checkpoints(str(tmpdir.join('checkpoints')))
+        assert again.valid('parse', [str(source)])
+        assert again.load('parse') == {'blocks': [1, 2]}
+
+    def test_no_state(self, tmpdir):
+        """ A stage can be checkpointed with no state. """
+        checkpoints = Checkpoints(str(tmpdir))
+        checkpoints.save('gunzip', [])
+
+        assert checkpoints.valid('gunzip', [])
+        assert checkpoints.load('gunzip') is None
+        assert not os.path.exists(str(tmpdir.join('gunzip.pickle')))
+
+    def test_changed_input(self, tmpdir):
+        """ Changing an input's contents invalidates the checkpoint. """
+        source = tmpdir.join('input.xml')
+        source.write('<a/>')
+        Checkpoints(str(tmpdir)).save('parse', [str(source)], [])
+
+        source.write('<b/>')
+        assert not Checkpoints(str(tmpdir)).valid('parse', [str(source)])
+
+    def test_unchanged_not_rehashed(self, tmpdir):
+        """ An input is only hashed again if its size or mtime changed. """
+        source = tmpdir.join('input.xml')
+        source.write('<a/>')
+        Checkpoints(str(tmpdir)).save('parse', [str(source)], [])
+        mtime_ns = os.stat(str(source)).st_mtime_ns
+
+        # Same size & modification time: taken as unchanged
+        source.write('<b/>')
+        os.utime(str(source), ns=(mtime_ns, mtime_ns))
+        assert Checkpoints(str(tmpdir)).valid('parse', [str(source)])
+
+        os.utime(str(source), ns=(mtime_ns + 1, mtime_ns + 1))
+        assert not Checkpoints(str(tmpdir)).valid('parse', [str(source)])
+
+    def test_fingerprint(self, tmpdir):
+        """ A checkpoint is only valid with the fingerprint it was made by """
+        Checkpoints(str(tmpdir), fingerprint='a').save('parse', [], [])
+
+        assert Checkpoints(str(tmpdir), fingerprint='a').valid('parse', [])
+        assert not Checkpoints(str(tmpdir), fingerprint='b').valid('parse', [])
+
+    def test_discard(self, tmpdir):
+        """ A discarded checkpoint isn't valid, & others are kept. """
+        checkpoints = Checkpoints(str(tmpdir))
+        checkpoints.save('parse', [], [])
+        checkpoints.save('html', [], [])
+        checkpoints.discard('parse')
+
+        assert not checkpoints.valid('parse', [])
+        assert checkpoints.valid('html', [])
+
+    def test_unreadable_manifest(self, tmpdir):
+        """ A damaged manifest means there are no checkpoints. """
+        tmpdir.join(Checkpoints.MANIFEST).write('{"parse":')
+
+        assert not Checkpoints(str(tmpdir)).valid('parse', [])
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import subprocess
+import sys
+
+
+class TestCommandline(object):
+
+    def test_lazy_imports(self):
+        """
+        Loading the command line doesn't load the conversion's slow
+        dependencies, so --help & argument errors are quick.
+        """
+        heavy = [
+            'ebooklib', 'epubcheck', 'fuzzywuzzy', 'numeral', 'numpy',
+            'PIL', 'pkg_resources', 'pycountry',
+            'abbyy_to_epub3.create_epub',
+        ]
+        code = (
+            'import sys\n'
+            'import abbyy_to_epub3.commandline\n'
+            'print(" ".join(m for m in {!r} if m in sys.modules))\n'
+        ).format(heavy)
+        result = subprocess.run(
+            [sys.executable, '-c', code],
+            check=True, stdout=subprocess.PIPE, universal_newlines=True,
+        )
+        assert result.stdout.split() == []
@@ -18,14 +18,25 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from collections import OrderedDict
+from io import BytesIO
+from PIL import Image
 from tempfile import TemporaryDirectory
+from zipfile import ZipFile
 
+import gzip
 import os
 import json
 import pytest
-
-from abbyy_to_epub3.create_epub import Ebook
+import shutil
+
+from abbyy_to_epub3.create_epub import (
+    Ebook, SpilledImage, read_item_metadata,
+)
+from abbyy_to_epub3.geometry import BoxIndex
+from abbyy_to_epub3.image_cache import ImageCache
+from abbyy_to_epub3.parse_scandata import PageTable
 from abbyy_to_epub3.settings import TEST_DIR
+from abbyy_to_epub3.workspace import Workspace
 
 ITEM_DIR = os.path.join(TEST_DIR, 'item_dir')
 
@@ -46,7 +57,7 @@ class TestAbbyyParser(object):
 
     @pytest.fixture
     def pages(self):
-        return {1: 'Cover'}
+        return PageTable([1], ['cover'], [True])
 
     @pytest.fixture
     def paragraphs(self):
@@ -69,6 +80,46 @@ class TestAbbyyParser(object):
         assert book.item_dir == '{}/item_dir'.format(TEST_DIR)
         assert book.item_bookpath == 'item_bookpath'
 
+    def test_memory_budget(self):
+        """ Memory is only tracked if asked for, or given a budget. """
+        book = Ebook(
+            item_identifier="item_identifier",
+            item_dir="{}/item_dir".format(TEST_DIR),
+            item_bookpath="item_bookpath",
+            memory_budget=100,
+        )
+
+        assert book.memory.budget == 100 * 2 ** 20
+        assert book.instrumentation.memory is book.memory
+
+    def test_no_memory_probe(self, book):
+        """ By default there's no memory tracking. """
+        assert book.memory is None
+
+    def test_profile_serial(self, tmpdir, monkeypatch):
+        """ Profiled, the stages run one at a time, so each is profiled. """
+        workers = []
+
+        class Scheduled(Exception):
+            pass
+
+        def scheduler(max_workers=None, **kwargs):
+            workers.append(max_workers)
+            raise Scheduled()
+        monkeypatch.setattr(
+            'abbyy_to_epub3.create_epub.StageScheduler', scheduler
+        )
+        book = Ebook(
+            item_identifier="item_identifier",
+            item_dir="{}/item_dir".format(TEST_DIR),
+            item_bookpath="item_bookpath",
+            profile_dir=str(tmpdir.join('profile')),
+        )
+
+        with pytest.raises(Scheduled):
+            book.craft_epub(epub_outfile=str(tmpdir.join('out.epub')))
+        assert workers == [1]
+
     def test_create_accessibility_metadata(self, book):
         """ Set the accessibility metadata of a default book. """
         book.create_accessibility_metadata()
@@ -108,6 +159,383 @@ class TestAbbyyParser(object):
         ) in book.chapters[1].content
         assert book.chapters[1].file_name == 'chap_0002.xhtml'
 
+    def test_resume_scandata(self, book, tmpdir):
+        """ Given a workdir, a stage resumes from its checkpoint. """
+        book.use_workdir(str(tmpdir))
+        book.pages = PageTable([1], ['cover'], [True])
+        book.checkpoint('scandata', [book.scandata_xml], book.pages)
+
+        again = Ebook(ITEM_DIR, 'item_identifier', 'item_bookpath')
+        again.use_workdir(str(tmpdir))
+        # The fixture scandata is empty; parsing it would fail
+        again.load_scandata_pages()
+
+        assert again.pages == {1: 'cover'}
+        assert again.stats['stages_resumed'] == 1
+
+    def test_resume_html(
+        self, blocks, metadata, pages, book, tmpdir, monkeypatch
+    ):
+        """ The book's HTML resumes as it was made, chapters & all. """
+        book.use_workdir(str(tmpdir))
+        book.metadata = metadata
+        book.blocks = blocks
+        book.pages = pages
+        monkeypatch.setattr(Ebook, 'make_image', lambda Ebook, str: '<img />')
+        book.craft_html()
+
+        again = Ebook(ITEM_DIR, 'item_identifier', 'item_bookpath')
+        again.use_workdir(str(tmpdir))
+        again.metadata = metadata
+        again.craft_html()
+
+        assert again.stats['stages_resumed'] == 1
+        assert [c.title for c in again.chapters] == [
+            c.title for c in book.chapters]
+        assert again.chapters[1] in again.book.items
+
+    def test_resume_html_new_metadata(
+        self, blocks, metadata, pages, book, tmpdir, monkeypatch
+    ):
+        """ Resumed HTML takes up changes to the metadata file. """
+        book.use_workdir(str(tmpdir))
+        book.metadata = metadata
+        book.blocks = blocks
+        book.pages = pages
+        monkeypatch.setattr(Ebook, 'make_image', lambda Ebook, str: '<img />')
+        book.craft_html()
+
+        again = Ebook(ITEM_DIR, 'item_identifier', 'item_bookpath')
+        again.use_workdir(str(tmpdir))
+        again.metadata = dict(
+            metadata, title=['Ashes'], language=['fr'],
+            **{'page-progression': ['rl']}
+        )
+        again.craft_html()
+
+        opening = again.chapters[0]
+        assert opening.title == 'Ashes'
+        assert opening.content.startswith(
+            '<h1 dir="ltr" class="center">Ashes</h1>')
+        assert opening.content.endswith(book.chapters[0].content[-200:])
+        assert {(c.lang, c.direction) for c in again.chapters} == {
+            ('fr', 'rtl')}
+
+    def test_item_metadata(self, tmpdir):
+        """ Given the item's metadata, a book doesn't read _meta.xml """
+        shared = read_item_metadata(
+            os.path.join(TEST_DIR, 'finereader_10_meta.xml'))
+        item_dir = str(tmpdir.join('item_dir'))
+        shutil.copytree(ITEM_DIR, item_dir)
+        book = Ebook(
+            item_dir, 'item_identifier', 'item_bookpath',
+            item_metadata=shared,
+        )
+        os.remove(os.path.join(item_dir, 'item_identifier_meta.xml'))
+
+        book.read_metadata()
+        book.metadata['subject'].append('changed')
+
+        assert 'PAGES_SUPPORT' not in shared
+        assert 'Greek poetry' in book.metadata['subject']
+        assert 'changed' not in shared['subject']
+
+    def test_stale_checkpoint(self, tmpdir):
+        """ A checkpoint isn't used once its inputs or options change. """
+        item_dir = str(tmpdir.join('item_dir'))
+        shutil.copytree(ITEM_DIR, item_dir)
+        workdir = str(tmpdir.join('work'))
+        book = Ebook(item_dir, 'item_identifier', 'item_bookpath')
+        book.use_workdir(workdir)
+        book.checkpoint('scandata', [book.scandata_xml], {1: 'cover'})
+
+        small = Ebook(
+            item_dir, 'item_identifier', 'item_bookpath',
+            image_profile='small',
+        )
+        small.use_workdir(workdir)
+        assert not small.resume('scandata', [book.scandata_xml])
+
+        with open(book.scandata_xml, 'a') as f:
+            f.write('<book/>')
+        again = Ebook(item_dir, 'item_identifier', 'item_bookpath')
+        again.use_workdir(workdir)
+        assert not again.resume('scandata', [book.scandata_xml])
+
+    def test_enclosed_image(self, book):
+        """ An image inside another image on its page is skipped. """
+        book.metadata = {'pics_by_page': BoxIndex()}
+        outer = {'type': 'Picture', 'page_no': 3, 'pic_id': 0}
+        inner = {'type': 'Picture', 'page_no': 3, 'pic_id': 1}
+        book.metadata['pics_by_page'].add(3, (0, 0, 100, 100))
+        book.metadata['pics_by_page'].add(3, (10, 10, 50, 50))
+
+        assert not book.is_enclosed_image(outer)
+        assert book.is_enclosed_image(inner)
+        assert book.make_image(inner) is None
+
+    def test_merged_image(self, book):
+        """ Fragments of one figure make a single image of their union. """
+        pics = BoxIndex()
+        book.metadata = {'pics_by_page': pics}
+        style = {'pagewidth': '1000', 'pageheight': '1000'}
+        left = {
+            'type': 'Picture', 'page_no': 3,
+            'pic_id': pics.add(3, (100, 100, 300, 400)),
+            'style': dict(style, l='100', t='100', r='300', b='400'),
+        }
+        right = {
+            'type': 'Picture', 'page_no': 3,
+            'pic_id': pics.add(3, (305, 120, 600, 500)),
+            'style': dict(style, l='305', t='120', r='600', b='500'),
+        }
+
+        assert book.image_skip_reason(left) is None
+        assert book.image_box(left) == (100, 100, 600, 500)
+        assert book.image_skip_reason(right) == 'merged'
+        assert book.make_image(right) is None
+        assert book.stats['images_skipped_merged'] == 1
+
+        book.merge_gap = -1
+        assert book.image_skip_reason(right) is None
+        assert book.image_box(left) == (100, 100, 300, 400)
+
+    def test_make_image_noise(self, book):
+        """ Stray marks are skipped, and counted, before any decoding. """
+        pics = BoxIndex()
+        book.metadata = {'pics_by_page': pics}
+        style = {'pagewidth': '1000', 'pageheight': '1000'}
+        speck = {
+            'type': 'Picture', 'page_no': 3,
+            'pic_id': pics.add(3, (500, 500, 505, 505)),
+            'style': dict(style, l='500', t='500', r='505', b='505'),
+        }
+        shadow = {
+            'type': 'Picture', 'page_no': 3,
+            'pic_id': pics.add(3, (0, 0, 25, 500)),
+            'style': dict(style, l='0', t='0', r='25', b='500'),
+        }
+
+        assert book.make_image(speck) is None
+        assert book.make_image(shadow) is None
+        assert book.stats['images_skipped_small'] == 1
+        assert book.stats['images_skipped_margin'] == 1
+
+    def test_image_skip_reason_text(self, book):
+        """ A picture drawn over the text of its page is skipped. """
+        pics = BoxIndex()
+        book.metadata = {'pics_by_page': pics, 'text_by_page': BoxIndex()}
+        book.metadata['text_by_page'].add(3, (100, 100, 900, 900))
+        block = {
+            'type': 'Picture', 'page_no': 3,
+            'pic_id': pics.add(3, (200, 200, 400, 400)),
+            'style': {
+                'l': '200', 't': '200', 'r': '400', 'b': '400',
+                'pagewidth': '1000', 'pageheight': '1000',
+            },
+        }
+
+        assert book.image_skip_reason(block) == 'text'
+
+    def test_make_image_media_type(self, book, tmpdir):
+        """ Images are encoded per the profile, with a matching media type. """
+        jp2_dir = tmpdir.mkdir('item_bookpath_jp2')
+        Image.effect_noise((400, 600), 30).convert('RGB').save(
+            str(jp2_dir.join('item_bookpath_0003.jp2'))
+        )
+        book.tmpdir = str(tmpdir)
+        book.image_processor = 'pillow'
+        book.metadata = {}
+        book.picnum = 1
+        block = {
+            'type': 'Picture',
+            'page_no': 3,
+            'style': {
+                'l': '0', 't': '0', 'r': '200', 'b': '300',
+                'pagewidth': '400', 'pageheight': '600',
+            },
+        }
+
+        content = book.make_image(block)
+        image = book.book.get_item_with_href('images/img_0001.jpg')
+
+        assert 'src="images/img_0001.jpg"' in content
+        assert image.media_type == 'image/jpeg'
+        assert book.image_bytes == len(image.content)
+
+    def test_make_image_cached(self, book, tmpdir, monkeypatch):
+        """ A second conversion takes its images from the cache. """
+        jp2_dir = tmpdir.mkdir('item_bookpath_jp2')
+        Image.new('RGB', (40, 60), 'white').save(
+            str(jp2_dir.join('item_bookpath_0003.jp2'))
+        )
+        book.tmpdir = str(tmpdir)
+        book.image_processor = 'pillow'
+        book.image_cache = ImageCache(str(tmpdir.join('cache')))
+        book.metadata = {}
+        book.picnum = 1
+        block = {
+            'type': 'Picture',
+            'page_no': 3,
+            'style': {
+                'l': '0', 't': '0', 'r': '20', 'b': '30',
+                'pagewidth': '40', 'pageheight': '60',
+            },
+        }
+        first = book.make_image(block)
+
+        def no_decoding():
+            raise AssertionError("decoded an image despite the cache")
+        monkeypatch.setattr(book, 'image_factory', no_decoding)
+        book.picnum = 1
+        second = book.make_image(block)
+
+        assert first == second
+        assert book.image_cache.stats['hits'] == 1
+
+    def test_extract_cover_from_zip(self, book, tmpdir, monkeypatch):
+        """
+        The cover & thumbnail are made from the zipped cover leaf alone,
+        keeping its aspect ratio, without extracting the page images.
+        """
+        leaf = tmpdir.join('leaf.jp2')
+        Image.new('RGB', (1000, 2000), 'white').save(str(leaf))
+        jp2_zip = tmpdir.join('item_bookpath_jp2.zip')
+        with ZipFile(str(jp2_zip), 'w') as f:
+            f.write(str(leaf), 'item_bookpath_jp2/item_bookpath_0002.jp2')
+        book.jp2_zip = str(jp2_zip)
+        book.workspace = Workspace(directory=str(tmpdir.join('work')))
+        book.tmpdir = str(tmpdir.join('work'))
+        book.image_processor = 'pillow'
+        book.pages = PageTable([1, 2], ['color card', 'cover'], [True, True])
+        with book.workspace:
+            book.extract_cover()
+
+        cover = book.book.get_item_with_id('cover-img')
+        thumbnail = Image.open(BytesIO(book.thumbnail.data))
+
+        assert Image.open(BytesIO(cover.content)).size == (600, 1200)
+        assert thumbnail.size == (135, 270)
+        assert cover.media_type == 'image/png'
+        assert not os.path.exists(
+            os.path.join(book.tmpdir, 'item_bookpath_jp2')
+        )
+
+    def test_make_image_memory_workspace(self, book, tmpdir):
+        """
+        Without unpacking, each page is read from the zip while it's needed,
+        once for all its pictures, & counts against the quota meanwhile.
+        """
+        leaf = tmpdir.join('leaf.jp2')
+        Image.new('RGB', (40, 60), 'white').save(str(leaf))
+        jp2_zip = tmpdir.join('item_bookpath_jp2.zip')
+        with ZipFile(str(jp2_zip), 'w') as f:
+            f.write(str(leaf), 'item_bookpath_jp2/item_bookpath_0003.jp2')
+        book.jp2_zip = str(jp2_zip)
+        book.image_processor = 'pillow'
+        book.metadata = {}
+        book.picnum = 1
+        block = {
+            'type': 'Picture',
+            'page_no': 3,
+            'style': {
+                'l': '0', 't': '0', 'r': '20', 'b': '30',
+                'pagewidth': '40', 'pageheight': '60',
+            },
+        }
+        book.workspace = Workspace(
+            'memory', root=str(tmpdir), tmpfs_dir=None,
+            quota=os.path.getsize(str(leaf)),
+        )
+        with book.workspace:
+            book.tmpdir = book.workspace.path
+            content = book.make_image(block)
+            assert 'src="images/img_0001.png"' in content
+            page = book.workspace.extract_current(
+                book.jp2_zip, 'item_bookpath_jp2/item_bookpath_0003.jp2',
+                'pages',
+            )
+            mtime = os.stat(page).st_mtime_ns
+            block['style']['t'] = '10'
+            assert 'src="images/img_0002.png"' in book.make_image(block)
+            assert os.stat(page).st_mtime_ns == mtime
+            assert book.workspace.peak == os.path.getsize(str(leaf))
+            block['page_no'] = 4
+            assert book.make_image(block) is None
+            assert book.workspace.usage()['on_disk'] == 0
+
+    def test_plan_memory(self, tmpdir):
+        """
+        The plan is made from the inputs' sizes, & spilled images are read
+        back when the EPUB is written.
+        """
+        item_dir = str(tmpdir.join('item_dir'))
+        shutil.copytree(ITEM_DIR, item_dir)
+        leaf = tmpdir.join('leaf.jp2')
+        Image.new('RGB', (1000, 2000), 'white').save(str(leaf))
+        jp2_zip = os.path.join(item_dir, 'item_bookpath_jp2.zip')
+        with ZipFile(jp2_zip, 'w') as f:
+            f.write(str(leaf), 'item_bookpath_jp2/item_bookpath_0001.jp2')
+        with gzip.open(
+            os.path.join(item_dir, 'item_bookpath_abbyy.gz'), 'wb'
+        ) as f:
+            f.write(b'<document/>')
+        book = Ebook(
+            item_dir, 'item_identifier', 'item_bookpath', memory_budget=1,
+        )
+
+        estimate = book.estimate_memory()
+        assert estimate['decode'] == 2 * 16 * 2 ** 20
+        assert estimate['scratch'] == 11 + 2 * os.path.getsize(str(leaf))
+
+        book.plan_memory()
+        assert book.workspace_backing == 'disk'
+        assert book.spill_images
+        assert book.memory.plan.reasons
+
+        book.workspace = Workspace(root=str(tmpdir))
+        with book.workspace:
+            book.tmpdir = book.workspace.path
+            image = SpilledImage(book.spill(b'png', 'images/img_0001.png'))
+            assert image.get_content() == b'png'
+            assert book.workspace.used == 3
+
+    def test_make_image_duplicate(self, book, tmpdir):
+        """ A repeated image points at the item already in the book. """
+        jp2_dir = tmpdir.mkdir('item_bookpath_jp2')
+        for page in (3, 4):
+            Image.new('RGB', (40, 60), 'white').save(
+                str(jp2_dir.join('item_bookpath_{:0>4}.jp2'.format(page)))
+            )
+        book.tmpdir = str(tmpdir)
+        book.image_processor = 'pillow'
+        book.metadata = {}
+        book.picnum = 1
+        style = {
+            'l': '0', 't': '0', 'r': '20', 'b': '30',
+            'pagewidth': '40', 'pageheight': '60',
+        }
+
+        first = book.make_image({'page_no': 3, 'style': style})
+        second = book.make_image({'page_no': 4, 'style': style})
+
+        assert 'src="images/img_0001.png"' in first
+        assert 'src="images/img_0001.png"' in second
+        assert 'Picture #2' in second
+        assert len(book.book.items) == 1
+        assert book.stats['images_duplicate'] == 1
+        assert book.image_bytes == len(book.book.items[0].content)
+
+    def test_image_budget(self, book):
+        """ A book budget is shared between the images still to come. """
+        book.image_profile.image_budget = 1000
+        book.image_profile.book_budget = 10000
+        book.images_expected = 4
+        book.images_made = 2
+        book.image_bytes = 9000
+
+        assert book.image_budget() == 500
+
     def test_make_chapters(self, metadata, book):
         """
         create multiple chapters.
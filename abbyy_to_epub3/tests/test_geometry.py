@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+from abbyy_to_epub3.geometry import BoxIndex, NoiseFilter, block_box
+
+
+class TestBoxIndex(object):
+
+    @pytest.fixture
+    def index(self):
+        index = BoxIndex()
+        index.add(1, (0, 0, 100, 100))      # a large picture
+        index.add(1, (10, 10, 50, 50))      # inside the large picture
+        index.add(1, (90, 90, 200, 200))    # overlaps the large picture
+        index.add(2, (10, 10, 50, 50))      # same box, but another page
+        return index
+
+    def test_block_box(self):
+        """ Reads a block's rectangle from its ABBYY attributes. """
+        block = {'style': {'l': '1', 't': '2', 'r': '3', 'b': '4'}}
+
+        assert block_box(block) == (1, 2, 3, 4)
+
+    def test_add_ids(self, index):
+        """ Ids count the rectangles on each page separately. """
+        assert index.add(1, (0, 0, 1, 1)) == 3
+        assert index.add(3, (0, 0, 1, 1)) == 0
+        assert len(index) == 6
+
+    def test_containing(self, index):
+        """ Finds the rectangles enclosing a box on that page only. """
+        assert list(index.containing(1, (20, 20, 30, 30))) == [
+            True, True, False
+        ]
+        assert list(index.containing(4, (20, 20, 30, 30))) == []
+
+    def test_overlapping(self, index):
+        """ Finds the rectangles sharing area with a box. """
+        assert list(index.overlapping(1, (95, 0, 150, 95))) == [
+            True, False, True
+        ]
+
+    def test_redundant(self, index):
+        """ Only rectangles enclosed in another on the same page. """
+        assert list(index.redundant(1)) == [False, True, False]
+        assert list(index.redundant(2)) == [False]
+
+    def test_redundant_identical(self):
+        """ Of identical rectangles, the first is kept. """
+        index = BoxIndex()
+        index.add(1, (0, 0, 10, 10))
+        index.add(1, (0, 0, 10, 10))
+
+        assert not index.is_redundant(1, 0)
+        assert index.is_redundant(1, 1)
+
+    def test_redundant_after_add(self, index):
+        """ Adding a rectangle refreshes the page's cached flags. """
+        index.redundant(1)
+        index.add(1, (-10, -10, 300, 300))
+
+        assert list(index.redundant(1)) == [True, True, True, False]
+
+    def test_intersection_area(self, index):
+        """ Sums the area a box shares with each rectangle on the page. """
+        assert index.intersection_area(1, (0, 0, 10, 10)) == 100
+        assert index.intersection_area(1, (40, 40, 60, 60)) == 400 + 100
+        assert index.intersection_area(4, (0, 0, 10, 10)) == 0
+
+
+    def test_groups(self):
+        """ Rectangles within the gap are chained into one group. """
+        index = BoxIndex()
+        index.add(1, (0, 0, 100, 100))
+        index.add(1, (300, 0, 400, 100))    # far from the first
+        index.add(1, (105, 0, 200, 100))    # 5px right of the first
+        index.add(1, (205, 0, 295, 100))    # bridges to the second
+
+        assert list(index.groups(1, gap=0)) == [0, 1, 2, 3]
+        assert list(index.groups(1, gap=5)) == [0, 0, 0, 0]
+        assert list(index.groups(1, gap=4)) == [0, 1, 2, 3]
+
+    def test_group_box(self, index):
+        """ A group's bounding box covers all its rectangles. """
+        assert index.group_box(1, 1) == (0, 0, 200, 200)
+        assert index.group_box(2, 0) == (10, 10, 50, 50)
+        assert index.is_group_leader(1, 0)
+        assert not index.is_group_leader(1, 2)
+
+    def test_groups_recomputed(self, index):
+        """ Adding a rectangle invalidates that page's groups. """
+        assert list(index.groups(2, gap=0)) == [0]
+        index.add(2, (50, 10, 60, 50))
+
+        assert list(index.groups(2, gap=0)) == [0, 0]
+
+class TestNoiseFilter(object):
+
+    @pytest.fixture
+    def noise(self):
+        return NoiseFilter(
+            min_area=0.001, max_aspect=25, margin=0.05, max_text_overlap=0.6
+        )
+
+    def test_real_picture(self, noise):
+        """ A picture in the body of the page is kept. """
+        assert noise.reason((100, 100, 500, 400), (1000, 1000)) is None
+
+    @pytest.mark.parametrize('box,reason', [
+        ((100, 100, 110, 110), 'small'),
+        ((100, 100, 100, 400), 'small'),
+        ((100, 100, 900, 120), 'aspect'),
+        ((0, 100, 40, 400), 'margin'),
+        ((100, 960, 400, 1000), 'margin'),
+    ])
+    def test_noise(self, noise, box, reason):
+        """ Specks, rules and gutter shadows are rejected by their shape. """
+        assert noise.reason(box, (1000, 1000)) == reason
+
+    def test_text_overlap(self, noise):
+        """ A picture mostly covered by text is rejected. """
+        box = (100, 100, 200, 200)
+
+        assert noise.reason(box, (1000, 1000), text_area=5000) is None
+        assert noise.reason(box, (1000, 1000), text_area=7000) == 'text'
+
+    def test_disabled(self):
+        """ The default thresholds only reject empty boxes. """
+        noise = NoiseFilter()
+
+        assert noise.reason((0, 0, 1, 1000), (1000, 1000)) is None
+        assert noise.reason((0, 0, 0, 10), (1000, 1000)) == 'small'
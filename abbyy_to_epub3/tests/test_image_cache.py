@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import pytest
+import time
+
+from abbyy_to_epub3.image_cache import ImageCache
+from abbyy_to_epub3.image_output import EncodedImage, OutputProfile
+
+
+class TestImageCache(object):
+
+    @pytest.fixture
+    def cache(self, tmpdir):
+        return ImageCache(str(tmpdir.join('cache')), max_bytes=1000)
+
+    @pytest.fixture
+    def jp2(self, tmpdir):
+        path = tmpdir.join('page_0001.jp2')
+        path.write_binary(b'not really a jp2')
+        return str(path)
+
+    @pytest.fixture
+    def profile(self):
+        return OutputProfile('test', max_width=100)
+
+    def encoded(self, size=100):
+        return EncodedImage(b'x' * size, 'image/jpeg', 'jpg', 'photo')
+
+    def test_roundtrip(self, cache, jp2, profile):
+        """ A stored image comes back with its format. """
+        key = cache.key(jp2, 'pillow', profile, dim=(1, 2, 3, 4))
+        cache.put(key, self.encoded())
+
+        assert cache.get(key) == self.encoded()
+        assert cache.stats['hits'] == 1
+
+    def test_miss(self, cache, jp2, profile):
+        """ An unknown key is a miss. """
+        key = cache.key(jp2, 'pillow', profile)
+
+        assert cache.get(key) is None
+        assert cache.stats['misses'] == 1
+
+    def test_key_inputs(self, cache, jp2, profile):
+        """ Changing any input changes the key. """
+        key = cache.key(jp2, 'pillow', profile, dim=(1, 2, 3, 4))
+
+        assert key == cache.key(jp2, 'pillow', profile, dim=(1, 2, 3, 4))
+        assert key != cache.key(jp2, 'pillow', profile, dim=(1, 2, 3, 5))
+        assert key != cache.key(jp2, 'kakadu', profile, dim=(1, 2, 3, 4))
+        assert key != cache.key(
+            jp2, 'pillow', OutputProfile('other'), dim=(1, 2, 3, 4)
+        )
+        with open(jp2, 'ab') as f:
+            f.write(b'changed')
+        assert key != cache.key(jp2, 'pillow', profile, dim=(1, 2, 3, 4))
+
+    def test_lru_eviction(self, cache, jp2, profile):
+        """ The least recently used entries are evicted beyond max_bytes. """
+        keys = [
+            cache.key(jp2, 'pillow', profile, dim=(i, 0, 0, 0))
+            for i in range(4)
+        ]
+        cache.put(keys[0], self.encoded(400))
+        cache.put(keys[1], self.encoded(400))
+        # make the first entry the most recently used
+        past = time.time() - 60
+        os.utime(cache._entry(keys[1]), (past, past))
+        cache.get(keys[0])
+        cache.put(keys[2], self.encoded(400))
+
+        assert cache.get(keys[0]) is not None
+        assert cache.get(keys[1]) is None
+        assert cache.get(keys[2]) is not None
+        assert cache.stats['evictions'] == 1
+
+    def test_low_water(self, cache, jp2, profile):
+        """ Eviction makes room below max_bytes, for the next stores. """
+        for i in range(6):
+            cache.put(
+                cache.key(jp2, 'pillow', profile, dim=(i, 0, 0, 0)),
+                self.encoded(200),
+            )
+
+        assert cache.stats['evictions'] == 2
+        assert cache.read_size() == 800
+
+    def test_stale_tmp(self, cache, jp2, profile):
+        """ Abandoned temporary files are deleted, recent ones kept. """
+        subdir = os.path.join(cache.directory, 'ab')
+        os.makedirs(subdir)
+        stale = os.path.join(subdir, '.tmpstale')
+        recent = os.path.join(subdir, '.tmprecent')
+        for path in (stale, recent):
+            with open(path, 'wb') as f:
+                f.write(b'x' * 100)
+        past = time.time() - cache.TMP_GRACE - 60
+        os.utime(stale, (past, past))
+        cache.evict()
+
+        assert not os.path.exists(stale)
+        assert os.path.exists(recent)
+        assert cache.read_size() == 0
+
+    def test_shared_directory(self, cache, jp2, profile):
+        """ Separate cache objects on one directory share entries. """
+        key = cache.key(jp2, 'pillow', profile)
+        cache.put(key, self.encoded())
+        other = ImageCache(cache.directory)
+
+        assert other.get(key) == self.encoded()
+
+    def test_no_rescan(self, cache, jp2, profile, monkeypatch):
+        """ A new cache object on a filled directory doesn't walk it """
+        for i in range(3):
+            cache.put(
+                cache.key(jp2, 'pillow', profile, dim=(i, 0, 0, 0)),
+                self.encoded(),
+            )
+        other = ImageCache(cache.directory, max_bytes=1000)
+
+        def scan():
+            raise AssertionError("walked the cache")
+        monkeypatch.setattr(other, 'scan', scan)
+        other.put(other.key(jp2, 'pillow', profile), self.encoded())
+        # storing an entry again doesn't count it twice
+        other.put(other.key(jp2, 'pillow', profile), self.encoded())
+
+        assert other.read_size() == 400
+        assert other.stats['stores'] == 2
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from io import BytesIO
+from PIL import Image, ImageDraw
+
+import configparser
+import pytest
+
+from abbyy_to_epub3.image_output import (
+    DuplicateIndex, OutputProfile, classify, dhash, encode_image,
+    profile_names,
+)
+
+
+class TestImageOutput(object):
+
+    @pytest.fixture
+    def profile(self):
+        return OutputProfile('test', max_width=1000)
+
+    @pytest.fixture
+    def photo(self):
+        """ Mid-tone noise, with nothing near black or white. """
+        return Image.effect_noise((600, 400), 30).convert('RGB')
+
+    def bars(self):
+        """ Black text-like bars on a white page. """
+        im = Image.new('RGB', (600, 400), 'white')
+        draw = ImageDraw.Draw(im)
+        for y in range(20, 380, 40):
+            draw.rectangle((20, y, 580, y + 10), fill='black')
+        return im
+
+    @pytest.fixture
+    def bitonal(self):
+        return self.bars()
+
+    @pytest.fixture
+    def lineart(self):
+        """ Mostly black & white, with a band of grey shading. """
+        im = self.bars()
+        ImageDraw.Draw(im).rectangle((0, 0, 600, 40), fill='grey')
+        return im
+
+    def test_profile_names(self):
+        """ Profiles are the config sections named Profile:<name>. """
+        config = configparser.ConfigParser()
+        config.read_string("[Main]\n[Profile:a]\n[Profile:b]\n")
+
+        assert profile_names(config) == ['a', 'b']
+
+    def test_unknown_profile(self):
+        """ Asking for a profile that isn't configured is an error. """
+        config = configparser.ConfigParser()
+
+        with pytest.raises(ValueError):
+            OutputProfile.from_config(config, 'nonesuch')
+
+    def test_classify(self, profile, photo, bitonal, lineart):
+        """ Tells photographs, line art and bitonal images apart. """
+        assert classify(photo, profile) == 'photo'
+        assert classify(bitonal, profile) == 'bitonal'
+        assert classify(lineart, profile) == 'lineart'
+
+    def test_photo_jpeg(self, profile, photo):
+        """ Photographs are encoded as JPEG. """
+        encoded = encode_image(photo, profile)
+
+        assert encoded.media_type == 'image/jpeg'
+        assert encoded.extension == 'jpg'
+        assert Image.open(BytesIO(encoded.data)).format == 'JPEG'
+
+    def test_bitonal_png(self, profile, bitonal):
+        """ Bitonal images become 1-bit PNGs. """
+        encoded = encode_image(bitonal, profile)
+
+        assert encoded.media_type == 'image/png'
+        assert Image.open(BytesIO(encoded.data)).mode == '1'
+
+    def test_lineart_png(self, profile, lineart):
+        """ Line art becomes a palettized PNG. """
+        encoded = encode_image(lineart, profile)
+
+        assert encoded.media_type == 'image/png'
+        assert Image.open(BytesIO(encoded.data)).mode == 'P'
+
+    def test_max_width(self, photo):
+        """ Images wider than the profile allows are scaled down. """
+        profile = OutputProfile('narrow', max_width=300)
+        encoded = encode_image(photo, profile)
+
+        assert Image.open(BytesIO(encoded.data)).size == (300, 200)
+
+    def test_budget(self, profile, photo):
+        """ The encoder shrinks images to meet a byte budget. """
+        unlimited = encode_image(photo, profile)
+        encoded = encode_image(photo, profile, budget=20000)
+
+        assert len(encoded.data) <= 20000 < len(unlimited.data)
+
+    def test_lossless(self, photo):
+        """ A lossless profile keeps full colour PNGs. """
+        profile = OutputProfile('lossless', lossless=True)
+        encoded = encode_image(photo, profile)
+
+        assert encoded.media_type == 'image/png'
+        assert Image.open(BytesIO(encoded.data)).mode == 'RGB'
+
+    def test_dhash_similar(self, bitonal):
+        """ Near-identical images have nearby perceptual hashes. """
+        speck = bitonal.copy()
+        speck.putpixel((300, 5), (0, 0, 0))
+
+        assert bin(dhash(bitonal) ^ dhash(speck)).count('1') <= 2
+        assert dhash(bitonal) != dhash(bitonal.rotate(90, expand=True))
+
+    def test_duplicate_exact(self, profile, photo):
+        """ Identical encoded images are found. """
+        stored = DuplicateIndex()
+        encoded = encode_image(photo, profile)
+        stored.add(encoded, 'images/img_0001.jpg')
+
+        assert stored.find(encoded) == 'images/img_0001.jpg'
+        assert stored.find(encode_image(photo.rotate(90), profile)) is None
+
+    def test_duplicate_perceptual(self, profile, bitonal):
+        """ With a tolerance, near-identical images are found. """
+        speck = bitonal.copy()
+        speck.putpixel((300, 5), (0, 0, 0))
+        exact = DuplicateIndex()
+        tolerant = DuplicateIndex(tolerance=4)
+        for stored in (exact, tolerant):
+            stored.add(encode_image(bitonal, profile), 'images/img_0001.png')
+
+        assert exact.find(encode_image(speck, profile)) is None
+        assert tolerant.find(encode_image(speck, profile)) == (
+            'images/img_0001.png'
+        )
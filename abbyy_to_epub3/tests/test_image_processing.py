@@ -17,12 +17,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from io import BytesIO
 from PIL import Image
 
 import mock
+import pytest
 import subprocess
 
-from abbyy_to_epub3.image_processing import factory as ImageFactory
+from abbyy_to_epub3.image_processing import (
+    factory as ImageFactory, reduce_level,
+)
 
 
 class TestImageFactory(object):
@@ -55,52 +59,120 @@ class TestImageFactory(object):
     #
     # Kakadu tests
     #
+    @pytest.fixture
+    def expanded(self):
+        """ A decoded image as kdu_expand writes it to stdout. """
+        buf = BytesIO()
+        Image.new('RGB', (4, 4)).save(buf, 'ppm')
+        return mock.Mock(stdout=buf.getvalue())
+
     @mock.patch("subprocess.run")
-    def test_kakadu_uncropped_subprocess(self, mock_subprocess):
+    def test_kakadu_uncropped_subprocess(
+        self, mock_subprocess, expanded, tmpdir
+    ):
         """
         When working with Kakadu, a call to crop_image with no dimensions
         makes the subprocess call without a region string.
         """
+        mock_subprocess.return_value = expanded
         test_image = ImageFactory("kakadu")
         infile = 'input_filename'
-        outfile = 'output_filename'
+        outfile = str(tmpdir.join('output_filename.png'))
         expected = [
             'kdu_expand',
+            '-quiet',
             '-region', '{0.0,0.0},{1.0,1.0}',
             '-reduce', '2',
             '-i', 'input_filename',
-            '-o', 'output_filename.bmp',
+            '-o',
         ]
 
         test_image.crop_image(infile, outfile)
-        mock_subprocess.assert_called_with(
-            (expected), stdout=subprocess.DEVNULL, check=True
-        )
+        cmd = mock_subprocess.call_args[0][0]
+
+        assert cmd[:-1] == expected
+        assert cmd[-1].endswith('.ppm')
 
     @mock.patch("subprocess.run")
-    def test_kakadu_cropped_subprocess(self, mock_subprocess):
+    def test_kakadu_cropped_subprocess(
+        self, mock_subprocess, expanded, tmpdir
+    ):
         """
         When working with Kakadu, a call to crop_image with provided
         dimensions makes the subprocess call with a region string.
         """
+        mock_subprocess.return_value = expanded
         test_image = ImageFactory("kakadu")
         infile = 'input_filename'
-        outfile = 'output_filename'
+        outfile = str(tmpdir.join('output_filename.png'))
         dim = [1, 2, 3, 4]
         pagedim = (1.0, 2.0)
 
         expected = [
             'kdu_expand',
+            '-quiet',
             '-region', '{1.0,1.0},{1.0,2.0}',
             '-reduce', '2',
             '-i', 'input_filename',
-            '-o', 'output_filename.bmp',
+            '-o',
         ]
 
         test_image.crop_image(infile, outfile, dim=dim, pagedim=pagedim)
-        mock_subprocess.assert_called_with(
-            (expected), stdout=subprocess.DEVNULL, check=True
+        cmd = mock_subprocess.call_args[0][0]
+
+        assert cmd[:-1] == expected
+
+    @mock.patch("subprocess.run")
+    def test_kakadu_in_memory(self, mock_subprocess, expanded, tmpdir):
+        """
+        Kakadu decodes through a pipe and Pillow writes the PNG, with no
+        intermediate BMP left behind.
+        """
+        mock_subprocess.return_value = expanded
+        test_image = ImageFactory("kakadu")
+        outfile = tmpdir.join('output_filename.png')
+
+        test_image.crop_image('input_filename', str(outfile), resize=(2, 2))
+
+        assert mock_subprocess.call_args[1]['stdout'] == subprocess.PIPE
+        assert Image.open(str(outfile)).size == (2, 2)
+        assert tmpdir.listdir() == [outfile]
+
+    @mock.patch("subprocess.run")
+    def test_kakadu_threads_timeout(self, mock_subprocess, expanded, tmpdir):
+        """ Thread count & timeout are passed through to kdu_expand. """
+        mock_subprocess.return_value = expanded
+        test_image = ImageFactory("kakadu", num_threads=4, timeout=10)
+
+        test_image.crop_image(
+            'input_filename', str(tmpdir.join('output_filename.png'))
         )
+        cmd = mock_subprocess.call_args[0][0]
+
+        assert cmd[cmd.index('-num_threads') + 1] == '4'
+        assert mock_subprocess.call_args[1]['timeout'] == 10
+
+    @mock.patch("subprocess.run")
+    def test_kakadu_timeout(self, mock_subprocess, tmpdir):
+        """ A decode that runs too long becomes a RuntimeError. """
+        mock_subprocess.side_effect = subprocess.TimeoutExpired('kdu', 1)
+        test_image = ImageFactory("kakadu")
+
+        with pytest.raises(RuntimeError):
+            test_image.crop_image(
+                'input_filename', str(tmpdir.join('output_filename.png'))
+            )
+
+    @mock.patch("subprocess.run")
+    def test_kakadu_missing(self, mock_subprocess, tmpdir):
+        """ A kdu_expand that can't be run becomes a RuntimeError. """
+        mock_subprocess.side_effect = FileNotFoundError('kdu_expand')
+        test_image = ImageFactory("kakadu")
+
+        with pytest.raises(RuntimeError):
+            test_image.crop_image(
+                'input_filename', str(tmpdir.join('output_filename.png'))
+            )
 
     #
     # Pillow tests
@@ -143,3 +215,32 @@ class TestImageFactory(object):
             MockImage.assert_called_with(infile)
             # Did we save the file?
             MockImage.assert_has_calls(expected)
+
+    def test_pillow_reduced(self, tmpdir):
+        """ Pillow decodes JP2 crops at a reduced resolution. """
+        infile = str(tmpdir.join('page.jp2'))
+        Image.new('RGB', (400, 800)).save(infile)
+        test_image = ImageFactory("pillow")
+
+        im = test_image.decode(infile, discard_level=1, dim=(0, 0, 200, 400))
+
+        assert im.size == (100, 200)
+
+    #
+    # Decoding to fit a box
+    #
+    def test_reduce_level(self):
+        """ Discard levels still leave enough pixels to fill the box. """
+        assert reduce_level((4000, 6000), (800, 1200)) == 2
+        assert reduce_level((4000, 6000), (1600, 2400)) == 1
+        assert reduce_level((400, 600), (800, 1200)) == 0
+
+    def test_decode_to_fit(self, tmpdir):
+        """ The whole image fits the box, keeping its aspect ratio. """
+        infile = str(tmpdir.join('page.jp2'))
+        Image.new('RGB', (2000, 4000)).save(infile)
+        test_image = ImageFactory("pillow")
+
+        im = test_image.decode_to_fit(infile, (800, 1200))
+
+        assert im.size == (600, 1200)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import pstats
+import threading
+
+import pytest
+
+from abbyy_to_epub3.instrumentation import Instrumentation
+
+
+class TestInstrumentation(object):
+
+    @pytest.fixture
+    def instrumentation(self):
+        instrumentation = Instrumentation()
+        with instrumentation.span('parse'):
+            with instrumentation.span('pages', 'parse'):
+                pass
+        for _ in range(3):
+            with instrumentation.span('crop', 'image'):
+                pass
+        instrumentation.count('images_decoded', 3)
+        return instrumentation
+
+    def test_report(self, instrumentation):
+        """ Spans are totalled per category & name, with the counters. """
+        report = instrumentation.report()
+
+        assert list(report['spans']) == ['stage', 'parse', 'image']
+        assert report['spans']['image']['crop']['calls'] == 3
+        assert report['spans']['stage']['parse']['wall'] >= (
+            report['spans']['parse']['pages']['wall']
+        )
+        assert report['counters'] == {'images_decoded': 3}
+
+    def test_shared_counters(self):
+        """ Counters can be an existing Counter, such as Ebook.stats. """
+        stats = {'pages': 2}
+        instrumentation = Instrumentation(counters=stats)
+        instrumentation.count('pages')
+
+        assert stats == {'pages': 3}
+
+    def test_span_error(self):
+        """ A span is recorded even if its block raises. """
+        instrumentation = Instrumentation()
+        with pytest.raises(ValueError):
+            with instrumentation.span('broken'):
+                raise ValueError
+
+        assert [span.name for span in instrumentation.spans] == ['broken']
+
+    def test_threads(self):
+        """ Spans from other threads are recorded with their thread. """
+        instrumentation = Instrumentation()
+
+        def work():
+            with instrumentation.span('thread'):
+                pass
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+
+        assert instrumentation.spans[0].thread == thread.ident
+
+    def test_trace(self, instrumentation, tmpdir):
+        """ Writes a Chrome trace with complete events & the counters. """
+        path = str(tmpdir.join('trace.json'))
+        instrumentation.write_trace(path)
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+
+        spans = [event for event in events if event['ph'] == 'X']
+        assert len(spans) == 5
+        assert all(event['dur'] >= 0 for event in spans)
+        assert events[-1]['ph'] == 'C'
+        assert events[-1]['args'] == {'images_decoded': 3}
+
+    def test_profile(self, tmpdir):
+        """ Profiled spans dump cProfile stats named after the span. """
+        profile_dir = str(tmpdir.join('profile'))
+        instrumentation = Instrumentation(profile_dir=profile_dir)
+        with instrumentation.span('html', profile=True):
+            sorted(range(100))
+        with instrumentation.span('crop', 'image'):
+            pass
+
+        assert os.listdir(profile_dir) == ['html.prof']
+        pstats.Stats(os.path.join(profile_dir, 'html.prof'))
+
+    def test_profile_concurrent(self, tmpdir):
+        """ Concurrent stages are profiled one at a time, not raising """
+        profile_dir = str(tmpdir.join('profile'))
+        instrumentation = Instrumentation(profile_dir=profile_dir)
+        started = threading.Event()
+        done = threading.Event()
+
+        def parse():
+            with instrumentation.stage('parse'):
+                started.set()
+                done.wait(10)
+
+        thread = threading.Thread(target=parse)
+        thread.start()
+        started.wait(10)
+        with instrumentation.stage('images'):
+            pass
+        done.set()
+        thread.join()
+        with instrumentation.stage('html'):
+            pass
+
+        assert sorted(os.listdir(profile_dir)) == ['html.prof', 'parse.prof']
+        assert instrumentation.counters['profiles_skipped'] == 1
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pycountry
+import pytest
+
+from abbyy_to_epub3 import language_codes
+from abbyy_to_epub3.languages import (
+    normal_code, normalize_language, table_source,
+)
+
+
+class TestLanguages(object):
+
+    def test_table_matches_pycountry(self):
+        """ Every code in the table normalises as pycountry would. """
+        for language in pycountry.languages:
+            for attribute in ('alpha_2', 'alpha_3', 'bibliographic'):
+                code = getattr(language, attribute, None)
+                if code:
+                    assert normalize_language(code) == normal_code(
+                        pycountry.languages.lookup(code))
+
+    def test_table_is_current(self):
+        """ The table was generated from the installed pycountry. """
+        with open(language_codes.__file__) as f:
+            assert f.read() == table_source()
+
+    def test_case_and_whitespace(self):
+        """ Codes are matched regardless of case & surrounding spaces. """
+        assert normalize_language(' GER ') == 'de'
+
+    def test_name_falls_back(self):
+        """ Language names aren't in the table, but pycountry finds them. """
+        assert normalize_language('German') == 'de'
+
+    def test_invalid(self):
+        """ An unknown language raises LookupError, as pycountry does. """
+        with pytest.raises(LookupError):
+            normalize_language('xx-invalid')
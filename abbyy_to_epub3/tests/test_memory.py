@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import tracemalloc
+
+import pytest
+
+from abbyy_to_epub3.memory import (
+    MemoryPlan, MemoryProbe, current_rss, peak_rss,
+)
+
+
+class TestMemoryProbe(object):
+
+    def test_rss(self):
+        """ Reads the current & peak resident set size in bytes. """
+        rss = current_rss()
+        if rss is None:
+            pytest.skip("no /proc/self/statm")
+
+        assert 0 < rss <= peak_rss()
+
+    def test_stage_peak(self):
+        """ A stage's peak covers memory it held only while running. """
+        probe = MemoryProbe(interval=0.01)
+        probe.start()
+        with probe.stage('big'):
+            ballast = bytearray(64 * 2 ** 20)
+            probe.sample()
+            del ballast
+        probe.stop()
+        record = probe.stages['big']
+
+        if current_rss() is not None:
+            assert record['rss_peak'] >= record['rss_start'] + 32 * 2 ** 20
+        assert probe.peak >= record['rss_peak']
+        assert probe.report()['stages'] == {'big': record}
+
+    def test_budget(self):
+        """ The peak is checked against the budget, if there is one. """
+        probe = MemoryProbe()
+        with probe.stage('any'):
+            pass
+
+        assert not probe.over_budget()
+        probe.budget = 1
+        assert probe.over_budget()
+        assert 'EXCEEDED' in probe.summary()
+
+    def test_tracemalloc(self):
+        """ Lists the largest allocations at the end of each stage. """
+        was_tracing = tracemalloc.is_tracing()
+        probe = MemoryProbe(tracemalloc_top=2)
+        probe.start()
+        with probe.stage('alloc'):
+            ballast = [str(i) for i in range(10000)]
+        probe.stop()
+
+        top = probe.stages['alloc']['top_allocations']
+        assert len(top) == 2
+        assert top[0]['size'] >= top[1]['size']
+        assert tracemalloc.is_tracing() == was_tracing
+        del ballast
+
+
+class TestMemoryPlan(object):
+
+    MB = 2 ** 20
+    ESTIMATE = {
+        'base': 50 * MB, 'blocks': 20 * MB, 'decode': 30 * MB,
+        'images': 40 * MB, 'scratch': 200 * MB,
+    }
+
+    def test_tmpfs(self):
+        """ The inputs are unpacked in memory when that fits. """
+        plan = MemoryPlan(self.ESTIMATE, 400 * self.MB)
+
+        assert plan.workspace == 'tmpfs'
+        assert not plan.spill_images
+        assert plan.peak() == 340 * self.MB
+        assert plan.fits()
+        assert len(plan.reasons) == 1
+
+    def test_disk_then_spill(self):
+        """ Choices are given up in turn until the estimate fits. """
+        plan = MemoryPlan(self.ESTIMATE, 140 * self.MB)
+        assert plan.workspace == 'disk'
+        assert not plan.spill_images
+
+        plan = MemoryPlan(self.ESTIMATE, 110 * self.MB)
+        assert plan.workspace == 'disk'
+        assert plan.spill_images
+        assert plan.peak() == 100 * self.MB
+        assert plan.fits()
+
+    def test_too_small(self):
+        """ The blocks & a decode are always held. """
+        plan = MemoryPlan(self.ESTIMATE, 50 * self.MB, workspace='memory')
+
+        assert plan.workspace == 'memory'
+        assert plan.spill_images
+        assert not plan.fits()
+        assert 'still over the budget' in plan.reasons[-1]
+        assert plan.report()['peak'] == 100 * self.MB
@@ -17,7 +17,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import gzip
 import pytest
+import shutil
 
 from abbyy_to_epub3.parse_abbyy import AbbyyParser, sanitize_xml
 from abbyy_to_epub3.settings import TEST_DIR
@@ -130,3 +132,39 @@ class TestAbbyyParser(object):
         parser.parse_metadata()
 
         assert self.metadata['language'][0] == 'en'
+
+    def test_pics_by_page(self, finereader6):
+        """ Pictures are indexed by the page they appear on. """
+        parser = finereader6
+        parser.parse_abbyy()
+        pics = [block for block in self.blocks if block['type'] == 'Picture']
+
+        assert len(self.metadata['pics_by_page']) == len(pics)
+        assert len(self.metadata['pics_by_page'].boxes(2)) == 3
+        assert [pic['pic_id'] for pic in pics if pic['page_no'] == 2] == [
+            0, 1, 2
+        ]
+
+    def test_text_by_page(self, finereader6):
+        """ Text blocks are indexed by page, to find pictures over text. """
+        parser = finereader6
+        parser.parse_abbyy()
+
+        assert len(self.metadata['text_by_page'].boxes(3)) == 1
+        assert len(self.metadata['text_by_page'].boxes(2)) == 0
+
+    def test_parse_gzipped(self, finereader6, tmpdir):
+        """ A gzipped ABBYY is parsed as it's decompressed. """
+        finereader6.parse_abbyy()
+        abbyy_gz = str(tmpdir.join('finereader_6_sample.xml.gz'))
+        with open(finereader6.document, 'rb') as infile:
+            with gzip.open(abbyy_gz, 'wb') as outfile:
+                shutil.copyfileobj(infile, outfile)
+        blocks = []
+        parser = AbbyyParser(
+            abbyy_gz, finereader6.metadata_file, {}, {}, blocks,
+        )
+        parser.parse_abbyy()
+
+        assert parser.version == 'FR6'
+        assert blocks == self.blocks
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pickle
+import pytest
+
+from abbyy_to_epub3.parse_scandata import PageTable, ScandataParser
+
+SCANDATA = """<?xml version="1.0" encoding="UTF-8"?>
+<book>
+  <bookData><leafCount>4</leafCount></bookData>
+  <pageData>
+    <page leafNum="0">
+      <pageType>Color Card</pageType>
+      <addToAccessFormats>false</addToAccessFormats>
+      <origWidth>2000</origWidth>
+      <origHeight>3000</origHeight>
+    </page>
+    <page leafNum="1">
+      <pageType>Copyright</pageType>
+      <addToAccessFormats>true</addToAccessFormats>
+    </page>
+    <page leafNum="2">
+      <pageType>Title</pageType>
+      <addToAccessFormats>true</addToAccessFormats>
+      <origWidth>2000</origWidth>
+      <origHeight>3000</origHeight>
+      <cropBox><x>10</x><y>20</y><w>1900</w><h>2900</h></cropBox>
+    </page>
+    <page leafNum="5">
+      <pageType>Normal</pageType>
+      <addToAccessFormats>true</addToAccessFormats>
+    </page>
+  </pageData>
+</book>
+"""
+
+
+class TestScandataParser(object):
+
+    @pytest.fixture
+    def pages(self, tmpdir):
+        scandata = tmpdir.join('item_bookpath_scandata.xml')
+        scandata.write(SCANDATA)
+        return ScandataParser(str(scandata)).parse_scandata()
+
+    def test_page_types(self, pages):
+        """ Page types are lowercased, and non-access pages skippable """
+        assert pages == {
+            0: 'skippable', 1: 'copyright', 2: 'title', 5: 'normal'}
+        assert list(pages) == [0, 1, 2, 5]
+        assert 3 not in pages
+
+    def test_skipped(self, pages):
+        """ Non-access pages & skippable page types are skipped """
+        assert pages.is_skipped(0)
+        assert pages.is_skipped(1)
+        assert pages.is_skipped(2)
+        assert not pages.is_skipped(5)
+        # leaves missing from scandata are treated as normal pages
+        assert not pages.is_skipped(3)
+        assert not pages.is_skipped(None)
+
+    def test_geometry(self, pages):
+        """ Page dimensions & crop boxes, where scandata has them """
+        assert pages.dimensions(2) == (2000, 3000)
+        assert pages.crop_box(2) == (10, 20, 1900, 2900)
+        assert pages.dimensions(1) is None
+        assert pages.crop_box(0) is None
+
+    def test_cover_leaf(self, pages):
+        """ The first access page which is a cover, title or normal """
+        assert pages.cover_leaf() == 2
+        assert PageTable().cover_leaf() is None
+
+    def test_repeated_leaf(self):
+        """ A leaf listed twice keeps its last entry, as a dict would """
+        pages = PageTable([1, 2, 1], ['cover', 'normal', 'title'],
+                          [True, True, True])
+        assert len(pages) == 2
+        assert pages[1] == 'title'
+        assert pages.cover_leaf() == 2
+
+    def test_pickle(self, pages):
+        """ The table survives a checkpoint """
+        assert pickle.loads(pickle.dumps(pages)) == pages
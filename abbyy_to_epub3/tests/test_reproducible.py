@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime, timezone
+from ebooklib import epub
+from zipfile import ZIP_STORED, ZipFile
+
+import hashlib
+import time
+
+from abbyy_to_epub3.reproducible import (
+    ReproducibleEpubWriter, content_hash, source_date, write_hash_file,
+)
+
+DATE = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+
+def make_book(order):
+    """ A small book, its chapters added in the given order """
+    book = epub.EpubBook()
+    book.set_identifier('item_identifier')
+    book.set_title('A title')
+    book.set_language('en')
+    chapters = []
+    for name in order:
+        chapter = epub.EpubHtml(
+            title=name, file_name='{}.xhtml'.format(name), lang='en')
+        chapter.content = '<h1>{}</h1>'.format(name)
+        book.add_item(chapter)
+        chapters.append(chapter)
+    book.toc = chapters
+    book.spine = chapters
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    return book
+
+
+def write(book, path):
+    writer = ReproducibleEpubWriter(str(path), book, date=DATE)
+    writer.process()
+    writer.write()
+    return content_hash(str(path))
+
+
+class TestReproducible(object):
+
+    def test_source_date(self, monkeypatch):
+        """ SOURCE_DATE_EPOCH wins; dates are UTC, & not before 1980 """
+        monkeypatch.delenv('SOURCE_DATE_EPOCH', raising=False)
+        assert source_date('2000-01-01T00:00:00') == DATE
+        assert source_date('1970-01-01T00:00:00').year == 1980
+        monkeypatch.setenv('SOURCE_DATE_EPOCH', '946684800')
+        assert source_date('2010-01-01T00:00:00') == DATE
+
+    def test_same_bytes(self, tmpdir):
+        """ The same book is written to the same bytes, whenever """
+        first = write(make_book(['one', 'two']), tmpdir.join('a.epub'))
+        time.sleep(2)  # zip dates are to the two seconds
+        second = write(make_book(['one', 'two']), tmpdir.join('b.epub'))
+
+        assert first == second
+
+    def test_entries(self, tmpdir):
+        """ The mimetype comes first, stored; the rest in order of name """
+        path = tmpdir.join('book.epub')
+        write(make_book(['two', 'one']), path)
+
+        with ZipFile(str(path)) as f:
+            infos = f.infolist()
+            opf = f.read('EPUB/content.opf').decode('utf-8')
+        names = [info.filename for info in infos]
+        assert names[:3] == [
+            'mimetype', 'META-INF/container.xml', 'EPUB/content.opf']
+        assert names[3:] == sorted(names[3:])
+        assert infos[0].compress_type == ZIP_STORED
+        assert {info.date_time for info in infos} == {(2000, 1, 1, 0, 0, 0)}
+        assert 'dcterms:modified">2000-01-01T00:00:00Z' in opf
+
+    def test_hash_file(self, tmpdir):
+        """ The hash is written beside the file, as sha256sum would """
+        path = tmpdir.join('book.epub')
+        path.write_binary(b'not really an epub')
+        digest = content_hash(str(path))
+
+        hash_file = write_hash_file(str(path), digest)
+
+        assert digest == hashlib.sha256(b'not really an epub').hexdigest()
+        assert open(hash_file).read() == '{}  book.epub\n'.format(digest)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from abbyy_to_epub3.service import (
+    ConversionService, ServiceBusy, make_server,
+)
+
+JOB = {
+    'item_dir': 'item_dir',
+    'item_identifier': 'item_identifier',
+    'item_bookpath': 'item_bookpath',
+}
+
+
+def slow_convert(task):
+    """ Stands in for convert_item, taking long enough to overlap. """
+    (job, out_dir, tmpdir, options) = task
+    time.sleep(0.5)
+    result = dict(job)
+    result.update({'status': 'ok', 'seconds': 0.5})
+    return result
+
+
+def dying_convert(task):
+    """ Stands in for convert_item; the worker dies on `item_bookpath` """
+    (job, out_dir, tmpdir, options) = task
+    if job['item_bookpath'] == 'item_bookpath':
+        os._exit(1)
+    return slow_convert(task)
+
+
+def stuck_convert(task):
+    """ Stands in for convert_item; stuck on `item_bookpath` """
+    (job, out_dir, tmpdir, options) = task
+    if job['item_bookpath'] == 'item_bookpath':
+        time.sleep(60)
+    return slow_convert(task)
+
+
+@pytest.fixture
+def service(tmpdir):
+    service = ConversionService(
+        out_dir=str(tmpdir), workers=1, queue_size=2, convert=slow_convert,
+    )
+    service.start()
+    yield service
+    service.close()
+
+
+def request(url, body=None):
+    """ The status & JSON body of a GET, or a POST if there's a body """
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    try:
+        with urlopen(url, data=data) as response:
+            return (response.status, json.loads(response.read()))
+    except HTTPError as e:
+        return (e.code, json.loads(e.read()))
+
+
+class TestConversionService(object):
+
+    def test_coalesce(self, service):
+        """ Requests for a book being converted share its conversion. """
+        first = service.submit(JOB)
+        second = service.submit(dict(JOB))
+
+        assert first is second
+        assert first.wait(10)['status'] == 'ok'
+        metrics = service.metrics()
+        assert metrics['requests'] == 2
+        assert metrics['coalesced'] == 1
+        assert metrics['ok'] == 1
+        assert metrics['pending'] == 0
+
+    def test_queue_full(self, service):
+        """ Books beyond the queue size are refused until there's room. """
+        conversions = [
+            service.submit(dict(JOB, item_bookpath=str(n))) for n in (1, 2)
+        ]
+        with pytest.raises(ServiceBusy):
+            service.submit(dict(JOB, item_bookpath='3'))
+        assert service.metrics()['rejected'] == 1
+
+        for conversion in conversions:
+            conversion.wait(10)
+        assert service.submit(dict(JOB, item_bookpath='3')).wait(10)
+
+    def test_http(self, service):
+        """ Converts over HTTP, & reports health & metrics. """
+        server = make_server(service, port=0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        url = 'http://{}:{}'.format(*server.server_address)
+        try:
+            assert request(url + '/health') == (200, {'status': 'ok'})
+
+            (status, result) = request(url + '/convert', JOB)
+            assert status == 200
+            assert result['item_bookpath'] == 'item_bookpath'
+
+            (status, result) = request(url + '/convert', {'item_dir': 'x'})
+            assert status == 400
+            assert result['error'] == 'missing item_identifier, item_bookpath'
+
+            (status, metrics) = request(url + '/metrics')
+            assert metrics['ok'] == 1
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_lost_conversion(self, tmpdir):
+        """ A book whose worker dies fails, frees its place & degrades """
+        service = ConversionService(
+            out_dir=str(tmpdir), workers=1, queue_size=1,
+            convert=dying_convert,
+        )
+        service.start()
+        try:
+            result = service.submit(JOB).wait(30)
+
+            assert result['status'] == 'failed'
+            assert result['error'] == 'worker died'
+            assert service.metrics()['pending'] == 0
+            assert service.health() == {'status': 'degraded', 'lost': 1}
+            # its place in the queue is free, & the pool still converts
+            other = service.submit(dict(JOB, item_bookpath='other'))
+            assert other.wait(30)['status'] == 'ok'
+        finally:
+            service.close()
+
+    def test_timed_out_conversion(self, tmpdir):
+        """ A stuck book's worker is killed, so the next book converts """
+        service = ConversionService(
+            out_dir=str(tmpdir), workers=1, queue_size=1,
+            convert=stuck_convert, book_timeout=1,
+        )
+        service.start()
+        try:
+            result = service.submit(JOB).wait(30)
+            assert result['error'] == 'timed out'
+
+            # the only worker was stuck; its replacement takes the next book
+            other = service.submit(dict(JOB, item_bookpath='other'))
+            assert other.wait(30)['status'] == 'ok'
+        finally:
+            service.close()
+
+    def test_epub_paths(self, service):
+        """ Books of different items with the same bookpath don't collide """
+        first = service.submit(JOB).wait(10)
+        second = service.submit(
+            dict(JOB, item_identifier='other', item_bookpath='a/item_bookpath')
+        ).wait(10)
+
+        assert first['out'] != second['out']
+        assert first['out'].endswith('item_identifier/item_bookpath.epub')
+        with pytest.raises(ValueError):
+            service.submit(dict(JOB, item_identifier='../elsewhere'))
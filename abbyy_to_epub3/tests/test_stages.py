@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import sys
+import threading
+import time
+
+import pytest
+
+from abbyy_to_epub3.instrumentation import Instrumentation
+from abbyy_to_epub3.stages import StageScheduler
+
+
+class TestStageScheduler(object):
+
+    def test_dependencies_first(self):
+        """ A stage only starts once the stages it depends on are done. """
+        order = []
+        stages = StageScheduler()
+        stages.add('a', lambda: order.append('a'))
+        stages.add('b', lambda: order.append('b'), after=['a'])
+        stages.add('c', lambda: order.append('c'), after=['a', 'b'])
+        stages.run()
+
+        assert order == ['a', 'b', 'c']
+        assert set(stages.timings) == {'a', 'b', 'c'}
+
+    def test_independent_overlap(self):
+        """ Independent stages run at the same time. """
+        both = threading.Barrier(2, timeout=5)
+        stages = StageScheduler()
+        stages.add('disk', both.wait)
+        stages.add('cpu', both.wait)
+
+        # run in sequence, the barrier would time out & break
+        stages.run()
+
+    def test_failure(self):
+        """ A failed stage stops its dependents & its error is re-raised. """
+        ran = []
+
+        def fail():
+            raise RuntimeError("broken")
+
+        stages = StageScheduler()
+        stages.add('fail', fail)
+        stages.add('after', lambda: ran.append('after'), after=['fail'])
+
+        with pytest.raises(RuntimeError, match='broken'):
+            stages.run()
+        assert ran == []
+
+    def test_exit(self):
+        """ A stage exiting the program still exits it. """
+        stages = StageScheduler()
+        stages.add('exit', lambda: sys.exit(1))
+
+        with pytest.raises(SystemExit):
+            stages.run()
+
+    def test_unknown_dependency(self):
+        """ Stages can only depend on stages added before them. """
+        stages = StageScheduler()
+
+        with pytest.raises(ValueError):
+            stages.add('b', lambda: None, after=['a'])
+
+    def test_critical_path(self):
+        """ The critical path follows the slowest chain of dependencies. """
+        stages = StageScheduler()
+        stages.add('slow', lambda: time.sleep(0.2))
+        stages.add('fast', lambda: None)
+        stages.add('last', lambda: None, after=['fast', 'slow'])
+        stages.run()
+
+        assert stages.critical_path() == ['slow', 'last']
+        assert '* slow' in stages.report()
+
+    def test_instrumentation(self):
+        """ Stages are recorded as spans when given an Instrumentation. """
+        instrumentation = Instrumentation()
+        stages = StageScheduler(instrumentation=instrumentation)
+        stages.add('a', lambda: None)
+        stages.add('b', lambda: None, after=['a'])
+        stages.run()
+
+        assert [span.name for span in instrumentation.spans] == ['a', 'b']
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from zipfile import ZipFile
+
+import gzip
+import io
+import os
+import threading
+import time
+
+import pytest
+
+from abbyy_to_epub3.workspace import (
+    ScratchLimit, ScratchQuotaExceeded, Workspace, gzip_size,
+    scratch_estimate,
+)
+
+
+@pytest.fixture
+def jp2_zip(tmpdir):
+    path = str(tmpdir.join('book_jp2.zip'))
+    with ZipFile(path, 'w') as f:
+        f.writestr('book_jp2/book_0001.jp2', b'a' * 100)
+        f.writestr('book_jp2/book_0002.jp2', b'b' * 300)
+    return path
+
+
+class TestWorkspace(object):
+
+    def test_temporary(self, tmpdir):
+        """ A temporary directory under root, removed on exit. """
+        with Workspace(root=str(tmpdir)) as workspace:
+            path = workspace.path
+            assert os.path.dirname(path) == str(tmpdir)
+        assert not os.path.exists(path)
+
+    def test_tmpfs(self, tmpdir):
+        """ tmpfs goes under the tmpfs directory, or root without one. """
+        tmpfs = tmpdir.mkdir('shm')
+        with Workspace('tmpfs', tmpfs_dir=str(tmpfs)) as workspace:
+            assert os.path.dirname(workspace.path) == str(tmpfs)
+        missing = str(tmpdir.join('missing'))
+        with Workspace(
+            'tmpfs', root=str(tmpdir), tmpfs_dir=missing,
+        ) as workspace:
+            assert os.path.dirname(workspace.path) == str(tmpdir)
+
+    def test_unknown_backing(self):
+        with pytest.raises(ValueError):
+            Workspace('floppy')
+
+    def test_quota(self, tmpdir):
+        """ Reservations past the quota fail, before anything's written. """
+        with Workspace(root=str(tmpdir), quota=100) as workspace:
+            workspace.reserve(60)
+            with pytest.raises(ScratchQuotaExceeded):
+                workspace.reserve(60, 'pages')
+            workspace.release(60)
+            workspace.reserve(100)
+            assert workspace.peak == 100
+
+    def test_copy_quota(self, tmpdir):
+        """ A stream is reserved as it's copied. """
+        data = os.urandom(3 * 2 ** 20)
+        with Workspace(root=str(tmpdir), quota=2 ** 21) as workspace:
+            with pytest.raises(ScratchQuotaExceeded):
+                workspace.copy(io.BytesIO(data), 'abbyy')
+            assert os.path.getsize(
+                os.path.join(workspace.path, 'abbyy')) == 2 ** 21
+        with Workspace(root=str(tmpdir)) as workspace:
+            path = workspace.copy(io.BytesIO(data), 'abbyy')
+            assert workspace.usage()['on_disk'] == len(data)
+            assert workspace.used == len(data)
+            with open(path, 'rb') as f:
+                assert f.read() == data
+
+    def test_extract(self, tmpdir, jp2_zip):
+        """ Unpacked files are reserved; those needed a while, released. """
+        with Workspace(root=str(tmpdir)) as workspace:
+            with workspace.extracted(
+                jp2_zip, 'book_jp2/book_0002.jp2', 'pages'
+            ) as path:
+                assert os.path.getsize(path) == 300
+                assert workspace.used == 300
+            assert not os.path.exists(path)
+            assert workspace.used == 0
+            with workspace.extracted(jp2_zip, 'nothing.jp2', 'pages') as path:
+                assert path is None
+
+            workspace.extract_all(jp2_zip)
+            assert workspace.used == 400
+            assert workspace.peak == 400
+            with pytest.raises(KeyError):
+                workspace.extract(jp2_zip, 'nothing.jp2', 'cover')
+
+    def test_extract_current(self, tmpdir, jp2_zip):
+        """ Only the latest file is kept, & it's unpacked once. """
+        with Workspace(root=str(tmpdir)) as workspace:
+            path = workspace.extract_current(
+                jp2_zip, 'book_jp2/book_0002.jp2', 'pages'
+            )
+            assert workspace.extract_current(
+                jp2_zip, 'book_jp2/book_0002.jp2', 'pages'
+            ) == path
+            assert workspace.used == 300
+            other = workspace.extract_current(
+                jp2_zip, 'book_jp2/book_0001.jp2', 'pages'
+            )
+            assert not os.path.exists(path)
+            assert workspace.used == 100
+            assert workspace.peak == 300
+            workspace.drop_current()
+            assert not os.path.exists(other)
+            assert workspace.used == 0
+            assert workspace.extract_current(
+                jp2_zip, 'nothing.jp2', 'pages'
+            ) is None
+
+    def test_directory(self, tmpdir):
+        """ A given directory is kept, & what's in it counts. """
+        directory = tmpdir.mkdir('work')
+        directory.join('abbyy').write('x' * 50)
+        with Workspace(directory=str(directory), quota=60) as workspace:
+            assert workspace.used == 50
+            with pytest.raises(ScratchQuotaExceeded):
+                workspace.reserve(20)
+        assert directory.join('abbyy').check()
+
+    def test_estimate(self, tmpdir, jp2_zip):
+        """ Every page & the ABBYY, or only two pages if not unpacking. """
+        abbyy_gz = str(tmpdir.join('book_abbyy.gz'))
+        with gzip.open(abbyy_gz, 'wb') as f:
+            f.write(b'<a/>' * 1000)
+        assert gzip_size(abbyy_gz) == 4000
+        assert scratch_estimate(abbyy_gz, jp2_zip) == 4000 + 400 + 300
+        assert scratch_estimate(abbyy_gz, jp2_zip, unpacks=False) == 400
+
+
+class TestScratchLimit(object):
+
+    def test_hold(self):
+        """ A hold waits until it fits; a hold over the limit runs alone """
+        limit = ScratchLimit(100)
+        order = []
+
+        def hold(nbytes):
+            with limit.hold(nbytes):
+                order.append(nbytes)
+                time.sleep(0.05)
+
+        with limit.hold(80):
+            waiting = threading.Thread(target=hold, args=(50, ))
+            waiting.start()
+            time.sleep(0.05)
+            assert order == []
+        waiting.join()
+        assert order == [50]
+
+        with limit.hold(500):
+            assert limit.held.value == 500
+        assert limit.held.value == 0
@@ -20,10 +20,10 @@ import json
 import logging
 import subprocess
 
-from distutils.version import LooseVersion
-from epubcheck import EpubCheck
 from pprint import pformat
 
+from abbyy_to_epub3.capabilities import registry as tools, version_tuple
+
 
 class EpubVerify(object):
     """
@@ -43,6 +43,9 @@ class EpubVerify(object):
 
     def run_epubcheck(self, epub):
         """ Runs epubcheck and stores the output. """
+        # Imported here: it's slow to load, & most runs don't validate
+        from epubcheck import EpubCheck
+
         result = EpubCheck(epub)
         self.results['epubcheck'] = result
 
@@ -65,20 +68,18 @@ class EpubVerify(object):
         """
 
         # Many OSs ship with older versions of NodeJS, which can cause Ace
-        # to fail silently. Do a version check!
-        try:
-            version_check = subprocess.Popen(
-                ['node', '--version'], stdout=subprocess.PIPE,
-            )
-        except FileNotFoundError as e:
+        # to fail silently. Do a version check! The probe runs once per
+        # process, not once per validation.
+        node = tools.probe('node')
+        if not node['available']:
             # Don't raise an exception, but log the error
-            self.logger.error("Node not present, but required for Ace:", e)
+            self.logger.error("Node not present, but required for Ace")
             return
-        vers, _ = version_check.communicate()
-        vers_string = vers.decode("utf-8").rstrip()
-        if LooseVersion(vers_string) <= LooseVersion('v6.4.0'):
+        if version_tuple(node['version']) <= (6, 4, 0):
             # Don't raise an exception, but log the error
-            self.logger.error("Node is {}, must be at least v6.4.0")
+            self.logger.error(
+                "Node is {}, must be at least v6.4.0".format(node['version'])
+            )
             return
 
         # Run the Ace checker
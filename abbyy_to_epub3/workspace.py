@@ -0,0 +1,318 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Scratch space for conversions: where the inputs are unpacked, on disk, on
+a RAM-backed tmpfs or hardly at all, with a quota on how much may be.
+"""
+
+from contextlib import contextmanager
+from zipfile import ZipFile
+
+import logging
+import multiprocessing
+import os
+import struct
+import tempfile
+import threading
+
+CHUNK = 2 ** 20  # bytes copied at a time, each reserved before it's written
+
+
+class ScratchQuotaExceeded(RuntimeError):
+    """ A conversion tried to unpack more than its workspace's quota """
+
+
+def disk_usage(path):
+    """ Bytes in the files under path """
+    total = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass  # removed while we looked
+    return total
+
+
+def gzip_size(path):
+    """
+    The uncompressed size of a gzip file, from its trailer, which only
+    holds it modulo 4 GiB: it's taken to be at least the compressed size,
+    less the little that deflate & the header can add.
+    """
+    with open(path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        (size, ) = struct.unpack('<I', f.read(4))
+        compressed = f.tell()
+    while size < compressed - compressed // 2 ** 12 - 2 ** 16:
+        size += 2 ** 32
+    return size
+
+
+def scratch_estimate(abbyy_gz, jp2_zip, unpacks=True):
+    """
+    The most bytes a conversion of these inputs unpacks: the ABBYY, every
+    page image & the cover leaf, which may be read before the rest; or,
+    when nothing is unpacked, the cover & the page being decoded. Page
+    images are taken to be the largest.
+    """
+    with ZipFile(jp2_zip) as f:
+        sizes = sorted(info.file_size for info in f.infolist())
+    if unpacks:
+        return gzip_size(abbyy_gz) + sum(sizes) + sum(sizes[-1:])
+    return sum(sizes[-2:])
+
+
+class Workspace(object):
+    """
+    A conversion's scratch directory, & an account of the bytes unpacked
+    into it.
+
+    The backing is where it lives & how much goes in it:
+
+    - `disk`: a temporary directory under `root`, or the system's default;
+      the ABBYY & all the page images are unpacked into it.
+    - `tmpfs`: as `disk`, but under `tmpfs_dir`, a RAM-backed file system,
+      so nothing waits on the disk. Memory is used instead, so this suits
+      books which fit comfortably.
+    - `memory`: nothing is unpacked. The ABBYY is parsed straight from its
+      gzip, and page images are read from their zip one at a time, as
+      they're needed. The little that is written goes under `tmpfs_dir`.
+
+    Without the tmpfs directory, `tmpfs` & `memory` fall back to `root`.
+    Given a `directory`, such as a work directory of checkpoints, that's
+    used & kept instead of a temporary one, & what's already in it counts
+    against the quota.
+
+    With a `quota`, in bytes, `reserve` raises ScratchQuotaExceeded rather
+    than let the workspace hold more, before anything is written. Files
+    are reserved as they're unpacked; the Ace results, which are small,
+    aren't, but count in the `usage` at the end. Use as a context manager:
+    the temporary directory is removed on exit.
+    """
+
+    BACKINGS = ('disk', 'tmpfs', 'memory')
+
+    def __init__(
+        self, backing='disk', root=None, tmpfs_dir='/dev/shm', quota=0,
+        directory=None, debug=False,
+    ):
+        self.logger = logging.getLogger(__name__)
+        if debug:
+            self.logger.addHandler(logging.StreamHandler())
+            self.logger.setLevel(logging.DEBUG)
+
+        if backing not in self.BACKINGS:
+            raise ValueError("Unknown workspace backing: {}".format(backing))
+        self.backing = backing
+        self.root = os.path.abspath(root) if root else None
+        if backing != 'disk':
+            if tmpfs_dir and os.path.isdir(tmpfs_dir):
+                self.root = tmpfs_dir
+            else:
+                self.logger.warning(
+                    "No tmpfs at {}: using {} for the {} workspace".format(
+                        tmpfs_dir, self.root or tempfile.gettempdir(),
+                        backing))
+        self.quota = quota or 0
+        self.directory = directory
+        self.path = None
+        self.used = 0  # bytes reserved
+        self.peak = 0
+        self.lock = threading.Lock()
+        self._tmp = None
+        self._current = None  # (zip_path, member, subdir, path) kept
+
+    @property
+    def unpacks(self):
+        """ Whether the ABBYY & the page images are unpacked """
+        return self.backing != 'memory'
+
+    def __enter__(self):
+        if self.directory:
+            self.path = os.path.abspath(self.directory)
+            os.makedirs(self.path, exist_ok=True)
+            self.reserve(disk_usage(self.path), 'earlier runs')
+        else:
+            if self.root:
+                os.makedirs(self.root, exist_ok=True)
+            # Even if we clean up properly afterwards, using
+            # TemporaryDirectory outside of a context manager seems to
+            # cause a resource leak
+            self._tmp = tempfile.TemporaryDirectory(dir=self.root)
+            self.path = self._tmp.name
+        self.logger.debug("{} workspace: {}".format(self.backing, self.path))
+        return self
+
+    def __exit__(self, *exc):
+        self._current = None
+        if self._tmp:
+            self._tmp.cleanup()
+            self._tmp = None
+
+    def reserve(self, nbytes, what=''):
+        """
+        Account for nbytes about to be written, raising
+        ScratchQuotaExceeded if they don't fit in the quota.
+        """
+        with self.lock:
+            if self.quota and self.used + nbytes > self.quota:
+                raise ScratchQuotaExceeded(
+                    "{} bytes for {} would take the {} workspace past its "
+                    "quota: {} of {} bytes are used".format(
+                        nbytes, what or 'scratch', self.backing, self.used,
+                        self.quota))
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+
+    def release(self, nbytes):
+        """ Account for nbytes removed """
+        with self.lock:
+            self.used -= nbytes
+
+    def usage(self):
+        """
+        The workspace's backing & quota, the bytes reserved now & at most,
+        and the bytes actually in its directory, for reports
+        """
+        return {
+            'backing': self.backing,
+            'path': self.path,
+            'quota': self.quota,
+            'used': self.used,
+            'peak': self.peak,
+            'on_disk': disk_usage(self.path) if self.path else 0,
+        }
+
+    def copy(self, infile, path):
+        """
+        Write a stream, such as an opened gzip, to path in the workspace,
+        reserving each chunk before it's written.
+        """
+        path = os.path.join(self.path, path)
+        with open(path, 'wb') as outfile:
+            for chunk in iter(lambda: infile.read(CHUNK), b''):
+                self.reserve(len(chunk), os.path.basename(path))
+                outfile.write(chunk)
+        return path
+
+    def extract_all(self, zip_path):
+        """ Unpack a whole zip file into the workspace """
+        with ZipFile(zip_path) as f:
+            self.reserve(
+                sum(info.file_size for info in f.infolist()),
+                os.path.basename(zip_path))
+            f.extractall(self.path)
+
+    def extract(self, zip_path, member, subdir):
+        """
+        Unpack one member of a zip file under subdir of the workspace, so
+        it can't collide with the whole zip being unpacked, & return its
+        path. Raises KeyError if it isn't there.
+        """
+        with ZipFile(zip_path) as f:
+            info = f.getinfo(member)
+            self.reserve(info.file_size, member)
+            return f.extract(info, os.path.join(self.path, subdir))
+
+    @contextmanager
+    def extracted(self, zip_path, member, subdir):
+        """
+        As `extract`, for a file only needed for a while: it's removed, &
+        its bytes released, when the context ends. Gives None if the member
+        isn't there.
+        """
+        try:
+            path = self.extract(zip_path, member, subdir)
+        except KeyError:
+            yield None
+            return
+        try:
+            yield path
+        finally:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.release(size)
+
+    def extract_current(self, zip_path, member, subdir):
+        """
+        As `extract`, for files needed one after another, such as the page
+        images of a book, each perhaps several times in a row: only the
+        current one is kept. Extracting another removes it, & releases its
+        bytes; asking for it again gives it without unpacking it afresh.
+        Gives None if the member isn't there. `drop_current` removes the
+        one kept.
+        """
+        if self._current and self._current[:3] == (zip_path, member, subdir):
+            return self._current[3]
+        self.drop_current()
+        try:
+            path = self.extract(zip_path, member, subdir)
+        except KeyError:
+            return None
+        self._current = (zip_path, member, subdir, path)
+        return path
+
+    def drop_current(self):
+        """ Remove the file kept by `extract_current`, if there is one """
+        if self._current:
+            path = self._current[3]
+            self._current = None
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.release(size)
+
+
+class ScratchLimit(object):
+    """
+    A ceiling on the scratch bytes held by the conversions running at once,
+    in any of the processes sharing it: a batch's workers, say. Pass it to
+    the processes when they start. A conversion holds its estimated bytes
+    for as long as it runs, waiting until they fit; one bigger than the
+    whole limit runs when nothing else holds any, rather than never.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.condition = multiprocessing.Condition()
+        self.held = multiprocessing.Value('q', 0, lock=False)
+
+    def fits(self, nbytes):
+        return self.held.value == 0 or self.held.value + nbytes <= self.limit
+
+    @contextmanager
+    def hold(self, nbytes):
+        """ Hold nbytes of the limit, waiting for room, within the context """
+        with self.condition:
+            self.condition.wait_for(lambda: self.fits(nbytes))
+            self.held.value += nbytes
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+    def release(self, nbytes):
+        """
+        Give back nbytes of the limit: as a hold ends, or for a conversion
+        whose process was killed while holding them.
+        """
+        with self.condition:
+            self.held.value -= nbytes
+            self.condition.notify_all()
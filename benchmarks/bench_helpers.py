@@ -0,0 +1,391 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Micro-benchmarks of the helpers called once per line, block or page.
+
+    python -m benchmarks.bench_helpers run [--output baseline.json]
+    python -m benchmarks.bench_helpers compare baseline.json new.json
+
+`run` times each helper on realistic input: the lines, blocks & pages of a
+synthetic FineReader 10 book from benchmarks.corpus, and of the FineReader 6
+test fixture. Every case is timed in several samples, each long enough to
+measure, and the per-operation times are saved with the environment as a
+JSON baseline.
+
+`compare` lines up two runs & flags a case as slower when its median time
+per operation grew by more than --threshold, and a one-sided Mann-Whitney U
+test finds the difference significant at --alpha. It exits with status 1 if
+anything is slower, so it can gate a change.
+"""
+
+from statistics import NormalDist, median
+from lxml import etree
+
+import argparse
+import gzip
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from abbyy_to_epub3 import utils
+from abbyy_to_epub3.create_epub import Ebook
+from abbyy_to_epub3.geometry import BoxIndex
+from abbyy_to_epub3.parse_abbyy import AbbyyParser, add_last_text
+from benchmarks.common import write_results
+from benchmarks.corpus import generate_item
+
+TEST_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'abbyy_to_epub3', 'tests',
+)
+MIN_SAMPLE_SECONDS = 0.02
+
+
+class Inputs(object):
+    """
+    Everything the cases work on, made once: a synthetic item, its parsed
+    ABBYY, and the raw XML of its pages.
+    """
+
+    def __init__(self, directory, pages):
+        generate_item(directory, pages=pages, jp2_variants=1,
+                      jp2_size=(400, 600))
+        self.item_dir = directory
+        self.abbyy = os.path.join(directory, 'synthetic_abbyy')
+        with gzip.open(self.abbyy + '.gz', 'rb') as infile:
+            with open(self.abbyy, 'wb') as outfile:
+                shutil.copyfileobj(infile, outfile)
+        self.meta = os.path.join(directory, 'synthetic_meta.xml')
+
+        self.parser = self.new_parser()
+        self.parser.parse_abbyy()
+        self.blocks = self.parser.blocks
+        self.ns = self.parser.ns
+
+        tree = etree.parse(self.abbyy)
+        self.page_xml = [
+            etree.tostring(page)
+            for page in tree.iter('{{{}}}page'.format(self.ns))
+        ]
+        fr6 = etree.parse(os.path.join(TEST_DIR, 'finereader_6_sample.xml'))
+        self.lines = (
+            list(tree.iter('{{{}}}line'.format(self.ns))) +
+            list(fr6.iter('{{{}}}line'.format(fr6.getroot().nsmap[None])))
+        )
+        self.line_texts = [utils.gettext(line).strip() for line in self.lines]
+
+    def new_parser(self, blocks=None):
+        return AbbyyParser(
+            self.abbyy, self.meta, {}, {}, [] if blocks is None else blocks
+        )
+
+
+# Each case takes the Inputs & returns (setup, run, operations): setup makes
+# fresh state for one timed call of run(state), which does `operations`
+# calls of the helper. Cases whose run consumes its state are marked.
+
+def case_gettext(inputs):
+    return (lambda: inputs.lines,
+            lambda lines: [utils.gettext(line) for line in lines],
+            len(inputs.lines))
+
+
+def case_sanitize_xml(inputs):
+    return (lambda: inputs.line_texts,
+            lambda texts: [utils.sanitize_xml(text) for text in texts],
+            len(inputs.line_texts))
+
+
+def case_dirtify_xml(inputs):
+    sanitized = [utils.sanitize_xml(text) for text in inputs.line_texts]
+    return (lambda: sanitized,
+            lambda texts: [utils.dirtify_xml(text) for text in texts],
+            len(sanitized))
+
+
+def case_is_increasing(inputs):
+    # the page numbers of a long book, all checked as none are out of order
+    numbers = list(range(1, 1001))
+    return (lambda: numbers, utils.is_increasing, 1)
+
+
+def case_fast_iter(inputs):
+    def setup():
+        return etree.iterparse(
+            inputs.abbyy, events=('end',),
+            tag='{{{}}}page'.format(inputs.ns))
+    return (setup,
+            lambda context: utils.fast_iter(context, lambda elem: None),
+            len(inputs.page_xml))
+case_fast_iter.consumes = True
+
+
+def case_add_last_text(inputs):
+    # as the parser calls it: at the end of each page, with all the blocks
+    # so far
+    ends = {}
+    for (i, block) in enumerate(inputs.blocks):
+        if 'page_no' in block:
+            ends[block['page_no']] = i + 1
+    prefixes = [
+        (page, inputs.blocks[:end]) for (page, end) in sorted(ends.items())
+    ]
+
+    def run(prefixes):
+        for (page, blocks) in prefixes:
+            add_last_text(blocks, page)
+    return (lambda: prefixes, run, len(prefixes))
+
+
+def case_parse_block(inputs):
+    def setup():
+        parser = inputs.new_parser()
+        parser.find_namespace()
+        parser.paragraphs.update(inputs.parser.paragraphs)
+        parser.metadata.update(inputs.parser.metadata)
+        parser.metadata['pics_by_page'] = BoxIndex()
+        parser.metadata['text_by_page'] = BoxIndex()
+        pages = [etree.fromstring(xml) for xml in inputs.page_xml]
+        return (parser, pages)
+
+    def run(state):
+        (parser, pages) = state
+        for page in pages:
+            parser.pagewidth = page.get('width')
+            parser.pageheight = page.get('height')
+            parser.newpage = True
+            for block in page:
+                parser.parse_block(block)
+            parser.page_no += 1
+    operations = sum(
+        len(etree.fromstring(xml)) for xml in inputs.page_xml
+    )
+    return (setup, run, operations)
+case_parse_block.consumes = True
+
+
+def case_is_header_footer(inputs):
+    book = Ebook(inputs.item_dir, 'synthetic', 'synthetic')
+    book.blocks = inputs.blocks
+    book.identify_headers_footers_pagenos('first')
+    book.identify_headers_footers_pagenos('last')
+    candidates = [
+        (block, placement)
+        for block in inputs.blocks
+        for placement in ('first', 'last')
+        if placement in block
+    ]
+
+    def run(candidates):
+        for (block, placement) in candidates:
+            book.is_header_footer(block, placement)
+    return (lambda: candidates, run, len(candidates))
+
+
+def case_image_dim(inputs):
+    book = Ebook(inputs.item_dir, 'synthetic', 'synthetic')
+    pictures = [
+        block for block in inputs.blocks if block.get('type') == 'Picture'
+    ]
+    return (lambda: pictures,
+            lambda pictures: [book.image_dim(block) for block in pictures],
+            len(pictures))
+
+
+CASES = {
+    name[len('case_'):]: func
+    for (name, func) in sorted(globals().items())
+    if name.startswith('case_')
+}
+
+
+def time_case(case, inputs, samples):
+    """
+    Seconds per operation, one figure per sample. Each sample loops over
+    run enough times to take at least MIN_SAMPLE_SECONDS, unless run
+    consumes its state, when every call gets fresh state from setup.
+    """
+    (setup, run, operations) = case(inputs)
+    consumes = getattr(case, 'consumes', False)
+    loops = 1
+    run(setup())   # warm up caches & lazy imports
+    if not consumes:
+        state = setup()
+        while True:
+            start = time.perf_counter()
+            for _ in range(loops):
+                run(state)
+            if time.perf_counter() - start >= MIN_SAMPLE_SECONDS:
+                break
+            loops *= 2
+
+    per_op = []
+    for _ in range(samples):
+        elapsed = 0.0
+        state = setup()
+        for _ in range(loops):
+            if consumes:
+                state = setup()
+            start = time.perf_counter()
+            run(state)
+            elapsed += time.perf_counter() - start
+        per_op.append(elapsed / loops / max(operations, 1))
+    return {
+        'operations': operations,
+        'loops': loops,
+        'samples': per_op,
+        'median': median(per_op),
+    }
+
+
+def mann_whitney_greater(base, new):
+    """
+    One-sided p-value that `new` tends to be larger than `base`, from the
+    Mann-Whitney U test's normal approximation, corrected for ties.
+    """
+    (n1, n2) = (len(base), len(new))
+    pooled = sorted(
+        [(value, 0) for value in base] + [(value, 1) for value in new]
+    )
+    ranks = [0.0] * len(pooled)
+    ties = 0.0
+    i = 0
+    while i < len(pooled):
+        j = i
+        while j + 1 < len(pooled) and pooled[j + 1][0] == pooled[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2 + 1
+        count = j - i + 1
+        ties += count ** 3 - count
+        i = j + 1
+    rank_sum = sum(
+        rank for (rank, (_, group)) in zip(ranks, pooled) if group == 1
+    )
+    u = rank_sum - n2 * (n2 + 1) / 2
+    n = n1 + n2
+    variance = n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (u - n1 * n2 / 2 - 0.5) / math.sqrt(variance)
+    return 1 - NormalDist().cdf(z)
+
+
+def compare(base, new, threshold=0.05, alpha=0.01):
+    """
+    Compare two runs' results, case by case. Returns a list of dicts with
+    the median ratio, p-value & verdict: 'slower', 'faster' or 'same'.
+    """
+    rows = []
+    for name in sorted(set(base) & set(new)):
+        (a, b) = (base[name]['samples'], new[name]['samples'])
+        ratio = median(b) / median(a)
+        verdict = 'same'
+        if ratio > 1 + threshold and mann_whitney_greater(a, b) < alpha:
+            verdict = 'slower'
+        elif ratio < 1 - threshold and mann_whitney_greater(b, a) < alpha:
+            verdict = 'faster'
+        rows.append({
+            'case': name,
+            'base_median': median(a),
+            'new_median': median(b),
+            'ratio': ratio,
+            'p_slower': mann_whitney_greater(a, b),
+            'verdict': verdict,
+        })
+    return rows
+
+
+def run(args):
+    cases = args.case or list(CASES)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inputs = Inputs(tmpdir, args.pages)
+        results = {
+            name: time_case(CASES[name], inputs, args.samples)
+            for name in cases
+        }
+    write_results(args.output, 'helpers', results)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def run_compare(args):
+    rows = compare(
+        load_results(args.base), load_results(args.new),
+        threshold=args.threshold, alpha=args.alpha,
+    )
+    print('{:<20} {:>12} {:>12} {:>7} {:>8}  {}'.format(
+        'case', 'base (us)', 'new (us)', 'ratio', 'p', 'verdict'))
+    for row in rows:
+        print('{case:<20} {base:12.3f} {new:12.3f} {ratio:7.3f} '
+              '{p:8.4f}  {verdict}'.format(
+                  case=row['case'], base=row['base_median'] * 1e6,
+                  new=row['new_median'] * 1e6, ratio=row['ratio'],
+                  p=row['p_slower'], verdict=row['verdict'].upper()
+                  if row['verdict'] == 'slower' else row['verdict']))
+    if any(row['verdict'] == 'slower' for row in rows):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help='Time the helpers')
+    run_parser.add_argument('--output', help='Write JSON results here')
+    run_parser.add_argument('--samples', type=int, default=15)
+    run_parser.add_argument(
+        '--pages', type=int, default=60,
+        help='Pages in the synthetic book the inputs come from',
+    )
+    run_parser.add_argument(
+        '--case', action='append', choices=sorted(CASES),
+        help='Only time this helper; may be repeated',
+    )
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser(
+        'compare', help='Flag significant slowdowns between two runs')
+    compare_parser.add_argument('base', help='Baseline results JSON')
+    compare_parser.add_argument('new', help='New results JSON')
+    compare_parser.add_argument(
+        '--threshold', type=float, default=0.05,
+        help='Smallest change in median to report, as a fraction',
+    )
+    compare_parser.add_argument(
+        '--alpha', type=float, default=0.01,
+        help='Significance level of the Mann-Whitney U test',
+    )
+    compare_parser.set_defaults(func=run_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare the image libraries behind image_processing.factory on synthetic
+JP2 pages of several sizes and tilings.
+
+    python -m benchmarks.bench_image_backends [--output results.json]
+
+For each backend, page and case it records decode time, encode time, peak
+RSS & encoded bytes. The cases are:
+
+- cover: the whole page, decoded at reduced resolution to cover size
+- small_crop / large_crop: one region of about 1% / 40% of the page
+- batch_crops: ten small regions of the same page, decoded one by one
+
+Pillow decodes JPEG 2000 with OpenJPEG, so it stands for the OpenJPEG path.
+Backends which aren't installed are skipped, & listed in the output.
+"""
+
+from multiprocessing import Pool
+from PIL import Image
+
+import argparse
+import os
+import tempfile
+
+from abbyy_to_epub3.capabilities import IMAGE_BACKENDS, registry as tools
+from abbyy_to_epub3.image_output import OutputProfile, encode_image
+from abbyy_to_epub3.image_processing import factory as ImageFactory
+from benchmarks.common import Timer, peak_rss_kb, write_results
+
+SIZES = [(1500, 2200), (3000, 4400)]
+TILINGS = [None, (512, 512), (1024, 1024)]
+COVER_BOX = (800, 1200)
+
+# Regions as (left, top, right, bottom) fractions of the page
+CASES = {
+    'small_crop': [(0.45, 0.45, 0.55, 0.55)],
+    'large_crop': [(0.1, 0.1, 0.75, 0.7)],
+    'batch_crops': [
+        (0.05 + 0.09 * i, 0.4, 0.13 + 0.09 * i, 0.5) for i in range(10)
+    ],
+}
+
+
+def dimensions(text):
+    """ Parse WxH, as given on the command line """
+    (width, height) = text.lower().split('x')
+    return (int(width), int(height))
+
+
+def make_page(directory, size, tiling):
+    """ Save a synthetic scan: noise for photographs, with black 'text'. """
+    name = 'page_{}x{}_{}.jp2'.format(
+        size[0], size[1], 'x'.join(map(str, tiling)) if tiling else 'untiled'
+    )
+    path = os.path.join(directory, name)
+    im = Image.effect_noise(size, 40).convert('RGB')
+    for top in range(size[1] // 10, size[1] // 2, 60):
+        im.paste((0, 0, 0), (size[0] // 10, top, size[0] * 9 // 10, top + 20))
+    params = {'irreversible': True, 'num_resolutions': 6}
+    if tiling:
+        params['tile_size'] = tiling
+    im.save(path, **params)
+    return path
+
+
+def run_case(args):
+    """ Time one case in a fresh worker process, so RSS is its own. """
+    (backend, page, case) = args
+    processor = ImageFactory(backend)
+    profile = OutputProfile('benchmark', max_width=1600)
+    pagedim = processor.dimensions(page)
+    decode_s = encode_s = 0.0
+    output_bytes = 0
+
+    if case == 'cover':
+        with Timer() as t:
+            im = processor.decode_to_fit(page, COVER_BOX)
+        decode_s += t.seconds
+        images = [im]
+    else:
+        images = []
+        for (left, top, right, bottom) in CASES[case]:
+            dim = (
+                int(left * pagedim[0]), int(top * pagedim[1]),
+                int(right * pagedim[0]), int(bottom * pagedim[1]),
+            )
+            with Timer() as t:
+                images.append(processor.decode(page, dim=dim, pagedim=pagedim))
+            decode_s += t.seconds
+
+    for im in images:
+        with Timer() as t:
+            encoded = encode_image(im, profile)
+        encode_s += t.seconds
+        output_bytes += len(encoded.data)
+
+    return {
+        'backend': backend,
+        'page': os.path.basename(page),
+        'case': case,
+        'decodes': len(images),
+        'decode_s': decode_s,
+        'encode_s': encode_s,
+        'peak_rss_kb': peak_rss_kb(),
+        'output_bytes': output_bytes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--output', help='Write JSON results to this file')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--backend', action='append', choices=IMAGE_BACKENDS,
+        help='Only benchmark this backend; may be repeated',
+    )
+    parser.add_argument(
+        '--size', action='append', type=dimensions,
+        help='Page size as WxH, instead of the defaults; may be repeated',
+    )
+    parser.add_argument(
+        '--tiling', action='append', type=dimensions,
+        help='Tile size as WxH, instead of the defaults; may be repeated',
+    )
+    args = parser.parse_args()
+
+    backends = args.backend or IMAGE_BACKENDS
+    skipped = [b for b in backends if not tools.available(b)]
+    backends = [b for b in backends if b not in skipped]
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pages = [
+            make_page(tmpdir, size, tiling)
+            for size in args.size or SIZES
+            for tiling in args.tiling or TILINGS
+        ]
+        tasks = [
+            (backend, page, case)
+            for backend in backends
+            for page in pages
+            for case in ['cover'] + list(CASES)
+            for _ in range(args.repeat)
+        ]
+        with Pool(maxtasksperchild=1) as pool:
+            results = pool.map(run_case, tasks, chunksize=1)
+
+    write_results(args.output, 'image_backends', {
+        'skipped_backends': skipped,
+        'runs': results,
+    })
+
+
+if __name__ == "__main__":
+    main()
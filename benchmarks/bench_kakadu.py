@@ -0,0 +1,140 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Per-image cost of the in-process Kakadu path against the old
+kdu_expand -> BMP -> bmptopnm -> pnmtopng chain.
+
+    python -m benchmarks.bench_kakadu [--repeat N] [image.jp2 ...]
+
+With no images given, synthetic JP2 pages are generated with Pillow.
+Prints one JSON object per image & method. Exits cleanly if kdu_expand or
+the netpbm tools aren't installed.
+"""
+
+from PIL import Image
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from abbyy_to_epub3.image_processing import factory as ImageFactory
+
+REGIONS = {
+    'full': False,
+    'quarter': (0.25, 0.25, 0.5, 0.5),
+}
+
+
+def legacy_crop(origfile, outfile, region_string, discard_level=2):
+    """ The pre-Pillow Kakadu chain, kept here only for comparison. """
+    subprocess.run([
+        'kdu_expand',
+        '-region', region_string,
+        '-reduce', str(discard_level),
+        '-i', origfile,
+        '-o', outfile + '.bmp'
+    ], stdout=subprocess.DEVNULL, check=True)
+    p_pnm = subprocess.Popen(
+        ['bmptopnm', outfile + '.bmp'],
+        stderr=subprocess.DEVNULL, stdout=subprocess.PIPE,
+    )
+    p_png = subprocess.Popen(
+        'pnmtopng',
+        stderr=subprocess.DEVNULL, stdin=p_pnm.stdout, stdout=subprocess.PIPE,
+    )
+    pngout, _ = p_png.communicate()
+    with open(outfile, 'wb') as fh:
+        fh.write(pngout)
+
+
+def synthetic_pages(tmpdir):
+    """ Write a couple of noisy JP2 pages of typical scan sizes. """
+    pages = []
+    for width, height in ((1500, 2200), (3000, 4400)):
+        path = os.path.join(tmpdir, 'page_{}x{}.jp2'.format(width, height))
+        Image.effect_noise((width, height), 64).convert('RGB').save(path)
+        pages.append(path)
+    return pages
+
+
+def run(images, repeat):
+    processor = ImageFactory('kakadu')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        images = images or synthetic_pages(tmpdir)
+        outfile = os.path.join(tmpdir, 'out.png')
+        for image in images:
+            with Image.open(image) as im:
+                pagedim = im.size
+            for name, region in REGIONS.items():
+                if region:
+                    (x, y, w, h) = region
+                    dim = (
+                        x * pagedim[0], y * pagedim[1],
+                        (x + w) * pagedim[0], (y + h) * pagedim[1],
+                    )
+                    region_string = "{%s,%s},{%s,%s}" % (y, x, h, w)
+                else:
+                    dim = False
+                    region_string = "{0.0,0.0},{1.0,1.0}"
+
+                methods = {
+                    'legacy': lambda: legacy_crop(
+                        image, outfile, region_string),
+                    'in_process': lambda: processor.crop_image(
+                        image, outfile, dim=dim, pagedim=pagedim),
+                }
+                for method, call in methods.items():
+                    timings = []
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        call()
+                        timings.append(time.perf_counter() - start)
+                    print(json.dumps({
+                        'image': os.path.basename(image),
+                        'region': name,
+                        'method': method,
+                        'best_s': min(timings),
+                        'mean_s': sum(timings) / len(timings),
+                        'bytes': os.path.getsize(outfile),
+                    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('images', nargs='*', help='JP2 files to decode')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    missing = [
+        tool for tool in ('kdu_expand', 'bmptopnm', 'pnmtopng')
+        if not shutil.which(tool)
+    ]
+    if missing:
+        print("Skipping: {} not installed".format(', '.join(missing)))
+        sys.exit(0)
+    run(args.images, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
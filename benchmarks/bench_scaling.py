@@ -0,0 +1,142 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+How conversion time & memory grow with book size, on synthetic books.
+
+    python -m benchmarks.bench_scaling [--pages N ...] [--version FR10|FR6]
+        [--corpus DIR] [--output results.json]
+
+For each ABBYY version & size, a book is generated with benchmarks.corpus
+(or reused from --corpus DIR, if already there), then converted by
+Ebook.craft_epub in a fresh process, so peak memory is its own. Each run
+records total wall time & peak RSS, and per stage the wall & CPU time and
+memory high-water mark, with the conversion counters. Per-page costs make
+runs of different sizes comparable.
+
+Generating & converting 10,000 pages takes a long time; the default sizes
+are 100 & 1,000 pages.
+"""
+
+from multiprocessing import Pool
+
+import argparse
+import os
+import tempfile
+
+from abbyy_to_epub3.create_epub import Ebook
+from benchmarks.common import Timer, peak_rss_kb, write_results
+from benchmarks.corpus import VERSIONS, dimensions, generate_item, parse_mix
+
+SIZES = [100, 1000]
+
+
+def corpus_item(corpus, version, pages, options):
+    """ The item directory for a book, generating it if it's not there. """
+    item_dir = os.path.join(corpus, '{}_{}'.format(version, pages))
+    if not os.path.exists(os.path.join(item_dir, 'synthetic_jp2.zip')):
+        generate_item(item_dir, pages=pages, version=version, **options)
+    return item_dir
+
+
+def convert(args):
+    """ Convert one book in a fresh worker process & report on it. """
+    (item_dir, version, pages, backend, run) = args
+    with tempfile.TemporaryDirectory() as tmpdir:
+        book = Ebook(
+            item_dir, 'synthetic', 'synthetic',
+            image_backend=backend, memory=True,
+        )
+        with Timer() as t:
+            book.craft_epub(epub_outfile=os.path.join(tmpdir, 'out.epub'))
+    report = book.instrumentation.report()
+    memory = report.pop('memory')
+    stages = {
+        name: {
+            'wall_s': totals['wall'],
+            'cpu_s': totals['cpu'],
+            'peak_rss_kb': memory['stages'][name]['rss_peak'] // 1024,
+        }
+        for (name, totals) in report['spans']['stage'].items()
+    }
+    return {
+        'version': version,
+        'pages': pages,
+        'run': run,
+        'wall_s': t.seconds,
+        'ms_per_page': t.seconds * 1000 / pages,
+        'peak_rss_kb': peak_rss_kb(),
+        'stages': stages,
+        'steps': {
+            category: totals
+            for (category, totals) in report['spans'].items()
+            if category != 'stage'
+        },
+        'counters': report['counters'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--output', help='Write JSON results to this file')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument(
+        '--pages', action='append', type=int,
+        help='Book size in pages, instead of the defaults; may be repeated',
+    )
+    parser.add_argument(
+        '--version', action='append', choices=sorted(VERSIONS),
+        help='Only benchmark this ABBYY version; may be repeated',
+    )
+    parser.add_argument(
+        '--corpus',
+        help='Keep generated books in this directory & reuse them',
+    )
+    parser.add_argument(
+        '--backend', default='auto', choices=['auto', 'kakadu', 'pillow'],
+    )
+    parser.add_argument('--mix', type=parse_mix, default=None)
+    parser.add_argument('--jp2-size', type=dimensions, default=(1000, 1500))
+    args = parser.parse_args()
+
+    options = {'mix': args.mix, 'jp2_size': args.jp2_size}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        corpus = args.corpus or tmpdir
+        tasks = [
+            (corpus_item(corpus, version, pages, options),
+             version, pages, args.backend, run)
+            for version in args.version or sorted(VERSIONS)
+            for pages in args.pages or SIZES
+            for run in range(args.repeat)
+        ]
+        with Pool(maxtasksperchild=1) as pool:
+            results = pool.map(convert, tasks, chunksize=1)
+
+    write_results(args.output, 'scaling', {
+        'options': {
+            'backend': args.backend,
+            'jp2_size': args.jp2_size,
+            'mix': args.mix,
+        },
+        'runs': results,
+    })
+
+
+if __name__ == "__main__":
+    main()
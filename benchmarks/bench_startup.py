@@ -0,0 +1,106 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Startup cost of the command line tool, which the orchestrator pays once per
+item.
+
+    python -m benchmarks.bench_startup [--repeat 20] [--max-seconds 0.3]
+
+Each case runs in a fresh interpreter, so nothing is already imported: the
+bare interpreter as a floor, importing `abbyy_to_epub3.commandline`, and
+`abbyy2epub --help`. The median & best times are reported, and with
+--max-seconds the benchmark exits with status 1 if the median of any
+case other than the floor is slower, so it can guard the startup time.
+"""
+
+from statistics import median
+
+import argparse
+import subprocess
+import sys
+import time
+
+from benchmarks.common import write_results
+
+CASES = {
+    'interpreter': 'pass',
+    'import': 'import abbyy_to_epub3.commandline',
+    'help': (
+        'import sys; sys.argv = ["abbyy2epub", "--help"]\n'
+        'from abbyy_to_epub3.commandline import main\n'
+        'try:\n'
+        '    main()\n'
+        'except SystemExit:\n'
+        '    pass\n'
+    ),
+}
+
+
+def time_case(code, repeat):
+    """ Seconds taken by each of `repeat` fresh interpreters running code """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-c', code],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--output', help='Write JSON results here')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument(
+        '--max-seconds', type=float, default=None,
+        help='Fail if the median import or --help time is slower than this',
+    )
+    args = parser.parse_args()
+
+    # One untimed run, so that the timed ones find the bytecode compiled
+    time_case(CASES['import'], 1)
+
+    results = {}
+    for name, code in CASES.items():
+        times = time_case(code, args.repeat)
+        results[name] = {
+            'median': median(times),
+            'best': min(times),
+            'samples': times,
+        }
+        print('{:<12} median {:7.1f} ms  best {:7.1f} ms'.format(
+            name, median(times) * 1e3, min(times) * 1e3), file=sys.stderr)
+    write_results(args.output, 'startup', results)
+
+    if args.max_seconds is not None:
+        slow = [
+            name for name, result in results.items()
+            if name != 'interpreter' and result['median'] > args.max_seconds
+        ]
+        if slow:
+            print('Slower than {}s: {}'.format(
+                args.max_seconds, ', '.join(slow)), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
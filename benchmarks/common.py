@@ -0,0 +1,82 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Helpers shared by the benchmarks: timing, memory high-water marks and
+machine-readable results.
+"""
+
+import json
+import platform
+import resource
+import sys
+import time
+
+from abbyy_to_epub3 import __version__
+from abbyy_to_epub3.capabilities import registry as tools
+
+
+def peak_rss_kb():
+    """
+    The highest resident set size of this process & its finished children,
+    in KiB. Linux reports ru_maxrss in KiB, macOS in bytes.
+    """
+    scale = 1024 if sys.platform == 'darwin' else 1
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) // scale
+
+
+class Timer(object):
+    """ Context manager recording elapsed wall-clock seconds. """
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+
+
+def environment():
+    """ What the results were measured on, to store alongside them. """
+    return {
+        'abbyy_to_epub3': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'tools': {
+            name: tools.probe(name)['version']
+            for name in ('kakadu', 'pillow')
+        },
+    }
+
+
+def write_results(path, benchmark, results):
+    """ Write results as JSON to path, or to stdout if path is None. """
+    report = {
+        'benchmark': benchmark,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': environment(),
+        'results': results,
+    }
+    if path:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,566 @@
+# Copyright 2017 Deborah Kaplan
+#
+# This file is part of Abbyy-to-epub3.
+# Source code is available at <https://github.com/deborahgu/abbyy-to-epub3>.
+#
+# Abbyy-to-epub3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Generate synthetic archive.org book items of any size, to measure how the
+conversion scales.
+
+    python -m benchmarks.corpus OUTDIR [--pages N] [--version FR10|FR6]
+        [--mix text=0.7,picture=0.1,...] [--seed N]
+
+An item is everything Ebook needs: `<id>_meta.xml`, and the book's
+`_abbyy.gz`, `_scandata.xml` & `_jp2.zip`. The ABBYY has paragraph styles
+(FR10 only), chapter headings, running headers, page numbers, footnotes,
+tables & pictures, with a `charParams` element per character as FineReader
+writes them. Pages are drawn from a mix of kinds:
+
+- text: running header, body paragraphs, page number, sometimes a footnote
+- picture: an illustration filling most of the page, with a caption
+- mixed: text around a picture
+- table: a table among text
+- blank: no blocks at all
+
+The first leaf is always the cover, the second the title page; a share of
+the leaves is marked not to be added to access formats, as color cards &
+spare pages are. Encoding JPEG 2000 is slow, so page images are drawn in a
+few variants per kind & reused; use --jp2-variants 0 for a distinct image
+per leaf.
+"""
+
+from PIL import Image, ImageDraw
+from xml.sax.saxutils import escape
+
+import argparse
+import gzip
+import io
+import os
+import random
+import zipfile
+
+from abbyy_to_epub3.constants import ABBYY_NS, OLD_NS
+
+VERSIONS = {'FR10': ABBYY_NS, 'FR6': OLD_NS}
+KINDS = ['text', 'picture', 'mixed', 'table', 'blank']
+DEFAULT_MIX = {
+    'text': 0.75, 'picture': 0.08, 'mixed': 0.08, 'table': 0.05, 'blank': 0.04,
+}
+
+# FR10 paragraph styles: id, role, extra attributes
+STYLES = [
+    ('{00000001-0000-0000-0000-000000000001}', 'text', ''),
+    ('{00000001-0000-0000-0000-000000000002}', 'heading', ' roleLevel="1"'),
+    ('{00000001-0000-0000-0000-000000000003}', 'footnote', ''),
+    ('{00000001-0000-0000-0000-000000000004}', 'tableCaption', ''),
+    ('{00000001-0000-0000-0000-000000000005}', 'rt', ''),
+]
+STYLE_IDS = {role: style_id for (style_id, role, _) in STYLES}
+
+WORDS = (
+    "the of and to in that was his he it with is for as had you not be her "
+    "on at by which have or from this him but all she they were my are me "
+    "one their so an said them we who would been will no when there if more "
+    "out up into do any your what has man could other than our some very "
+    "time upon about may its only now like little then can should made did "
+    "us such great before must two these see know over much down after "
+    "first mister good men own never most old shall day where those came "
+    "come himself way work life without go make well through being long "
+    "say might how am too even under house here while again place "
+    "country every young king people eyes hand years letter river garden"
+).split()
+
+
+def parse_mix(text):
+    """ Parse a page mix, as given on the command line: kind=share,... """
+    mix = dict.fromkeys(KINDS, 0.0)
+    for item in text.split(','):
+        (kind, share) = item.split('=')
+        if kind not in mix:
+            raise argparse.ArgumentTypeError(
+                "Unknown page kind {}; choose from {}".format(
+                    kind, ', '.join(KINDS)))
+        mix[kind] = float(share)
+    return mix
+
+
+def dimensions(text):
+    """ Parse WxH, as given on the command line """
+    (width, height) = text.lower().split('x')
+    return (int(width), int(height))
+
+
+class BookWriter(object):
+    """
+    Writes one synthetic book. Coordinates are in page image pixels, so the
+    ABBYY page size is the JP2 size, as for real scans.
+    """
+
+    def __init__(
+        self, pages=100, version='FR10', mix=None, seed=0,
+        jp2_size=(1000, 1500), jp2_variants=4, skippable=0.02,
+        char_params=True, marked_headers=False, chapter_pages=20,
+    ):
+        if version not in VERSIONS:
+            raise ValueError("Unknown ABBYY version: {}".format(version))
+        self.pages = max(pages, 2)
+        self.version = version
+        self.ns = VERSIONS[version]
+        self.mix = mix or DEFAULT_MIX
+        self.rng = random.Random(seed)
+        self.width, self.height = jp2_size
+        self.jp2_variants = jp2_variants
+        self.skippable = skippable
+        self.char_params = char_params
+        self.marked_headers = marked_headers
+        self.chapter_pages = chapter_pages
+        self.line_height = self.height // 40
+        self.margin = self.width // 12
+        self.kinds = self.page_kinds()
+        self.jp2_cache = {}   # (kind, variant): encoded JP2 bytes
+
+    def page_kinds(self):
+        """ The kind of every leaf: cover, title, then drawn from the mix. """
+        kinds = [
+            kind for kind in KINDS if self.mix.get(kind, 0) > 0
+        ] or ['text']
+        weights = [self.mix.get(kind, 0) for kind in kinds]
+        if not any(weights):
+            weights = None
+        return ['cover', 'title'] + self.rng.choices(
+            kinds, weights=weights, k=self.pages - 2
+        )
+
+    def words(self, n):
+        return ' '.join(self.rng.choice(WORDS) for _ in range(n))
+
+    # Geometry
+
+    def picture_box(self, kind, leaf):
+        """ Where the picture on a page is, as (left, top, right, bottom). """
+        if kind == 'cover':
+            return (0, 0, self.width, self.height)
+        variant = self.variant(leaf)
+        shift = (variant % 4) * self.height // 40
+        if kind == 'picture':
+            return (
+                self.margin, self.height // 10 + shift,
+                self.width - self.margin, self.height * 3 // 4 + shift,
+            )
+        return (
+            self.margin * 2, self.height * 3 // 10 + shift,
+            self.width - self.margin * 2, self.height * 11 // 20 + shift,
+        )
+
+    def variant(self, leaf):
+        return leaf % self.jp2_variants if self.jp2_variants else leaf
+
+    def body_lines(self, top, bottom):
+        """ Line boxes filling the body between top & bottom. """
+        lines = []
+        y = top
+        while y + self.line_height <= bottom:
+            lines.append((
+                self.margin, y, self.width - self.margin,
+                y + self.line_height * 4 // 5,
+            ))
+            y += self.line_height
+        return lines
+
+    # ABBYY
+
+    def chars(self, text, box):
+        """ The content of a line: charParams per character, or plain. """
+        if not self.char_params:
+            return escape(text)
+        (left, top, right, bottom) = box
+        step = max((right - left) // max(len(text), 1), 1)
+        return ''.join(
+            '<charParams l="{l}" t="{t}" r="{r}" b="{b}" '
+            'wordStart="{start}" wordFromDictionary="true" '
+            'charConfidence="{conf}">{char}</charParams>'.format(
+                l=left + i * step, t=top, r=left + (i + 1) * step, b=bottom,
+                start='true' if i == 0 or text[i - 1] == ' ' else 'false',
+                conf=self.rng.randint(40, 100), char=escape(char),
+            )
+            for (i, char) in enumerate(text)
+        )
+
+    def par(self, lines, role='text'):
+        """ A paragraph of (text, box) lines. """
+        if self.version == 'FR10':
+            start = '<par style="{}">'.format(STYLE_IDS[role])
+        else:
+            start = '<par align="Justified">'
+        content = ''.join(
+            '<line baseline="{b}" l="{l}" t="{t}" r="{r}" b="{b}">'
+            '<formatting lang="EnglishUnitedStates" ff="Times New Roman" '
+            'fs="10.">{chars}</formatting></line>'.format(
+                l=box[0], t=box[1], r=box[2], b=box[3],
+                chars=self.chars(text, box),
+            )
+            for (text, box) in lines
+        )
+        return start + content + '</par>'
+
+    @staticmethod
+    def region(box):
+        return (
+            'l="{0}" t="{1}" r="{2}" b="{3}"><region>'
+            '<rect l="{0}" t="{1}" r="{2}" b="{3}"/></region>'.format(*box)
+        )
+
+    def text_block(self, pars):
+        """ A Text block of (role, lines) paragraphs. """
+        boxes = [box for (_, lines) in pars for (_, box) in lines]
+        box = (
+            min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes),
+        )
+        return '<block blockType="Text" {}<text>{}</text></block>\n'.format(
+            self.region(box),
+            ''.join(self.par(lines, role) for (role, lines) in pars),
+        )
+
+    def picture_block(self, box):
+        return '<block blockType="Picture" {}</block>\n'.format(
+            self.region(box))
+
+    def table_block(self, box, rows=4, cols=3):
+        (left, top, right, bottom) = box
+        cell_w = (right - left) // cols
+        cell_h = (bottom - top) // rows
+        content = ''
+        for row in range(rows):
+            content += '<row>'
+            for col in range(cols):
+                cell = (
+                    left + col * cell_w, top + row * cell_h,
+                    left + (col + 1) * cell_w,
+                    top + row * cell_h + self.line_height,
+                )
+                content += '<cell><text>{}</text></cell>'.format(
+                    self.par([(self.words(2), cell)]))
+            content += '</row>'
+        return '<block blockType="Table" {}{}</block>\n'.format(
+            self.region(box), content)
+
+    def paragraphs(self, line_boxes):
+        """ Body text over the given line boxes, split into paragraphs. """
+        pars = []
+        lines = []
+        for box in line_boxes:
+            lines.append((self.words(self.rng.randint(8, 12)), box))
+            if self.rng.random() < 0.15:
+                pars.append(('text', lines))
+                lines = []
+        if lines:
+            pars.append(('text', lines))
+        return pars
+
+    def page_blocks(self, leaf, kind):
+        """ The ABBYY blocks of one page. """
+        h = self.height
+        if kind == 'blank':
+            return ''
+        if kind == 'cover':
+            return self.picture_block(self.picture_box(kind, leaf))
+        if kind == 'title':
+            return self.text_block([('heading', [(
+                'A Synthetic Book',
+                (self.margin, h // 3, self.width - self.margin,
+                 h // 3 + self.line_height * 2),
+            )])])
+
+        blocks = ''
+        header_role = 'rt' if self.marked_headers else 'text'
+        header_text = (
+            'A SYNTHETIC BOOK' if leaf % 2 else
+            'CHAPTER {}'.format(leaf // self.chapter_pages + 1)
+        )
+        blocks += self.text_block([(header_role, [(
+            header_text,
+            (self.width // 3, h // 25, self.width * 2 // 3, h // 25 + 20),
+        )])])
+
+        # Text above, below & beside pictures & tables is in blocks of its
+        # own, as ABBYY finds it
+        body_top = h // 10
+        if leaf % self.chapter_pages == 0:
+            blocks += self.text_block([('heading', [(
+                'Chapter {}'.format(leaf // self.chapter_pages + 1),
+                (self.margin, body_top, self.width // 2,
+                 body_top + self.line_height * 3 // 2),
+            )])])
+            body_top += self.line_height * 2
+
+        sections = []
+        if kind == 'picture':
+            box = self.picture_box(kind, leaf)
+            blocks += self.picture_block(box)
+            caption = 'tableCaption' if self.version == 'FR10' else 'text'
+            sections.append([(caption, [(self.words(6), (
+                self.margin, box[3] + self.line_height,
+                self.width - self.margin, box[3] + self.line_height * 2,
+            ))])])
+        elif kind == 'mixed':
+            box = self.picture_box(kind, leaf)
+            sections.append(self.paragraphs(
+                self.body_lines(body_top, box[1] - self.line_height)))
+            blocks += self.picture_block(box)
+            sections.append(self.paragraphs(
+                self.body_lines(box[3] + self.line_height, h * 4 // 5)))
+        elif kind == 'table':
+            table_top = h * 2 // 5
+            sections.append(self.paragraphs(
+                self.body_lines(body_top, table_top - self.line_height)))
+            blocks += self.table_block((
+                self.margin, table_top, self.width - self.margin,
+                table_top + h // 5))
+            sections.append(self.paragraphs(
+                self.body_lines(table_top + h // 5 + self.line_height,
+                                h * 4 // 5)))
+        else:
+            sections.append(
+                self.paragraphs(self.body_lines(body_top, h * 4 // 5)))
+        for pars in sections:
+            if pars:
+                blocks += self.text_block(pars)
+
+        if self.rng.random() < 0.2:
+            blocks += self.text_block([('footnote', [(
+                '* ' + self.words(10),
+                (self.margin, h * 17 // 20, self.width - self.margin,
+                 h * 17 // 20 + self.line_height * 2 // 3),
+            )])])
+        blocks += self.text_block([('text', [(
+            str(leaf),
+            (self.width // 2 - 20, h * 37 // 40, self.width // 2 + 20,
+             h * 37 // 40 + self.line_height * 2 // 3),
+        )])])
+        return blocks
+
+    def write_abbyy(self, path):
+        """ Stream the ABBYY XML into a gzip file, a page at a time. """
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            f.write('<document xmlns="{}" version="1.0" producer="{}" '
+                    'pagesCount="{}">\n'.format(
+                        self.ns, 'abbyy_to_epub3 synthetic corpus',
+                        len(self.kinds)))
+            if self.version == 'FR10':
+                f.write('<documentData><paragraphStyles>\n')
+                for (style_id, role, extra) in STYLES:
+                    f.write(
+                        '<paragraphStyle id="{id}" name="{role}" '
+                        'mainFontStyleId="{id}f" role="{role}"{extra} '
+                        'align="Left" startIndent="0" leftIndent="0" '
+                        'rightIndent="0"><fontStyle id="{id}f" '
+                        'ff="Times New Roman" fs="10"/></paragraphStyle>\n'
+                        .format(id=style_id, role=role, extra=extra))
+                f.write('</paragraphStyles></documentData>\n')
+            for (leaf, kind) in enumerate(self.kinds):
+                f.write('<page width="{}" height="{}" resolution="300" '
+                        'originalCoords="1">\n'.format(
+                            self.width, self.height))
+                f.write(self.page_blocks(leaf, kind))
+                f.write('</page>\n')
+            f.write('</document>\n')
+
+    # Scandata & metadata
+
+    def page_type(self, leaf, kind):
+        if kind == 'cover':
+            return 'Cover'
+        if kind == 'title':
+            return 'Title'
+        return 'Normal'
+
+    def write_scandata(self, path):
+        """ One page element per leaf, with its type, size & crop box. """
+        skip = set(
+            leaf for leaf in range(2, len(self.kinds))
+            if self.rng.random() < self.skippable
+        )
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<book>\n')
+            f.write('<bookData><leafCount>{}</leafCount></bookData>\n'.format(
+                len(self.kinds)))
+            f.write('<pageData>\n')
+            for (leaf, kind) in enumerate(self.kinds):
+                f.write(
+                    '<page leafNum="{leaf}"><pageType>{type}</pageType>'
+                    '<addToAccessFormats>{access}</addToAccessFormats>'
+                    '<origWidth>{w}</origWidth><origHeight>{h}</origHeight>'
+                    '<cropBox><x>0</x><y>0</y><w>{w}</w><h>{h}</h>'
+                    '</cropBox><handSide>{side}</handSide></page>\n'.format(
+                        leaf=leaf, type=self.page_type(leaf, kind),
+                        access='false' if leaf in skip else 'true',
+                        w=self.width, h=self.height,
+                        side='RIGHT' if leaf % 2 else 'LEFT'))
+            f.write('</pageData>\n</book>\n')
+
+    def write_meta(self, path, identifier):
+        fields = [
+            ('identifier', identifier),
+            ('title', 'A Synthetic Book'),
+            ('creator', 'Corpus, Generated'),
+            ('publisher', 'abbyy_to_epub3 benchmarks'),
+            ('date', '2017'),
+            ('language', 'eng'),
+            ('page-progression', 'lr'),
+            ('imagecount', str(len(self.kinds))),
+        ]
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<metadata>\n')
+            for (tag, value) in fields:
+                f.write('  <{0}>{1}</{0}>\n'.format(tag, escape(value)))
+            f.write('</metadata>\n')
+
+    # Page images
+
+    def page_image(self, leaf, kind):
+        """ A scan-like page: grey text lines, noisy pictures. """
+        im = Image.new('RGB', (self.width, self.height), (245, 242, 235))
+        if kind == 'blank':
+            return im
+        draw = ImageDraw.Draw(im)
+        box = None
+        if kind in ('cover', 'picture', 'mixed'):
+            box = self.picture_box(kind, leaf)
+            size = (box[2] - box[0], box[3] - box[1])
+            im.paste(Image.effect_noise(size, 60).convert('RGB'), box[:2])
+        if kind in ('cover', 'picture'):
+            return im
+        for line in self.body_lines(self.height // 10, self.height * 4 // 5):
+            if box and line[3] > box[1] and line[1] < box[3]:
+                continue
+            draw.rectangle(
+                (line[0], line[1] + 4, line[2], line[3] - 4),
+                fill=(70, 70, 70))
+        return im
+
+    def jp2(self, leaf, kind):
+        """ The encoded page image, shared between leaves of a variant. """
+        key = (kind, self.variant(leaf))
+        if key not in self.jp2_cache:
+            buf = io.BytesIO()
+            self.page_image(leaf, kind).save(
+                buf, 'JPEG2000', irreversible=True, num_resolutions=6,
+                quality_mode='rates', quality_layers=[20])
+            if not self.jp2_variants:
+                return buf.getvalue()
+            self.jp2_cache[key] = buf.getvalue()
+        return self.jp2_cache[key]
+
+    def write_jp2_zip(self, path, bookpath):
+        """ The page images, stored uncompressed as in archive.org items. """
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as zf:
+            for (leaf, kind) in enumerate(self.kinds):
+                zf.writestr(
+                    '{0}_jp2/{0}_{1:0>4}.jp2'.format(bookpath, leaf),
+                    self.jp2(leaf, kind))
+
+    def write(self, item_dir, identifier='synthetic', bookpath=None):
+        """
+        Write the whole item into item_dir. Returns a summary: the paths,
+        the number of leaves of each kind & the size of each file.
+        """
+        bookpath = bookpath or identifier
+        os.makedirs(item_dir, exist_ok=True)
+        paths = {
+            'meta': os.path.join(item_dir, identifier + '_meta.xml'),
+            'abbyy': os.path.join(item_dir, bookpath + '_abbyy.gz'),
+            'scandata': os.path.join(item_dir, bookpath + '_scandata.xml'),
+            'jp2': os.path.join(item_dir, bookpath + '_jp2.zip'),
+        }
+        self.write_meta(paths['meta'], identifier)
+        self.write_abbyy(paths['abbyy'])
+        self.write_scandata(paths['scandata'])
+        self.write_jp2_zip(paths['jp2'], bookpath)
+        return {
+            'item_dir': item_dir,
+            'identifier': identifier,
+            'bookpath': bookpath,
+            'version': self.version,
+            'pages': len(self.kinds),
+            'kinds': {
+                kind: self.kinds.count(kind)
+                for kind in sorted(set(self.kinds))
+            },
+            'bytes': {
+                name: os.path.getsize(path) for (name, path) in paths.items()
+            },
+        }
+
+
+def generate_item(item_dir, identifier='synthetic', bookpath=None, **kwargs):
+    """
+    Write a synthetic item into item_dir; takes BookWriter's options.
+    Returns BookWriter.write's summary.
+    """
+    return BookWriter(**kwargs).write(item_dir, identifier, bookpath)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('item_dir', help='Directory to write the item into')
+    parser.add_argument('--identifier', default='synthetic')
+    parser.add_argument('--bookpath', default=None)
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--version', choices=sorted(VERSIONS), default='FR10')
+    parser.add_argument(
+        '--mix', type=parse_mix, default=None,
+        help='Shares of page kinds, e.g. text=0.6,picture=0.2,table=0.2. '
+        'Kinds: {}'.format(', '.join(KINDS)),
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--jp2-size', type=dimensions, default=(1000, 1500),
+        help='Page image size as WxH',
+    )
+    parser.add_argument(
+        '--jp2-variants', type=int, default=4,
+        help='Distinct page images per page kind; 0 for one per leaf',
+    )
+    parser.add_argument(
+        '--skippable', type=float, default=0.02,
+        help='Share of leaves not added to access formats',
+    )
+    parser.add_argument(
+        '--no-char-params', dest='char_params', action='store_false',
+        help='Write plain line text instead of a charParams per character',
+    )
+    parser.add_argument(
+        '--marked-headers', action='store_true',
+        help="Mark running headers with FR10's rt role, instead of leaving "
+        'them to be detected',
+    )
+    args = parser.parse_args()
+
+    summary = generate_item(
+        args.item_dir, args.identifier, args.bookpath,
+        pages=args.pages, version=args.version, mix=args.mix,
+        seed=args.seed, jp2_size=args.jp2_size,
+        jp2_variants=args.jp2_variants, skippable=args.skippable,
+        char_params=args.char_params, marked_headers=args.marked_headers,
+    )
+    print(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -74,6 +74,10 @@ setup(
         'abbyy_to_epub3': ['config.ini']
     },
     entry_points={
-        'console_scripts': ['abbyy2epub=abbyy_to_epub3.commandline:main'],
+        'console_scripts': [
+            'abbyy2epub=abbyy_to_epub3.commandline:main',
+            'abbyy2epub-batch=abbyy_to_epub3.commandline:batch_main',
+            'abbyy2epub-service=abbyy_to_epub3.commandline:service_main',
+        ],
     }
 )